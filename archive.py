@@ -0,0 +1,189 @@
+"""Archives of recorded events.
+
+An archive is a file of concatenated messages in wire form (see
+Serializer.wire) that is memory-mapped for reading. Messages are
+found using the blank line that ends the headers and Content-Length,
+so only the headers are parsed while iterating and the body is
+decoded when it is accessed.
+
+An optional sidecar index file (archive path + '.idx') maps X-Hash
+values to message offsets for random access. It holds fixed size
+records sorted by hash, so lookups are a binary search on the mapped
+index file. The first record holds the size of the archive when the
+index was built, a stale index is built again.
+"""
+import os
+import mmap
+
+from swarmforce.http import SERIALIZER, X_HASH, CONTENT_LENGTH, \
+     find_head_end, parse_head
+
+INDEX_EXT = '.idx'
+INDEX_FMT = '%40s %016x\n'
+INDEX_RECORD = 58
+
+
+class Record(object):
+    """A message stored in an archive.
+
+    headers is the Request or Response with all the headers but no body.
+    body and event read and decode the body only when they are accessed.
+    """
+    __slots__ = ('archive', 'offset', 'body_offset', 'length', 'headers')
+
+    def __init__(self, archive, offset, body_offset, length, headers):
+        self.archive = archive
+        self.offset = offset
+        self.body_offset = body_offset
+        self.length = length
+        self.headers = headers
+
+    @property
+    def key(self):
+        "The X-Hash of the message, if any"
+        return self.headers.get(X_HASH)
+
+    @property
+    def end(self):
+        "Offset of the byte following the message"
+        return self.body_offset + self.length
+
+    @property
+    def body(self):
+        "Decode the body from the archive"
+        data = self.archive.data
+        return data[self.body_offset:self.end].decode('utf-8')
+
+    @property
+    def event(self):
+        "Return the full message, loading its body"
+        msg = self.headers
+        if self.length and not dict.get(msg, 'body'):
+            dict.__setitem__(msg, 'body', self.body)
+        return msg
+
+
+class Archive(object):
+    """A memory-mapped file of concatenated messages."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = ''  # empty files can not be mapped
+        self.size = size
+        self.index = None
+
+    def read(self, offset):
+        "Return the Record of the message found at offset or None"
+        data = self.data
+        size = self.size
+        while offset < size and data[offset] in '\r\n':
+            offset += 1  # skip blank lines between messages
+        if offset >= size:
+            return None
+
+        end, sep = find_head_end(data, offset)
+        if end < 0:
+            end, sep = size, 0  # last message without blank line
+        headers = parse_head(data[offset:end])
+        length = int(headers.get(CONTENT_LENGTH, 0))
+        body_offset = end + sep
+        if body_offset + length > size:
+            raise RuntimeError('Truncated message at %s in %s' %
+                               (offset, self.path))
+        return Record(self, offset, body_offset, length, headers)
+
+    def __iter__(self):
+        offset = 0
+        record = self.read(offset)
+        while record is not None:
+            yield record
+            record = self.read(record.end)
+
+    # index sidecar
+    def build_index(self):
+        "Write the X-Hash index sidecar of the archive"
+        entries = sorted((record.key, record.offset) for record in self
+                         if record.key)
+        path = self.path + INDEX_EXT
+        with open(path + '.tmp', 'wb') as index:
+            index.write(INDEX_FMT % ('', self.size))
+            for key, offset in entries:
+                index.write(INDEX_FMT % (key, offset))
+        os.rename(path + '.tmp', path)
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        self.index = None
+        self._open_index()
+
+    def _open_index(self):
+        "Map the index sidecar, None if missing or stale"
+        path = self.path + INDEX_EXT
+        if self.index is None and os.path.exists(path):
+            with open(path, 'rb') as index:
+                header = index.read(INDEX_RECORD)
+                if header[:40].strip() or len(header) < INDEX_RECORD or \
+                   int(header[41:57], 16) != self.size:
+                    return None  # written for another archive size
+                self.index = mmap.mmap(index.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        return self.index
+
+    def lookup(self, hash_):
+        "Return the Record with X-Hash hash_ or None, using the index"
+        index = self._open_index()
+        if index is None:
+            self.build_index()
+            index = self.index
+
+        low, high = 1, len(index) // INDEX_RECORD  # skip the header
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * INDEX_RECORD
+            key = index[start:start + 40]
+            if key < hash_:
+                low = middle + 1
+            else:
+                high = middle
+
+        start = low * INDEX_RECORD
+        if index[start:start + 40] == hash_:
+            return self.read(int(index[start + 41:start + 57], 16))
+
+    def close(self):
+        "Release the mapped files"
+        for data in (self.data, self.index):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.file.close()
+
+
+def parse_many(path, index=False):
+    """Iterate lazily over the messages stored in the file at path.
+    Build the X-Hash index sidecar first when index is True.
+    The archive is closed when the iteration ends, so the bodies must
+    be read meanwhile."""
+    archive = Archive(path)
+    try:
+        if index:
+            archive.build_index()
+        for record in archive:
+            yield record
+    finally:
+        archive.close()
+
+
+def write_many(path, events):
+    "Append events in wire form to the archive at path"
+    buf = bytearray()
+    for event in events:
+        SERIALIZER.write(event, buf)
+    with open(path, 'ab') as archive:
+        archive.write(buf)
+
+
+# End
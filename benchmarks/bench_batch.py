@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Benchmark single vs batched dispatch.
+
+Queue N tiny eval requests in a paused World, then measure the time
+until all their responses are back, with a worker that handles one
+request per dispatch_request() call and with a worker that handles a
+whole dispatch_batch() at once. Each call pays a fixed ROUND_TRIP
+cost, as a worker that stores its results in a database would.
+"""
+import os
+import sys
+import time
+import logging
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.swarm import World, Worker, RUNNING, PAUSED
+
+N = 5000
+ROUND_TRIP = 0.0002  # seconds per call, e.g. a database commit
+BATCH_SIZES = [1, 16, 64, 256]
+
+
+class Client(Worker):
+    "Count the responses"
+    def __init__(self):
+        Worker.__init__(self)
+        self.hits = 0
+
+    def dispatch_response(self, event):
+        self.hits += 1
+
+
+class Single(Worker):
+    "Evaluate one request at a time"
+    def dispatch_request(self, event):
+        event.answer().body = unicode(eval(event.body))
+        time.sleep(ROUND_TRIP)
+
+
+class Batched(Worker):
+    "Evaluate a batch of requests at once"
+    def dispatch_batch(self, events):
+        code = compile('[%s]' % ', '.join(e.body for e in events),
+                       '<batch>', 'eval')
+        for event, result in zip(events, eval(code)):
+            event.answer().body = unicode(result)
+        time.sleep(ROUND_TRIP)
+
+
+def bench(batch_size, n):
+    "return the events per second for n requests"
+    world = World()
+    world.lifetime = None
+    world.max_batch = max(256, batch_size)
+    world.start()
+    client = world.new(Client)
+    if batch_size == 1:
+        worker = world.new(Single)
+    else:
+        worker = world.new(Batched)
+        worker.batch_size = batch_size
+    worker.listen('DO /eval')
+
+    world.set(PAUSED)
+    time.sleep(world.relax * 2)
+    for i in xrange(n):
+        req = client.new_request(method='DO', path='/eval',
+                                 body=u'%s + 1' % i)
+        client.send(req)
+
+    t0 = time.time()
+    world.set(RUNNING)
+    while client.hits < n:
+        time.sleep(0.001)
+    elapsed = time.time() - t0
+    world.stop()
+    return n / elapsed
+
+
+def main():
+    logging.getLogger('swarmforce').setLevel(logging.ERROR)
+    print '%10s %12s %8s' % ('batch', 'events/s', 'speedup')
+    base = None
+    for batch_size in BATCH_SIZES:
+        rate = bench(batch_size, N)
+        base = base or rate
+        print '%10s %12.0f %8.2f' % (batch_size if batch_size > 1 else 'single',
+                                     rate, rate / base)
+
+
+if __name__ == '__main__':
+    main()
+
+# End
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark the hashing cost of World.push.
+
+World.push hashes a request, reads its key and checks its sanity, and
+answer() reads the hash header. Count how many full serializations
+(Serializer.canonical calls) are done per push and how long it takes, with the
+cached footprint and with the cache dropped before every access as
+it was before the footprint was memoized.
+"""
+import os
+import sys
+import time
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.http import Serializer, Request, populate, X_HASH
+
+N = 20000
+
+calls = [0]
+_canonical = Serializer.canonical
+
+
+def counted_canonical(self, *args, **kw):
+    "Serializer.canonical that counts its calls"
+    calls[0] += 1
+    return _canonical(self, *args, **kw)
+
+
+def push_like(event, cold):
+    "Same hashing steps that World.push does"
+    event.hash()
+    if cold:
+        event._invalidate()
+    event.key
+    if cold:
+        event._invalidate()
+    event.sane()
+    return event[X_HASH]
+
+
+def bench(cold):
+    "return dumps per push and usec per push"
+    events = list()
+    for i in xrange(N):
+        event = Request()
+        populate(event)
+        events.append(event)
+
+    calls[0] = 0
+    t0 = time.time()
+    for event in events:
+        push_like(event, cold)
+    elapsed = time.time() - t0
+    return float(calls[0]) / N, elapsed * 1e6 / N
+
+
+def main():
+    "Main entry point of benchmark"
+    Serializer.canonical = counted_canonical
+    print '%10s %14s %14s' % ('mode', 'dumps/push', 'us/push')
+    for cold, name in ((True, 'uncached'), (False, 'cached')):
+        dumps, cost = bench(cold)
+        print '%10s %14.1f %14.2f' % (name, dumps, cost)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# End
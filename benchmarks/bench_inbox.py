@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Benchmark inbox storage: one file per event against an InboxLog.
+
+- files: write every event to its own file in the inbox folder, then
+  move them all to another folder as clean_dead() does
+- log: append the events to an InboxLog with a single final fsync,
+  then read them back with a consumer
+- log sync: THREADS writers appending with a fsync per event, shared
+  by group commit
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from threading import Thread
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.http import Request, SERIALIZER
+from swarmforce.inboxlog import InboxLog
+
+N = [1000, 10000, 50000]
+SYNC_N = 2000
+THREADS = 8
+
+
+def request(i):
+    req = Request(method='DO', path='/inbox/%s' % i, body=u'event %s' % i)
+    req.hash()
+    return req
+
+
+def bench_files(root, events):
+    inbox = os.path.join(root, 'inbox')
+    other = os.path.join(root, 'other')
+    os.makedirs(inbox)
+    os.makedirs(other)
+    t0 = time.time()
+    for event in events:
+        with open(os.path.join(inbox, event.key), 'wb') as f:
+            f.write(SERIALIZER.write(event, bytearray()))
+    t1 = time.time()
+    for name in os.listdir(inbox):
+        os.rename(os.path.join(inbox, name), os.path.join(other, name))
+    return t1 - t0, time.time() - t1
+
+
+def bench_log(root, events):
+    inbox = InboxLog(os.path.join(root, 'log'))
+    t0 = time.time()
+    for event in events:
+        inbox.append(event, sync=False)
+    inbox.sync()
+    t1 = time.time()
+    consumer = inbox.consumer('bench')
+    while consumer.poll(1000):
+        pass
+    consumer.commit()
+    t2 = time.time()
+    inbox.close()
+    return t1 - t0, t2 - t1
+
+
+def bench_sync(root, events):
+    "return the events per second and the number of fsync calls"
+    inbox = InboxLog(os.path.join(root, 'sync'))
+    chunks = [events[i::THREADS] for i in range(THREADS)]
+
+    def writer(chunk):
+        for event in chunk:
+            inbox.append(event)
+
+    threads = [Thread(target=writer, args=(chunk, )) for chunk in chunks]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+    syncs = inbox.syncs
+    inbox.close()
+    return len(events) / elapsed, syncs
+
+
+def main():
+    print 'events/s'
+    print '%10s %12s %12s %12s %12s' % (
+        'events', 'file write', 'file move', 'log append', 'log read')
+    for n in N:
+        events = [request(i) for i in xrange(n)]
+        root = tempfile.mkdtemp()
+        try:
+            fw, fm = bench_files(root, events)
+            lw, lr = bench_log(root, events)
+        finally:
+            shutil.rmtree(root)
+        print '%10s %12.0f %12.0f %12.0f %12.0f' % (
+            n, n / fw, n / fm, n / lw, n / lr)
+
+    print
+    print 'durable appends from %s threads' % THREADS
+    root = tempfile.mkdtemp()
+    try:
+        rate, syncs = bench_sync(root, [request(i) for i in xrange(SYNC_N)])
+    finally:
+        shutil.rmtree(root)
+    print '%10s %12s %12s' % ('events', 'events/s', 'fsyncs')
+    print '%10s %12.0f %12s' % (SYNC_N, rate, syncs)
+
+
+if __name__ == '__main__':
+    main()
+
+# End
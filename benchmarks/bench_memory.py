@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark the memory used by queued events.
+
+Events are parsed from their wire form, as they arrive from other
+nodes, and the memory reachable from the queue is measured while they
+are Event dicts and once they are packed as PackedEvent.
+"""
+import gc
+import os
+import sys
+import time
+import types
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.http import Request, StreamParser, SERIALIZER, \
+     populate, pack
+
+N = 50000
+SKIP = (type, types.ModuleType, types.FunctionType, types.ClassType)
+
+
+def deep_size(root):
+    "Return the bytes of all objects reachable from root"
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, SKIP):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def main():
+    "Main entry point of benchmark"
+    buf = bytearray()
+    for i in xrange(N):
+        msg = Request()
+        populate(msg)
+        msg.hash()
+        SERIALIZER.write(msg, buf)
+
+    queue = StreamParser().feed(buf)
+    del buf
+
+    # shared header sets are counted once, in the first event
+    t0 = time.time()
+    packed = [pack(event) for event in queue]
+    pack_cost = (time.time() - t0) * 1e6 / N
+
+    t0 = time.time()
+    for event in packed:
+        event.unpack()
+    unpack_cost = (time.time() - t0) * 1e6 / N
+
+    events = deep_size(queue) / float(N)
+    compact = deep_size(packed) / float(N)
+    print '%10s %14s %14s' % ('form', 'bytes/event', 'us/event')
+    print '%10s %14.0f %14s' % ('Event', events, '-')
+    print '%10s %14.0f %14.2f' % ('packed', compact, pack_cost)
+    print '%10s %14s %14.2f' % ('unpack', '-', unpack_cost)
+    print 'ratio: %.2f' % (compact / events)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# End
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Benchmark the World run queue.
+
+Measure the per-event cost of filling a queue with N events and then
+draining it, for the RunQueue used by World and for the former plain
+list with pop(0). The RunQueue cost must stay flat as N grows.
+"""
+import os
+import sys
+import time
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.queues import RunQueue
+
+SIZES = [1000, 10000, 100000, 1000000]
+LIST_LIMIT = 100000  # list.pop(0) is quadratic, don't wait forever
+
+
+def bench_runqueue(n, max_batch):
+    "fill and drain a RunQueue, return the cost per event in usec"
+    queue = RunQueue()
+    t0 = time.time()
+    for i in xrange(n):
+        queue.append(i)
+    while queue:
+        queue.drain(max_batch)
+    return (time.time() - t0) * 1e6 / n
+
+
+def bench_list(n):
+    "fill and drain a plain list using pop(0), return usec per event"
+    queue = list()
+    t0 = time.time()
+    for i in xrange(n):
+        queue.append(i)
+    while queue:
+        queue.pop(0)
+    return (time.time() - t0) * 1e6 / n
+
+
+def main():
+    "Main entry point of benchmark"
+    print '%10s %14s %14s %14s' % ('events', 'list (us/ev)',
+                                   'batch=1', 'batch=64')
+    for n in SIZES:
+        if n <= LIST_LIMIT:
+            cost = '%14.3f' % bench_list(n)
+        else:
+            cost = '%14s' % '-'
+        print '%10s %s %14.3f %14.3f' % (
+            n, cost, bench_runqueue(n, 1), bench_runqueue(n, 64))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# End
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Benchmark the worker status lookup of a node.
+
+N workers have a pid file and FILES messages in their inbox. Compare
+walking node_home and reading every pid file (scan_pid_files) with
+reading the registry (get_worker_status).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.swarm import Layout
+
+WORKERS = [10, 100, 1000]
+FILES = 100
+ROUNDS = 5
+
+
+def populate(root, n):
+    for i in xrange(n):
+        layout = Layout(root, 'node', '%040x' % i)
+        layout.setup()
+        layout.update_pid_file()
+        for j in xrange(FILES):
+            file(os.path.join(layout['inbox'], 'msg%s' % j), 'wb').close()
+    return layout
+
+
+def timeit(func):
+    t0 = time.time()
+    for _ in xrange(ROUNDS):
+        result = func()
+    return (time.time() - t0) / ROUNDS * 1000, len(result)
+
+
+def main():
+    print 'msec per status of all the workers (%s inbox files each)' % FILES
+    print '%10s %12s %12s' % ('workers', 'os.walk', 'registry')
+    for n in WORKERS:
+        root = tempfile.mkdtemp()
+        try:
+            layout = populate(root, n)
+            walk, found = timeit(layout.scan_pid_files)
+            registry, indexed = timeit(layout.get_worker_status)
+            assert found == indexed == n
+        finally:
+            shutil.rmtree(root)
+        print '%10s %12.2f %12.2f' % (n, walk, registry)
+
+
+if __name__ == '__main__':
+    main()
+
+# End
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Benchmark the sharded runtime.
+
+Push N CPU bound requests into a ShardedWorld with 1, 2, 4 and 8 shards
+and measure the time until every shard has processed its queue. The
+speed-up is bounded by the number of CPU cores of the machine.
+"""
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.swarm import Worker
+from swarmforce.http import Request
+from swarmforce.shards import ShardedWorld
+
+SHARDS = [1, 2, 4, 8]
+N = 4000
+WORK = 20000  # loop iterations per request
+
+
+class Cruncher(Worker):
+    "A CPU bound worker"
+    def dispatch_request(self, event):
+        sum(xrange(WORK))
+
+
+def add_cruncher(world, index):
+    world.new(Cruncher).listen('DO /crunch')
+
+
+def bench(shards, n):
+    "return the elapsed seconds for processing n requests"
+    requests = [Request(method='DO', path='/crunch', body=u'%s' % i)
+                for i in xrange(n)]
+    world = ShardedWorld(shards, setup=add_cruncher)
+    world.start()
+    t0 = time.time()
+    for req in requests:
+        world.push(req)
+    stats = world.stop()
+    elapsed = time.time() - t0
+    assert sum(s['received'] for s in stats.values()) == n
+    return elapsed
+
+
+def main():
+    logging.getLogger('swarmforce').setLevel(logging.WARNING)
+    print 'CPU cores: %s, requests: %s' % (multiprocessing.cpu_count(), N)
+    print '%8s %10s %12s %8s' % ('shards', 'time (s)', 'events/s', 'speedup')
+    base = None
+    for shards in SHARDS:
+        elapsed = bench(shards, N)
+        base = base or elapsed
+        print '%8s %10.3f %12.0f %8.2f' % (shards, elapsed, N / elapsed,
+                                           base / elapsed)
+
+
+if __name__ == '__main__':
+    main()
+
+# End
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Benchmark the shared memory ring against the TCP transport.
+
+A child process runs a World with a worker counting requests. The
+parent sends it N requests, one way, through a ShmRing or a loopback
+Transport connection and waits until the child has counted them all.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import tempfile
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.swarm import World, Worker
+from swarmforce.http import Request
+from swarmforce.transport import Transport
+from swarmforce.shmring import ShmRing, RingSender, RingReceiver
+
+N = [1000, 10000, 50000]
+SIZE = 1 << 22
+SHM = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class Counter(Worker):
+    "Count requests and write a byte to a pipe after the n-th one"
+    def __init__(self, n, done):
+        Worker.__init__(self)
+        self.n = n
+        self.done = done
+        self.hits = 0
+
+    def dispatch_request(self, event):
+        self.hits += 1
+        if self.hits == self.n:
+            os.write(self.done, 'x')
+
+
+def request(i):
+    return Request(method='DO', path='/count', body=u'%s' % i)
+
+
+def child_world(n, done):
+    world = World()
+    world.lifetime = None
+    world.pending_ttl = None
+    world.start()
+    world.new(Counter, n, done).listen('DO /count')
+    return world
+
+
+def bench_ring(n):
+    "return the events per second sent through a ShmRing"
+    root = tempfile.mkdtemp(dir=SHM)
+    path = os.path.join(root, 'ring')
+    ring = ShmRing(path, size=SIZE, create=True)
+    done, wdone = os.pipe()
+    pid = os.fork()
+    if not pid:
+        world = child_world(n, wdone)
+        RingReceiver(ring, world).start()
+        time.sleep(3600)  # until the parent kills it
+
+    sender = RingSender(ring)
+    events = [request(i) for i in xrange(n)]
+    t0 = time.time()
+    for event in events:
+        sender.push(event)
+    os.read(done, 1)
+    elapsed = time.time() - t0
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    ring.unlink()
+    os.rmdir(root)
+    return n / elapsed
+
+
+def bench_tcp(n):
+    "return the events per second sent through a loopback connection"
+    done, wdone = os.pipe()
+    ready, wready = os.pipe()
+    pid = os.fork()
+    if not pid:
+        world = child_world(n, wdone)
+        server = Transport(world)
+        port = server.listen()[1]
+        server.start()
+        os.write(wready, '%5d' % port)
+        time.sleep(3600)
+
+    port = int(os.read(ready, 5))
+    client = Transport()
+    client.start()
+    conn = client.connect(('127.0.0.1', port))
+    events = [request(i) for i in xrange(n)]
+    t0 = time.time()
+    for event in events:
+        client.send(conn, event)
+    os.read(done, 1)
+    elapsed = time.time() - t0
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    client.stop()
+    return n / elapsed
+
+
+def main():
+    logging.getLogger('swarmforce').setLevel(logging.ERROR)
+    print 'one way events/s into a World in another process'
+    print '%10s %12s %12s %8s' % ('requests', 'shm ring', 'tcp', 'ratio')
+    for n in N:
+        shm = bench_ring(n)
+        tcp = bench_tcp(n)
+        print '%10s %12.0f %12.0f %8.2f' % (n, shm, tcp, shm / tcp)
+
+
+if __name__ == '__main__':
+    main()
+
+# End
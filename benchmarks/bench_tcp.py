@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Benchmark the TCP transport over loopback.
+
+Latency: send one request at a time and wait for its response.
+Throughput: pipeline N requests on a single keep-alive connection and
+wait for all the responses.
+"""
+import os
+import sys
+import time
+import logging
+
+# add root of code imports
+sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
+
+from swarmforce.swarm import World, Worker
+from swarmforce.http import Request
+from swarmforce.reactor import gather
+from swarmforce.transport import Transport
+
+LATENCY_N = 2000
+THROUGHPUT_N = [1000, 10000, 50000]
+
+
+class Echo(Worker):
+    "Answer with the request body"
+    def dispatch_request(self, event):
+        event.answer().body = event.body
+
+
+def request(i):
+    return Request(method='DO', path='/echo', body=u'%s' % i)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench_latency(client, conn, n):
+    "return the round trip times in usec"
+    samples = list()
+    for i in xrange(n):
+        t0 = time.time()
+        client.send(conn, request(i), future=True).result(5)
+        samples.append((time.time() - t0) * 1e6)
+    return samples
+
+
+def bench_throughput(client, conn, n):
+    "return the events per second of n pipelined requests"
+    t0 = time.time()
+    futures = [client.send(conn, request(i), future=True) for i in xrange(n)]
+    gather(futures).result(120)
+    return n / (time.time() - t0)
+
+
+def main():
+    logging.getLogger('swarmforce').setLevel(logging.ERROR)
+    world = World()
+    world.lifetime = None
+    world.start()
+    world.new(Echo).listen('DO /echo')
+    server = Transport(world)
+    server.listen()
+    server.start()
+    client = Transport()
+    client.start()
+    conn = client.connect(server.address)
+
+    samples = bench_latency(client, conn, LATENCY_N)
+    print 'latency over %s requests (usec)' % LATENCY_N
+    print '%10s %10s %10s %10s' % ('mean', 'p50', 'p99', 'max')
+    print '%10.0f %10.0f %10.0f %10.0f' % (
+        sum(samples) / len(samples), percentile(samples, 0.5),
+        percentile(samples, 0.99), max(samples))
+    print
+    print 'pipelined throughput'
+    print '%10s %12s' % ('requests', 'events/s')
+    for n in THROUGHPUT_N:
+        print '%10s %12.0f' % (n, bench_throughput(client, conn, n))
+
+    client.stop()
+    server.stop()
+    world.stop()
+
+
+if __name__ == '__main__':
+    main()
+
+# End
@@ -25,22 +25,39 @@ class FileSystemMonitor(FileSystemEventHandler):
     application's debug log.  Additional ``*args`` and ``**kwargs`` are passed
     to the parent class.
 
+    When a ``feeder`` (an InboxFeeder) is given, the files created,
+    modified or moved into the watched folders are notified to it, so
+    they are consumed as soon as they arrive.
+
     :param app: The application object
+    :param feeder: The InboxFeeder of the inbox folders or None
 
     """
 
-    def __init__(self, app, *args, **kw):
+    def __init__(self, app, feeder=None, *args, **kw):
         FileSystemEventHandler.__init__(self, *args, **kw)
         self.app = app
+        self.feeder = feeder
 
     def _on_any_event(self, event):
         self.app.log.info("Watchdog Event: %s" % (event.key,))  # pragma: nocover
 
+    def on_created(self, event):
+        if self.feeder is not None and not event.is_directory:
+            self.feeder.notify(event.src_path)
+
     def on_modified(self, event):
-        self.app.log.info("UPDATE Event: %s" % (event.key,))  # pragma: nocover
+        if self.feeder is not None and not event.is_directory:
+            self.feeder.notify(event.src_path)  # the rest of a message
+        else:
+            self.app.log.info("UPDATE Event: %s" % (event.key,))  # pragma: nocover
 
     def on_deleted(self, event):
-        self.app.log.info("DELETED Event: %s" % (event.key,))  # pragma: nocover
+        if self.feeder is None:
+            self.app.log.info("DELETED Event: %s" % (event.key,))  # pragma: nocover
 
     def on_moved(self, event):
-        self.app.log.info("MOVED Event: %s" % (event.key,))  # pragma: nocover
+        if self.feeder is not None and not event.is_directory:
+            self.feeder.notify(event.dest_path)
+        else:
+            self.app.log.info("MOVED Event: %s" % (event.key,))  # pragma: nocover
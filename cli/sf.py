@@ -17,6 +17,7 @@ from cement.core.controller import CementBaseController, expose
 from cement.core.exc import CaughtSignal, FrameworkError
 from cement.ext.ext_daemon import Environment
 from cement.ext.ext_watchdog import WatchdogEventHandler
+from watchdog.observers import Observer
 
 # add root of code imports
 sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)[:-3]))
@@ -25,7 +26,8 @@ sys.path.insert(0, os.path.sep.join(os.path.abspath(__file__).split(os.path.sep)
 from monitor import MonitorController, FileSystemMonitor
 from show import ShowController
 from swarmforce.misc import expath
-from swarmforce.swarm import Layout, active, dead
+from swarmforce.swarm import World, Layout, active, dead
+from swarmforce.inboxwatch import InboxFeeder
 from swarmforce.loggers import getLogger, log_configfile
 
 os.chdir(os.environ.get('SF_HOME', '.'))
@@ -41,6 +43,8 @@ defaults = init_defaults('swarmforce', 'log.logging')
 defaults['swarmforce']['debug'] = False
 defaults['swarmforce']['workers'] = '1'
 defaults['swarmforce']['root'] = '.'
+# the workers of each process, one per line: <module>.<Class> <rule>
+defaults['swarmforce']['worker_classes'] = ''
 
 
 # -----------------------------------------
@@ -82,6 +86,12 @@ def my_setup_hook(app):
     layout.setup()
     layout.update_pid_file()
 
+    # the World hosting the workers of this process, fed by
+    # watch_inboxes(). It starts after daemonize(), threads do not fork
+    app.world = World()
+    app.world.lifetime = None
+    load_workers(app)
+
     # replace logger
     # app.log = log
     #app.log.error('TEST')
@@ -100,10 +110,74 @@ def my_setup_hook(app):
         # os.unlink(pid_file)
 
 
+def load_workers(app):
+    """Create in app.world the workers listed in the 'worker_classes'
+    option, one per line: the dotted path of a Worker class and the
+    regexp of the statuslines it listens to, e.g.
+
+        worker_classes = swarmforce.tests.demo_workers.EvalWorker DO /eval
+    """
+    spec = app.config.get('swarmforce', 'worker_classes') or ''
+    for line in spec.splitlines():
+        path, _, rule = line.strip().partition(' ')
+        if not path:
+            continue
+        module, _, name = path.rpartition('.')
+        klass = getattr(__import__(module, fromlist=[name]), name)
+        worker = app.world.new(klass)
+        rule = rule.strip()
+        if rule:
+            worker.listen(rule)
+        log.info('Worker %s listens to %r', worker, rule)
+
+
 def my_cleanup_hook(app):
     """Clean any resources necessary at the end of the application."""
 
 
+def watch_inboxes(app):
+    """Consume the worker and node inboxes as files arrive in them.
+
+    A watchdog Observer notifies the new files to an InboxFeeder that
+    pushes their messages into app.world, the World hosting the workers
+    of this process, in coalesced batches. The feeder scans the folders
+    on start for the files dropped meanwhile.
+
+    Every process of the node watches the node inbox: the feeders claim
+    each file by renaming it, so only one of them consumes it. Nothing
+    is watched while this process has no workers, leaving the files to
+    the processes that have them.
+    """
+    world = app.world
+    if not world.workers:
+        log.warn('No worker_classes in %s, inboxes not watched',
+                 app.workerid)
+        return
+    if not world.is_alive():
+        world.start()
+
+    layout = app.layout
+    paths = [layout['inbox'], layout['node_inbox']]
+    app.feeder = InboxFeeder(world, paths)
+    app.observer = Observer()
+    handler = FileSystemMonitor(app, app.feeder)
+    for path in paths:
+        app.observer.schedule(handler, path, recursive=False)
+    app.observer.start()  # before the scan, so no file is missed
+    app.feeder.start()
+
+
+def unwatch_inboxes(app):
+    "Stop the inbox consumption started by watch_inboxes()"
+    if getattr(app, 'observer', None) is None:
+        return
+    app.observer.stop()
+    app.observer.join()
+    app.feeder.stop()  # before the world, so no message is refused
+    app.world.stop()
+    app.observer = None
+
+
 # -----------------------------------------
 # The Default base handler
 # -----------------------------------------
@@ -230,6 +304,7 @@ def main():
             app.run()
 
             app.daemonize()
+            watch_inboxes(app)
 
             try:
                 killtimeout = app.config.get('swarmforce', 'killtimeout')
@@ -240,6 +315,7 @@ def main():
 
                     # print 'print: pid[%s] loop: %s' % (os.getpid(), i)
                     time.sleep(1)
+                    app.layout.update_pid_file()  # heartbeat
                     if random.random() < 0.5:
                         app.layout.clean_dead()
 
@@ -272,6 +348,8 @@ def main():
             app.exit_code = 300
 
         finally:
+            unwatch_inboxes(app)
+
             # Maybe we want to see a full-stack trace for the above
             # exceptions, but only if --debug was passed?
             if app.debug:
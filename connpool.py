@@ -0,0 +1,195 @@
+"""Outbound connection pools for forwarding events to other nodes.
+
+A ConnectionPool keeps, for every destination node id (the sha1 nodeid
+of cli/sf.py), between min_size and max_size persistent connections of
+a Transport. Requests are multiplexed on the connection with the fewest
+requests in flight, and a new connection is only opened when all of
+them carry max_inflight pipelined requests.
+
+A maintenance thread runs every 'interval' seconds to:
+
+- open connections up to min_size
+- close connections idle for more than idle_timeout above min_size
+- PING idle connections and close the ones that do not answer within
+  health_timeout seconds
+"""
+import time
+import socket
+from threading import Thread, Lock, Event as Flag
+
+from swarmforce.loggers import getLogger
+
+log = getLogger('swarmforce')
+
+
+class NodePool(object):
+    """The connections to a single node and their counters"""
+    def __init__(self, nodeid, address):
+        self.nodeid = nodeid
+        self.address = address
+        self.connections = list()
+        self.pings = dict()  # connection -> (Future, sent time)
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self.failed = 0  # connect errors and failed health checks
+
+    def inflight(self):
+        return sum(len(conn.waiting) for conn in self.connections)
+
+    def stats(self, max_inflight):
+        size = len(self.connections)
+        inflight = self.inflight()
+        return dict(
+            address=self.address, size=size, inflight=inflight,
+            busy=sum(1 for conn in self.connections if conn.waiting),
+            utilization=float(inflight) / (size * max_inflight)
+            if size else 0.0,
+            opened=self.opened, closed=self.closed, reaped=self.reaped,
+            failed=self.failed)
+
+
+class ConnectionPool(object):
+    """Per node pools of outbound connections of a Transport."""
+    def __init__(self, transport, min_size=1, max_size=4, max_inflight=128,
+                 idle_timeout=60, interval=5, health_timeout=5):
+        self.transport = transport
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_inflight = max_inflight
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.health_timeout = health_timeout
+        self.nodes = dict()
+        self.lock = Lock()
+        self._stop = Flag()
+        self._thread = None
+
+    def register(self, nodeid, address):
+        "Set the (host, port) address of a node"
+        with self.lock:
+            node = self.nodes.get(nodeid)
+            if node is None:
+                self.nodes[nodeid] = NodePool(nodeid, address)
+            else:
+                node.address = address
+
+    def _open(self, node):
+        "Open a new connection to node. Called with the lock held"
+        try:
+            conn = self.transport.connect(node.address)
+        except socket.error, why:
+            node.failed += 1
+            log.warn('Can not connect to node %s at %s: %s',
+                     node.nodeid, node.address, why)
+            raise
+        node.connections.append(conn)
+        node.opened += 1
+        return conn
+
+    def _discard(self, node, conn):
+        node.connections.remove(conn)
+        node.pings.pop(conn, None)
+        node.closed += 1
+        if not conn.closed:
+            self.transport.close(conn)
+
+    def acquire(self, nodeid):
+        "Return the least loaded connection to a node, opening one if needed"
+        with self.lock:
+            node = self.nodes[nodeid]
+            for conn in [c for c in node.connections if c.closed]:
+                self._discard(node, conn)
+            best = None
+            if node.connections:
+                best = min(node.connections, key=lambda c: len(c.waiting))
+            if best is None or (len(best.waiting) >= self.max_inflight and
+                                len(node.connections) < self.max_size):
+                best = self._open(node)
+            return best
+
+    def send(self, nodeid, event, future=True):
+        """Send an event to a node. Return a Future of the response
+        when future is True"""
+        conn = self.acquire(nodeid)
+        return self.transport.send(conn, event, future)
+
+    def maintain(self):
+        "Run a maintenance round on all the node pools"
+        now = time.time()
+        with self.lock:
+            for node in self.nodes.values():
+                self._check(node, now)
+                self._reap(node, now)
+                while len(node.connections) < self.min_size:
+                    try:
+                        self._open(node)
+                    except socket.error:
+                        break
+
+    def _check(self, node, now):
+        "Close dead connections, ping the idle ones"
+        for conn in list(node.connections):
+            if conn.closed:
+                self._discard(node, conn)
+                continue
+            ping = node.pings.get(conn)
+            if ping is not None:
+                future, sent = ping
+                if future.done():
+                    del node.pings[conn]
+                    if future.exception() is not None:
+                        node.failed += 1
+                        self._discard(node, conn)
+                elif now - sent > self.health_timeout:
+                    log.warn('Node %s does not answer on %s',
+                             node.nodeid, node.address)
+                    node.failed += 1
+                    self._discard(node, conn)
+            elif not conn.waiting and now - conn.last > self.interval:
+                try:
+                    node.pings[conn] = (self.transport.ping(conn), now)
+                except IOError:
+                    self._discard(node, conn)
+
+    def _reap(self, node, now):
+        "Close the idle connections above min_size, oldest first"
+        idle = [conn for conn in node.connections
+                if not conn.waiting and conn not in node.pings and
+                now - conn.last > self.idle_timeout]
+        idle.sort(key=lambda conn: conn.last)
+        for conn in idle[:max(0, len(node.connections) - self.min_size)]:
+            self._discard(node, conn)
+            node.reaped += 1
+
+    def stats(self):
+        "Return the utilization metrics of every node pool"
+        with self.lock:
+            return dict((nodeid, node.stats(self.max_inflight))
+                        for nodeid, node in self.nodes.items())
+
+    def start(self):
+        "Run maintain() every interval seconds in a background thread"
+        self._thread = Thread(target=self._run, name='connpool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.maintain()
+            except Exception:
+                log.exception('Connection pool maintenance failed')
+
+    def stop(self):
+        "Stop maintenance and close all the connections"
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.interval * 2)
+        with self.lock:
+            for node in self.nodes.values():
+                for conn in list(node.connections):
+                    self._discard(node, conn)
+
+
+# End
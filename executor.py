@@ -0,0 +1,125 @@
+"""A bounded thread pool that runs tasks in order for each key.
+
+World uses it to dispatch events to workers: each worker has its own
+mailbox so a slow worker only delays its own events, while events for
+the same worker are still delivered one at a time in push order.
+"""
+import time
+from collections import deque
+from threading import Thread, Condition, Lock
+
+from swarmforce.loggers import getLogger
+
+log = getLogger('swarmforce')
+
+
+class KeyedExecutor(object):
+    """Run tasks on a bounded pool of threads.
+
+    Tasks submitted with the same key run sequentially in submission
+    order. A key is handled by one thread at a time, which takes up to
+    'batch' tasks from the key mailbox before giving others a chance.
+    """
+    def __init__(self, size=4, batch=16, name='executor'):
+        self.size = size
+        self.batch = batch
+        self.mailboxes = dict()
+        self.ready = deque()
+        self.lock = Lock()
+        self.cond = Condition(self.lock)  # tasks are ready
+        self.drained = Condition(self.lock)  # no tasks left
+        self.running = True
+        self.threads = list()
+        for i in xrange(size):
+            thread = Thread(target=self._run, name='%s-%s' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        "Queue func(*args) to be run after the previous tasks of key"
+        with self.cond:
+            if not self.running:
+                raise RuntimeError('%s is shut down' % self)
+            mailbox = self.mailboxes.get(key)
+            if mailbox is None:
+                mailbox = self.mailboxes[key] = deque()
+                self.ready.append(key)
+                self.cond.notify()
+            mailbox.append((func, args))
+
+    def _run(self):
+        "Thread loop: take a ready key and run a batch of its tasks"
+        cond = self.cond
+        while True:
+            with cond:
+                while not self.ready and self.running:
+                    cond.wait()
+                if not self.ready:
+                    return
+                key = self.ready.popleft()
+                mailbox = self.mailboxes[key]
+
+            # only this thread takes tasks of key, so tasks are counted
+            # by depth() until they start
+            for _ in xrange(self.batch):
+                try:
+                    func, args = mailbox.popleft()
+                except IndexError:
+                    break
+                try:
+                    func(*args)
+                except Exception:
+                    log.exception('Task %s failed for %s', func, key)
+
+            with cond:
+                if mailbox:
+                    self.ready.append(key)
+                    cond.notify()
+                else:
+                    del self.mailboxes[key]
+                    if not self.mailboxes:
+                        self.drained.notify_all()
+
+    def depth(self, key):
+        "Return the number of tasks waiting for key"
+        with self.cond:
+            return len(self.mailboxes.get(key, ()))
+
+    def depths(self):
+        "Return the number of waiting tasks of every busy key"
+        with self.cond:
+            return dict((key, len(mailbox))
+                        for (key, mailbox) in self.mailboxes.items())
+
+    def idle(self):
+        "True when there are no waiting or running tasks"
+        return not self.mailboxes
+
+    def join(self, timeout=None):
+        "Wait until all submitted tasks are done. Return True if idle"
+        if timeout is not None:
+            end = time.time() + timeout
+        with self.lock:
+            while self.mailboxes:
+                if timeout is None:
+                    self.drained.wait()
+                else:
+                    remain = end - time.time()
+                    if remain <= 0:
+                        break
+                    self.drained.wait(remain)
+            return not self.mailboxes
+
+    def shutdown(self, timeout=None):
+        "Drain submitted tasks and stop the threads"
+        drained = self.join(timeout)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        return drained
+
+
+# End
@@ -2,6 +2,7 @@
 import re
 import types
 import time
+import codecs
 from io import StringIO
 from random import choice
 from swarmforce.misc import random_path, random_token, hasher
@@ -10,6 +11,8 @@ from swarmforce.loggers import getLogger
 log = getLogger('swarmforce')
 
 CODE_OK = '200'
+CODE_UNAVAILABLE = '503'
+CODE_TIMEOUT = '504'
 
 X_CLIENT = 'X-Client-Id'
 X_REQ_ID = 'X-Request-Id'
@@ -17,6 +20,115 @@ X_TIME = 'X-Time'
 X_HASH = 'X-Hash'
 X_TIMEOUT = 'X-Timeout'
 X_REMAIN_EXECUTIONS = 'X-Remain-Executions'
+X_PRIORITY = 'X-Priority'
+
+
+STATUS_FIELDS = frozenset(['method', 'path', 'http-version',
+                           'body', 'code', 'result'])
+CONTENT_LENGTH = 'Content-Length'
+
+
+def to_bytes(value):
+    "Encode a header value or body as utf-8 bytes"
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return '%s' % value
+
+
+class Serializer(object):
+    """Serialization engine for events.
+
+    The header ordering of each distinct set of keys is computed once
+    and cached. Three forms are available:
+
+    - canonical(): bytes used for hashing. Same text as dump() but
+      without modifying the event.
+    - wire(): bytes for transport. CRLF line ends, a blank line always
+      ends the headers and Content-Length counts body bytes.
+    - dump(): the text form of Event.dump(), kept for compatibility.
+    """
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self.orders = dict()
+
+    def order(self, event, exclude=frozenset(), length=False):
+        """Return the sorted header names of event and the position
+        of Content-Length, that is added when length is True"""
+        key = (frozenset(event.keys()), exclude, length)
+        order = self.orders.get(key)
+        if order is None:
+            if len(self.orders) >= self.cache_size:
+                self.orders.clear()
+            names = set(key[0] - STATUS_FIELDS - exclude)
+            if length:
+                names.add(CONTENT_LENGTH)
+            names = sorted(names)
+            if CONTENT_LENGTH in names:
+                position = names.index(CONTENT_LENGTH) + 1
+            else:
+                position = None
+            order = self.orders[key] = (tuple(names), position)
+        return order
+
+    def _head(self, event, exclude, eol, length):
+        "Return the statusline and headers as utf-8 bytes"
+        names, position = self.order(event, exclude, length is not None)
+        get = event.get
+        lines = ['%s: %s' % (name, get(name)) for name in names]
+        lines.insert(0, event.statusline_fmt % event)
+        if length is not None:
+            lines[position] = '%s: %s' % (CONTENT_LENGTH, length)
+        return to_bytes(eol.join(lines))
+
+    def canonical(self, event, exclude_headers=(X_HASH, )):
+        "Return the canonical bytes of event used for hashing"
+        body = dict.get(event, 'body')
+        if body:
+            body = to_bytes(body)
+            head = self._head(event, frozenset(exclude_headers),
+                              '\n', len(body))
+            return '%s\n\n%s' % (head, body)
+        return self._head(event, frozenset(exclude_headers), '\n', None)
+
+    def wire(self, event):
+        "Return the bytes of event to be sent to other nodes"
+        return str(self.write(event, bytearray()))
+
+    def write(self, event, buf):
+        "Append the wire form of event to a bytearray"
+        body = dict.get(event, 'body')
+        if body:
+            body = to_bytes(body)
+            buf.extend(self._head(event, frozenset(), '\r\n', len(body)))
+            buf.extend('\r\n\r\n')
+            buf.extend(body)
+        else:
+            length = 0 if CONTENT_LENGTH in event else None
+            buf.extend(self._head(event, frozenset(), '\r\n', length))
+            buf.extend('\r\n\r\n')
+        return buf
+
+    def dump(self, event, exclude_headers=None, lines=None):
+        "Return the same text than the former Event.dump()"
+        if lines is None:
+            lines = []
+
+        lines.append(event.statusline_fmt % event)
+        names, _ = self.order(event, frozenset(exclude_headers or ()))
+        for name in names:
+            lines.append('%s: %s' % (name, event[name]))
+
+        body = event.body
+        if body:
+            lines.append('')
+            lines.append(body)
+
+        return '\n'.join(lines)
+
+
+SERIALIZER = Serializer()
 
 
 class Event(dict):
@@ -32,50 +144,49 @@ class Event(dict):
         dict.__init__(self, *args, **kw)
 
     def dump(self, exclude_headers=None, lines=None):
-        """Dump HTTP message into a Stream"""
-        if lines is None:
-            lines = []
-
-        lines.append(self.statusline_fmt % self)
-
-        excluded = set(['method', 'path', 'http-version',
-                        'body', 'code', 'result'])
-        if exclude_headers:
-            excluded.update(exclude_headers)
-
+        """Dump HTTP message into a Stream.
+        Content-Length is updated to match the utf-8 encoded body
+        as a side effect."""
         body = self.body
         if body:
-            self['Content-Length'] = len(body)
+            self[CONTENT_LENGTH] = len(to_bytes(body))
 
-        keys = list(excluded.symmetric_difference(self.keys()))
-        keys.sort()
+        return SERIALIZER.dump(self, exclude_headers, lines)
 
-        for key in keys:
-            if key in self:
-                value = self[key]
-                line = '%s: %s' % (key, value)
-                lines.append(line)
-
-        body = self.body
-        if body:
-            lines.append('')
-            lines.append(body)
-
-        return '\n'.join(lines)
+    def footprint(self):
+        """Return the canonical form of the message used for hashing.
+        It is cached until a header that counts for the hash changes."""
+        footprint = self.__dict__.get('_footprint')
+        if footprint is None:
+            footprint = SERIALIZER.canonical(self)
+            self.__dict__['_footprint'] = footprint
+        return footprint
 
     def hash(self, exclude_headers=None, inplace=True):
         """Get the hash of the message, skiping some headers"""
         if exclude_headers:
             exclude_headers.append(X_HASH)
+            hash_ = hasher(SERIALIZER.canonical(self, exclude_headers))
         else:
-            exclude_headers = [X_HASH]
+            hash_ = self.__dict__.get('_digest')
+            if hash_ is None:
+                hash_ = hasher(self.footprint())
+                self.__dict__['_digest'] = hash_
 
-        footprint = self.dump(exclude_headers)
-        hash_ = hasher(footprint)
         if inplace:
             self[X_HASH] = hash_
         return hash_
 
+    def copy(self):
+        """Return a copy of the message with the same class and headers,
+        sharing only the cached hash"""
+        msg = self.__class__.__new__(self.__class__)
+        dict.update(msg, self)
+        for key in ('_footprint', '_digest'):
+            if key in self.__dict__:
+                msg.__dict__[key] = self.__dict__[key]
+        return msg
+
     def sane(self):
         "Check event sanity"
         hash_1 = self.get(X_HASH)
@@ -103,6 +214,43 @@ class Event(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+    # dirty tracking of the cached footprint and hash
+    def _invalidate(self, key=None):
+        "Drop cached footprint and hash when key counts for the hash"
+        if key != X_HASH:
+            self.__dict__.pop('_footprint', None)
+            self.__dict__.pop('_digest', None)
+
+    def __setitem__(self, key, value):
+        if key not in self or dict.__getitem__(self, key) != value:
+            self._invalidate(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._invalidate(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._invalidate(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._invalidate()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._invalidate(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kw):
+        self._invalidate()
+        dict.update(self, *args, **kw)
+
+    def clear(self):
+        self._invalidate()
+        dict.clear(self)
+
 
 class Request(Event):
     """A request HTTP style class."""
@@ -139,6 +287,164 @@ class Response(Event):
         "Return a hashable object that identify this message"
         return (self['code'], self[X_TIME], )
 
+
+class HeaderSet(object):
+    """The sorted header names shared by all packed events that have
+    the same headers, with the position of each name."""
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names):
+        self.names = names
+        self.index = dict((name, i) for (i, name) in enumerate(names))
+
+
+HEADER_SETS = dict()
+MAX_HEADER_SETS = 4096
+
+# status line fields stored in PackedEvent slots
+SLOTS = (('method', 'method'), ('path', 'path'),
+         ('http-version', 'version'), ('code', 'code'),
+         ('result', 'result'), ('body', 'body'))
+SLOT_OF = dict(SLOTS)
+
+
+ascii_encode = codecs.lookup('ascii').encode
+
+
+def compact_text(value):
+    """Return ASCII unicode values as str, that need 4 times less memory
+    and are equal to the unicode value"""
+    if value.__class__ is unicode:
+        try:
+            return ascii_encode(value)[0]
+        except UnicodeError:
+            pass
+    return value
+
+
+class PackedEvent(object):
+    """A compact, read only form of a Request or Response.
+
+    Status line fields live in fixed slots and header values in a tuple
+    (data) that follows the names of a shared HeaderSet, so a packed event
+    needs a fraction of the memory of an Event dict. ASCII text values
+    are kept as str. It can be read as a dict and unpack() returns an
+    equivalent mutable Event.
+    """
+    __slots__ = ('kind', 'method', 'path', 'version', 'code', 'result',
+                 'body', 'headers', 'data', 'digest')
+
+    def __init__(self, event):
+        get = event.get
+        self.kind = event.__class__
+        self.method = get('method')
+        self.path = get('path')
+        self.version = get('http-version')
+        self.code = get('code')
+        self.result = get('result')
+        self.body = compact_text(get('body'))
+        self.digest = event.__dict__.get('_digest')
+
+        names = SERIALIZER.order(event)[0]
+        headers = HEADER_SETS.get(names)
+        if headers is None:
+            headers = HeaderSet(names)
+            if len(HEADER_SETS) < MAX_HEADER_SETS:
+                HEADER_SETS[names] = headers
+        self.headers = headers
+        self.data = tuple(map(compact_text, map(event.__getitem__, names)))
+
+    def unpack(self):
+        "Return a mutable Event with the same content"
+        msg = self.kind.__new__(self.kind)
+        dict.__init__(msg, zip(self.headers.names, self.data))
+        for key, slot in SLOTS:
+            value = getattr(self, slot)
+            if value is not None:
+                dict.__setitem__(msg, key, value)
+        if self.digest is not None:
+            msg.__dict__['_digest'] = self.digest
+        return msg
+
+    # dict like read access
+    def __getitem__(self, key):
+        slot = SLOT_OF.get(key)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is not None:
+                return value
+        else:
+            i = self.headers.index.get(key)
+            if i is not None:
+                return self.data[i]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        keys = [key for (key, slot) in SLOTS
+                if getattr(self, slot) is not None]
+        keys.extend(self.headers.names)
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    @property
+    def statusline(self):
+        "Same as Event.statusline"
+        return '%s %s' % (self.method, self.path)
+
+    @property
+    def key(self):
+        "Same as Request.key or Response.key"
+        if issubclass(self.kind, Request):
+            return self.digest or self[X_HASH]
+        return (self.code, self[X_TIME], )
+
+    def dump(self, *args, **kw):
+        "Same as Event.dump"
+        return self.unpack().dump(*args, **kw)
+
+
+def pack(event):
+    "Return the compact form of an event"
+    if isinstance(event, PackedEvent):
+        return event
+    return PackedEvent(event)
+
 RE_HEADER = re.compile(r"(?P<name>.*?): (?P<value>.*)",
                        re.DOTALL | re.I)
 
@@ -154,21 +460,25 @@ PARSE_MAP[RE_REQ] = Request
 PARSE_MAP[RE_RES] = Response
 
 
+def new_message(statusline):
+    """Create an empty Request or Response from its statusline."""
+    for _re, klass in PARSE_MAP.items():
+        match = _re.match(statusline)
+        if match:
+            match = match.groupdict()
+            match['http-version'] = match.pop('http_version')
+            return klass(**match)
+
+    raise RuntimeError('Unknown message type: %s' % statusline)
+
+
 def parse(stream):
     """Parse HTTP message from stream."""
     if isinstance(stream, types.StringTypes):
         stream = StringIO(unicode(stream))
 
     statusline = stream.readline().strip()
-    for _re, klass in PARSE_MAP.items():
-        match = _re.match(statusline)
-        if match:
-            match = match.groupdict()
-            match['http-version'] = match.pop('http_version')
-            msg = klass(**match)
-            break
-    else:
-        raise RuntimeError('Unknown message type: %s' % statusline)
+    msg = new_message(statusline)
 
     line = stream.readline().strip()
     while line:
@@ -184,11 +494,125 @@ def parse(stream):
     msg['body'] = body = stream.read()
     length = int(msg.get('Content-Length', 0))
 
-    assert not length or len(body) == length
+    assert not length or len(to_bytes(body)) == length
+
+    return msg
+
 
+def find_head_end(buf, start=0):
+    """Find the blank line that ends the headers of the message that
+    begins at start. Work with str, bytearray and mmap buffers.
+    Return the position and length of the separator or (-1, 0)"""
+    crlf = buf.find('\r\n\r\n', start)
+    if crlf >= 0:
+        end = buf.find('\n\n', start, crlf)
+    else:
+        end = buf.find('\n\n', start)
+    if end >= 0:
+        return end, 2
+    if crlf >= 0:
+        return crlf, 4
+    return -1, 0
+
+
+def parse_head(head):
+    "Parse the statusline and headers of a message without its body"
+    lines = head.decode('utf-8').split('\n')
+    msg = new_message(lines[0].strip())
+    headers = dict()
+    for line in lines[1:]:
+        name, sep, value = line.strip().partition(': ')
+        if not sep:
+            raise RuntimeError('Error parsing HTTP header: %s' % line)
+        headers[name] = value
+    dict.update(msg, headers)
     return msg
 
 
+class StreamParser(object):
+    """Incremental parser of HTTP messages.
+
+    Feed it with chunks of bytes as they arrive from a socket or a pipe
+    and it returns every Request or Response completed so far. Several
+    pipelined messages may come in a single chunk, and a message may be
+    split across many chunks. Incomplete data is kept in an internal
+    buffer that is only compacted once most of it has been consumed.
+
+    The headers end at the first blank line and the body is exactly
+    Content-Length bytes long (no body when it is missing).
+    """
+    def __init__(self, max_header=65536):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.max_header = max_header
+        self._head = None  # parsed headers waiting for their body
+
+    def feed(self, data):
+        "Add a chunk of bytes and return the list of completed messages"
+        self.buffer += data
+        messages = list()
+        msg = self._next()
+        while msg is not None:
+            messages.append(msg)
+            msg = self._next()
+
+        # compact the buffer once most of it has been consumed
+        offset = self.offset
+        if offset and offset * 2 >= len(self.buffer):
+            del self.buffer[:offset]
+            self.offset = 0
+            if self._head is not None:
+                msg, start, length = self._head
+                self._head = (msg, start - offset, length)
+        return messages
+
+    def close(self):
+        """Return the last message when the stream is closed before
+        its blank line, as the former dump() format does."""
+        messages = list()
+        if self._head is None and self.pending():
+            messages = self.feed('\r\n\r\n')
+        if self._head is not None or self.pending():
+            raise RuntimeError('Truncated HTTP message: %s bytes left'
+                               % self.pending())
+        return messages
+
+    def pending(self):
+        "Return the number of bytes of incomplete messages"
+        return len(self.buffer) - self.offset
+
+    def _next(self):
+        "Parse next message from buffer or return None"
+        buf = self.buffer
+        if self._head is None:
+            start = self.offset
+            size = len(buf)
+            while start < size and buf[start] in (10, 13):
+                start += 1  # skip blank lines between messages
+            self.offset = start
+
+            end, sep = find_head_end(buf, start)
+            if end < 0:
+                if size - start > self.max_header:
+                    raise RuntimeError('HTTP headers too long')
+                return None
+
+            msg = parse_head(buf[start:end])
+            length = int(msg.get(CONTENT_LENGTH, 0))
+            self._head = (msg, end + sep, length)
+
+        msg, start, length = self._head
+        if len(buf) - start < length:
+            return None
+
+        self._head = None
+        self.offset = start + length
+        if length:
+            dict.__setitem__(msg, 'body',
+                             buf[start:self.offset].decode('utf-8'))
+        return msg
+
+
 def populate(msg):
     """Populate the message using random data"""
     msg.method = choice(['GET', 'POST'])
@@ -200,7 +624,7 @@ def populate(msg):
 
     msg['User-Agent'] = choice(['HTTPTool/1.0', 'Mozilla/5.0'])
     msg.body = body = random_token(200)
-    msg['Content-Length'] = len(body)
+    msg['Content-Length'] = len(to_bytes(body))
 
 
 # End
@@ -0,0 +1,319 @@
+"""Durable inboxes stored as segmented append-only logs.
+
+An InboxLog keeps the events of an inbox directory in a few large
+segment files instead of one file per event. Segments are archives of
+messages in wire form (see archive.py) named after the log offset of
+their first byte, so the offset of any event is its segment name plus
+its position in the segment. A new segment is started when the active
+one grows beyond segment_size.
+
+Writes are made durable by group commit: append() writes the event to
+the active segment and then waits for a fsync covering it. The first
+writer in sync() does a single fsync for all the events written so far
+and the writers arriving meanwhile find their events already synced.
+commit_delay seconds may be spent before the fsync to gather more of
+them.
+
+Consumers read the segments through mmap and checkpoint the offset of
+the next event to process in a '<name>.offset' file, updated with an
+atomic rename. compact() removes the segments that every consumer has
+already processed.
+
+A log is written by a single process, but may be read from others.
+"""
+import os
+import time
+import mmap
+from bisect import bisect_right
+from threading import Lock
+
+from swarmforce.loggers import getLogger
+from swarmforce.http import SERIALIZER, CONTENT_LENGTH, \
+     find_head_end, parse_head
+from swarmforce.archive import Archive, Record
+
+log = getLogger('swarmforce')
+
+SEGMENT_EXT = '.log'
+SEGMENT_FMT = '%020d' + SEGMENT_EXT
+OFFSET_EXT = '.offset'
+
+
+def segment_bases(root):
+    "Return the sorted base offsets of the segments found in root"
+    return sorted(int(name[:-len(SEGMENT_EXT)]) for name in os.listdir(root)
+                  if name.endswith(SEGMENT_EXT) and name[:-4].isdigit())
+
+
+def is_log(root):
+    "True if the directory holds log segments"
+    return os.path.isdir(root) and bool(segment_bases(root))
+
+
+class Segment(Archive):
+    """A segment of the log mapped for reading.
+
+    Unlike Archive, a message still being written at the end of the
+    segment is not returned, and the mapping is extended with refresh()
+    as the segment grows.
+    """
+    def __init__(self, path, base):
+        Archive.__init__(self, path)
+        self.base = base
+
+    def refresh(self):
+        "Map the data appended since the segment was opened"
+        size = os.fstat(self.file.fileno()).st_size
+        if size <= self.size:
+            return False
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+        return True
+
+    def read(self, offset):
+        "Return the Record of the complete message at offset or None"
+        data = self.data
+        size = self.size
+        while offset < size and data[offset] in '\r\n':
+            offset += 1  # skip blank lines between messages
+        if offset >= size:
+            return None
+        end, sep = find_head_end(data, offset)
+        if end < 0:
+            return None
+        headers = parse_head(data[offset:end])
+        length = int(headers.get(CONTENT_LENGTH, 0))
+        body_offset = end + sep
+        if body_offset + length > size:
+            return None
+        return Record(self, offset, body_offset, length, headers)
+
+
+class InboxLog(object):
+    """A segmented append-only log of events rooted at a directory."""
+    def __init__(self, root, segment_size=1 << 26, commit_delay=0.0,
+                 readonly=False):
+        self.root = root
+        self.segment_size = segment_size
+        self.commit_delay = commit_delay
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+        self.lock = Lock()  # writes and segment rotation
+        self.sync_lock = Lock()  # a single fsync at a time
+        self.segments = dict()  # base -> Segment opened for reading
+        self.retired = list()  # fds of full segments not closed yet
+        self.fd = None
+        self.base = self.head = self.synced = 0
+        self.syncs = 0
+        self.readonly = readonly  # readers in other processes
+
+        self.bases = segment_bases(root)
+        if readonly:
+            return
+        if self.bases:
+            self._recover(self.bases[-1])
+        else:
+            self._open_segment(0)
+            self.bases = [0]
+
+    def path(self, base):
+        return os.path.join(self.root, SEGMENT_FMT % base)
+
+    def _open_segment(self, base):
+        self.fd = os.open(self.path(base),
+                          os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.base = base
+        self.head = base + os.fstat(self.fd).st_size
+        self.synced = self.head
+
+    def _recover(self, base):
+        "Truncate a message left half written by a crash"
+        segment = Segment(self.path(base), base)
+        offset = 0
+        for record in segment:
+            offset = record.end
+        size = segment.size
+        segment.close()
+        if offset < size:
+            log.warn('Truncating %s bytes at the end of %s',
+                     size - offset, self.path(base))
+            with open(self.path(base), 'r+b') as f:
+                f.truncate(offset)
+        self._open_segment(base)
+
+    # writer side
+    def append(self, event, sync=True):
+        "Write an event to the log, return its offset"
+        buf = SERIALIZER.write(event, bytearray())
+        offset = self._write(buf)
+        if sync:
+            self.sync(offset + len(buf))
+        return offset
+
+    def extend(self, events, sync=True):
+        "Write many events to the log, return the offset after them"
+        buf = bytearray()
+        for event in events:
+            SERIALIZER.write(event, buf)
+        end = self._write(buf) + len(buf)
+        if sync:
+            self.sync(end)
+        return end
+
+    def _write(self, buf):
+        with self.lock:
+            if self.head > self.base and \
+               self.head - self.base + len(buf) > self.segment_size:
+                self._rotate()
+            offset = self.head
+            os.write(self.fd, buf)
+            self.head += len(buf)
+            return offset
+
+    def _rotate(self):
+        "Seal the active segment and start a new one. Called with lock"
+        os.fsync(self.fd)
+        self.retired.append(self.fd)
+        self._open_segment(self.head)
+        self.bases.append(self.base)
+
+    def sync(self, end=None):
+        """Make the log durable up to end (all of it by default).
+        Concurrent callers share the same fsync."""
+        with self.sync_lock:
+            if end is not None and self.synced >= end:
+                return
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self.lock:
+                head, fd = self.head, self.fd
+                retired, self.retired = self.retired, list()
+            os.fsync(fd)
+            for old in retired:
+                os.close(old)  # synced when rotated
+            self.synced = max(self.synced, head)
+            self.syncs += 1
+
+    # reader side
+    def _segment(self, base):
+        segment = self.segments.get(base)
+        if segment is None:
+            segment = self.segments[base] = Segment(self.path(base), base)
+        return segment
+
+    def read(self, offset):
+        "Return the Record at log offset or None if there is none yet"
+        record = self._read(offset)
+        if record is None:
+            self.bases = segment_bases(self.root)  # maybe a new segment
+            record = self._read(offset)
+        return record
+
+    def _read(self, offset):
+        bases = self.bases
+        if not bases:
+            return None
+        # the end of a segment is the base of the next one
+        segment = self._segment(bases[max(0, bisect_right(bases, offset) - 1)])
+        pos = max(0, offset - segment.base)  # compacted offsets
+        record = segment.read(pos)
+        if record is None and segment.refresh():
+            record = segment.read(pos)
+        return record
+
+    def scan(self, offset=0, limit=None):
+        """Return the list of (offset, event) stored from offset on,
+        and the offset following the last of them"""
+        result = list()
+        record = self.read(offset)
+        while record is not None and (limit is None or len(result) < limit):
+            offset = record.archive.base + record.offset
+            result.append((offset, record.event))
+            offset = record.archive.base + record.end
+            record = self.read(offset)
+        return result, offset
+
+    def consumer(self, name):
+        return Consumer(self, name)
+
+    def checkpoints(self):
+        "Return the committed offsets of all the consumers"
+        result = dict()
+        for name in os.listdir(self.root):
+            if name.endswith(OFFSET_EXT):
+                result[name[:-len(OFFSET_EXT)]] = \
+                    Consumer(self, name[:-len(OFFSET_EXT)]).offset
+        return result
+
+    def compact(self):
+        """Remove the sealed segments already processed by every
+        consumer. Return the number of segments removed"""
+        offsets = self.checkpoints().values()
+        if not offsets:
+            return 0
+        low = min(offsets)
+        bases = segment_bases(self.root)
+        removed = 0
+        for base, following in zip(bases, bases[1:]):
+            if following > low:
+                break
+            segment = self.segments.pop(base, None)
+            if segment is not None:
+                segment.close()
+            os.unlink(self.path(base))
+            removed += 1
+        self.bases = segment_bases(self.root)
+        return removed
+
+    def close(self):
+        if not self.readonly:
+            self.sync()
+            os.close(self.fd)
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+
+class Consumer(object):
+    """A named reader of an InboxLog that checkpoints its offset."""
+    def __init__(self, log_, name):
+        self.log = log_
+        self.name = name
+        self.path = os.path.join(log_.root, name + OFFSET_EXT)
+        self.offset = 0  # next event to process
+        if os.path.exists(self.path):
+            self.offset = int(file(self.path, 'rt').read().strip() or 0)
+        self.position = self.offset  # next event to read
+
+    def poll(self, limit=None):
+        "Return the events written after the last one polled"
+        result, self.position = self.log.scan(self.position, limit)
+        return [event for _, event in result]
+
+    def commit(self, offset=None, sync=False):
+        """Checkpoint offset, by default the position after the events
+        polled so far"""
+        if offset is None:
+            offset = self.position
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wt') as f:
+            f.write('%d\n' % offset)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.offset = offset
+
+    def rewind(self):
+        "Read again the events polled but not committed"
+        self.position = self.offset
+
+    def lag(self):
+        "Bytes written to the log and not committed yet"
+        return self.log.head - self.offset
+
+
+# End
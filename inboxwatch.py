@@ -0,0 +1,217 @@
+"""Feed the message files dropped in inbox folders into a World.
+
+An InboxFeeder is told about new files by filesystem notifications (see
+cli/monitor.py FileSystemMonitor) instead of polling the folders.
+Notifications are coalesced: the first one wakes up the feeder thread,
+which waits up to 'linger' seconds for more of them, or until
+batch_size files are pending, and then reads all the files, pushes
+their events into the World and removes them.
+
+A file may hold one or more messages in wire form. A file whose last
+message is not complete yet is left alone until the next notification
+about it. scan() notifies every file already present, to catch the
+ones dropped while nobody was watching.
+
+Several feeders may watch the same folder: each file is claimed by an
+atomic rename before being read, so only one of them consumes it. A
+file is removed once the World has accepted all its messages; the ones
+refused are written back and retried later. A file that can not be
+parsed is moved into the 'quarantine' folder of its inbox.
+"""
+import os
+import time
+from collections import OrderedDict
+from threading import Thread, Condition
+
+from swarmforce.loggers import getLogger
+from swarmforce.http import SERIALIZER
+from swarmforce.inboxlog import Segment, SEGMENT_EXT, OFFSET_EXT
+
+log = getLogger('swarmforce')
+
+CLAIMED_EXT = '.claimed'
+IGNORED_EXT = ('.tmp', '.pid', CLAIMED_EXT, SEGMENT_EXT, OFFSET_EXT)
+
+
+def is_message_file(path):
+    "Ignore hidden and temporary files, and the files of an InboxLog"
+    name = os.path.basename(path)
+    return not name.startswith('.') and not name.endswith(IGNORED_EXT)
+
+
+def read_messages(path):
+    """Return the events stored in the file at path, or None when the
+    file is empty or its last message is still being written"""
+    try:
+        segment = Segment(path, 0)
+    except (IOError, OSError):
+        return None  # already consumed or moved away
+    try:
+        events = list()
+        end = 0
+        for record in segment:
+            events.append(record.event)
+            end = record.end
+        if not events or segment.data[end:].strip():
+            return None
+        return events
+    finally:
+        segment.close()
+
+
+class InboxFeeder(Thread):
+    """Push the messages of the files notified into world, in batches."""
+    def __init__(self, world, paths, batch_size=256, linger=0.005,
+                 name='inbox'):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.world = world
+        self.paths = paths  # the folders to scan on start
+        self.batch_size = batch_size
+        self.linger = linger  # seconds to wait for more notifications
+        self.retry = 0.1  # seconds to wait when the world refuses events
+        self.quarantine = 'quarantine'  # folder of bad files in an inbox
+        self.pending = OrderedDict()  # path -> time of first notification
+        self.cond = Condition()
+        self.running = False
+        self.batches = self.files = self.events = 0
+        self.refused = self.bad = 0
+        self.latency = 0.0  # max seconds from notification to push
+
+    def notify(self, path):
+        "A file was created, modified or moved into an inbox"
+        if not is_message_file(path):
+            return
+        with self.cond:
+            if path not in self.pending:
+                self.pending[path] = time.time()
+                if len(self.pending) == 1 or \
+                   len(self.pending) >= self.batch_size:
+                    self.cond.notify()
+
+    def scan(self):
+        "Notify the files already in the inbox folders"
+        for root in self.paths:
+            if os.path.isdir(root):
+                for name in sorted(os.listdir(root)):
+                    path = os.path.join(root, name)
+                    if os.path.isfile(path):
+                        self.notify(path)
+
+    def start(self):
+        self.running = True
+        Thread.start(self)
+        self.scan()
+
+    def stop(self, timeout=5):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.join(timeout)
+
+    def run(self):
+        while self.running:
+            try:
+                batch = self._next_batch()
+                if batch and not self._feed(batch):
+                    with self.cond:  # the world is full, let it drain
+                        if self.running:
+                            self.cond.wait(self.retry)
+            except Exception:
+                log.exception('Inbox feeder %s failed', self.name)
+
+    def _next_batch(self):
+        "Wait for notifications and return a coalesced batch of them"
+        cond = self.cond
+        with cond:
+            while not self.pending and self.running:
+                cond.wait(3600)  # a timeout keeps the wait interruptible
+            end = time.time() + self.linger
+            while self.running and len(self.pending) < self.batch_size:
+                left = end - time.time()
+                if left <= 0:
+                    break
+                cond.wait(left)
+            batch = list()
+            while self.pending and len(batch) < self.batch_size:
+                batch.append(self.pending.popitem(last=False))
+            return batch
+
+    def _feed(self, batch):
+        """Push the messages of a batch of files. Return False when the
+        world refuses them, leaving the rest of the batch for later"""
+        now = time.time()
+        for i, (path, notified) in enumerate(batch):
+            try:
+                accepted = self._feed_file(path, notified, now)
+            except Exception:
+                log.exception('Bad inbox file %s', path)
+                self._put_aside(path)
+                continue
+            if not accepted:
+                self.refused += 1
+                with self.cond:
+                    for path, notified in batch[i:]:
+                        self.pending.setdefault(path, notified)
+                self.batches += 1
+                return False
+        self.batches += 1
+        return True
+
+    def _feed_file(self, path, notified, now):
+        """Claim a file, push its messages and remove it.
+        Return False if the world does not accept all of them"""
+        if not os.path.isfile(path):
+            return True
+        claimed = path + CLAIMED_EXT
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return True  # consumed by another feeder
+        events = read_messages(claimed)
+        if events is None:
+            os.rename(claimed, path)  # a later notification brings it back
+            return True
+        push = self.world.try_push  # refused events are retried, not answered
+        for i, event in enumerate(events):
+            if not push(event):
+                self._restore(claimed, path, events[i:])
+                self.events += i
+                return False
+        try:
+            os.unlink(claimed)
+        except OSError, why:
+            log.warn('Can not remove %s: %s', claimed, why)
+        self.files += 1
+        self.events += len(events)
+        self.latency = max(self.latency, now - notified)
+        return True
+
+    def _restore(self, claimed, path, events):
+        "Write back the events not accepted yet, to feed them later"
+        buf = bytearray()
+        for event in events:
+            SERIALIZER.write(event, buf)
+        tmp = claimed + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(buf)
+        os.rename(tmp, path)
+        os.unlink(claimed)
+
+    def _put_aside(self, path):
+        "Move a file that can not be fed into the quarantine folder"
+        folder = os.path.join(os.path.dirname(path), self.quarantine)
+        name = os.path.basename(path)
+        self.bad += 1
+        try:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            for source in (path + CLAIMED_EXT, path):
+                if os.path.exists(source):
+                    os.rename(source, os.path.join(folder, name))
+                    break
+        except OSError, why:
+            log.error('Can not quarantine %s: %s', path, why)
+
+
+# End
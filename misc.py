@@ -5,7 +5,11 @@ import hashlib
 
 import sys
 import time
+import fcntl
+import select
 from random import choice, randint
+from threading import Lock
+
 alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWYZ0123456789_'
 
 # -----------------------------------------
@@ -61,6 +65,73 @@ def until(condition, timeout=5):
             'Timeout (%s) while waiting for condition %s' % \
         (timeout, condition))
 
+# -----------------------------------------
+# Threading convenience functions
+# -----------------------------------------
+class Waker(object):
+    """A self-pipe that let any thread wake up a loop sleeping in wait().
+
+    Unlike threading.Event, wait() sleeps in select() so the timeout
+    is handled by the kernel and wake() is noticed immediately.
+    """
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        for fd in (self._read, self._write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.signaled = False
+        self.closed = False
+        self._lock = Lock()  # no write after close() to a reused fd
+
+    def fileno(self):
+        "Allow to select() on the waker along other file descriptors"
+        return self._read
+
+    def wake(self):
+        "Wake up the sleeping loop. Several calls are coalesced"
+        if self.signaled or self.closed:
+            return
+        with self._lock:
+            if self.closed:
+                return
+            self.signaled = True
+            try:
+                os.write(self._write, 'x')
+            except OSError:
+                pass  # pipe is full, loop is going to wake anyway
+
+    def clear(self):
+        """Reset the signal. Must be called before checking the
+        condition the loop is waiting for to avoid lost wake ups"""
+        self.signaled = False
+        if self.closed:
+            return
+        try:
+            while os.read(self._read, 4096):
+                pass
+        except OSError:
+            pass
+
+    def wait(self, timeout=None):
+        "Sleep until wake() is called or timeout. Return True if awaken"
+        if timeout is not None and timeout < 0:
+            timeout = 0
+        if self.closed:
+            return False
+        try:
+            ready, _, _ = select.select([self._read], [], [], timeout)
+        except (select.error, ValueError):
+            return self.signaled
+        return bool(ready)
+
+    def close(self):
+        "Release the pipe"
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                os.close(self._read)
+                os.close(self._write)
+
 # -----------------------------------------
 # Some convenience functions
 # -----------------------------------------
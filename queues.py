@@ -0,0 +1,311 @@
+"""Event queues used by the World run loop"""
+
+import time
+import heapq
+from collections import deque
+from itertools import count
+from threading import Lock, Condition
+
+from swarmforce.http import X_CLIENT, X_PRIORITY
+
+# overflow policies of a bounded queue
+BLOCK = 'block'
+REJECT = 'reject'
+DROP_OLDEST = 'drop-oldest'
+
+# X-Priority of events without it. Lower values are served first
+DEFAULT_PRIORITY = 5
+
+
+class RunQueue(object):
+    """A FIFO queue of events with O(1) push and pop.
+
+    Many producer threads may call append() at the same time, while
+    a single consumer (the World loop) takes events with pop() or
+    with drain() to process a whole batch in one loop iteration.
+
+    append() ignores maxlen. Producers that must respect it use put()
+    to wait for room, offer() to fail or append_drop() to discard the
+    oldest event. The high-water mark is the largest size reached.
+    """
+    def __init__(self, maxlen=None):
+        self._queue = deque()
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self.maxlen = maxlen
+        self.high = 0
+
+    def append(self, event):
+        "Add an event at the end of the queue"
+        with self._lock:
+            self._queue.append(event)
+            if len(self._queue) > self.high:
+                self.high = len(self._queue)
+
+    def _full(self):
+        return self.maxlen is not None and len(self._queue) >= self.maxlen
+
+    def offer(self, event):
+        "Add an event if there is room. Return False when full"
+        with self._lock:
+            if self._full():
+                return False
+            self._queue.append(event)
+            if len(self._queue) > self.high:
+                self.high = len(self._queue)
+            return True
+
+    def put(self, event, timeout=None):
+        """Add an event waiting until there is room.
+        Return False if there is still no room after timeout"""
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._lock:
+            while self._full():
+                if timeout is None:
+                    self._not_full.wait()
+                else:
+                    remain = end - time.time()
+                    if remain <= 0:
+                        return False
+                    self._not_full.wait(remain)
+            self._queue.append(event)
+            if len(self._queue) > self.high:
+                self.high = len(self._queue)
+            return True
+
+    def append_drop(self, event):
+        """Add an event discarding the oldest one when full.
+        Return the discarded event or None"""
+        with self._lock:
+            dropped = None
+            if self._full() and self._queue:
+                dropped = self._queue.popleft()
+            self._queue.append(event)
+            if len(self._queue) > self.high:
+                self.high = len(self._queue)
+            return dropped
+
+    def appendleft(self, event):
+        "Put back an event at the head of the queue"
+        with self._lock:
+            self._queue.appendleft(event)
+
+    def pop(self):
+        "Remove and return the oldest event. Raise IndexError when empty"
+        with self._lock:
+            event = self._queue.popleft()
+            self._not_full.notify()
+            return event
+
+    def drain(self, max_batch=None):
+        """Remove and return up to max_batch events in FIFO order.
+        All queued events are returned when max_batch is None."""
+        with self._lock:
+            queue = self._queue
+            if max_batch is None or max_batch >= len(queue):
+                batch = list(queue)
+                queue.clear()
+            else:
+                popleft = queue.popleft
+                batch = [popleft() for _ in xrange(max_batch)]
+            if batch and self.maxlen is not None:
+                self._not_full.notify_all()
+        return batch
+
+    def clear(self):
+        "Discard all queued events"
+        with self._lock:
+            self._queue.clear()
+            self._not_full.notify_all()
+
+    def stats(self):
+        "Return the size, limit and high-water mark of the queue"
+        return dict(size=len(self._queue), maxlen=self.maxlen,
+                    high=self.high)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __nonzero__(self):
+        return bool(self._queue)
+
+    def __iter__(self):
+        "Iterate over a snapshot of queued events"
+        with self._lock:
+            return iter(list(self._queue))
+
+
+class FairLevel(object):
+    """Events of a priority level, scheduled by weighted fair queueing
+    among clients.
+
+    Every client has its own FIFO flow. The head event of each busy
+    flow is kept in a heap by its virtual finish time, which grows by
+    1 / weight for each event of the flow, so clients get turns in
+    proportion to their weights whatever the length of their flows.
+    """
+    def __init__(self):
+        self.flows = dict()
+        self.heap = list()
+        self.vtime = 0.0
+        self.size = 0
+        self._seq = count()
+
+    def append(self, client, event, weight):
+        flow = self.flows.get(client)
+        if flow is None:
+            flow = self.flows[client] = deque()
+            heapq.heappush(self.heap, (self.vtime + 1.0 / weight,
+                                       next(self._seq), client))
+        flow.append(event)
+        self.size += 1
+
+    def popleft(self, weights):
+        tag, _, client = heapq.heappop(self.heap)
+        flow = self.flows[client]
+        event = flow.popleft()
+        self.vtime = tag
+        self.size -= 1
+        if flow:
+            heapq.heappush(self.heap, (tag + 1.0 / weights.get(client, 1),
+                                       next(self._seq), client))
+        else:
+            del self.flows[client]
+        return event
+
+    def drop(self):
+        "Discard the oldest event of the longest flow"
+        client = max(self.flows, key=lambda c: len(self.flows[c]))
+        flow = self.flows[client]
+        event = flow.popleft()
+        self.size -= 1
+        if not flow:
+            del self.flows[client]
+            self.heap = [entry for entry in self.heap if entry[2] != client]
+            heapq.heapify(self.heap)
+        return event
+
+    def __iter__(self):
+        for flow in self.flows.values():
+            for event in flow:
+                yield event
+
+
+class FairScheduler(object):
+    """A deque-like store that serves events by X-Priority levels and
+    by weighted fair queueing of X-Client-Id within each level.
+
+    Levels are strict: an event is only served when no event of a
+    lower X-Priority value is waiting. Each dequeue costs
+    O(log clients) in the level plus O(log levels).
+    """
+    def __init__(self, weights=None):
+        self.weights = dict() if weights is None else weights
+        self.levels = dict()
+        self.active = list()  # heap of busy priorities
+        self.front = deque()  # events put back with appendleft()
+        self.size = 0
+
+    def append(self, event):
+        try:
+            priority = int(event.get(X_PRIORITY, DEFAULT_PRIORITY))
+        except ValueError:
+            priority = DEFAULT_PRIORITY
+        level = self.levels.get(priority)
+        if level is None:
+            level = self.levels[priority] = FairLevel()
+            heapq.heappush(self.active, priority)
+        client = event.get(X_CLIENT)
+        level.append(client, event, self.weights.get(client, 1))
+        self.size += 1
+
+    def appendleft(self, event):
+        self.front.appendleft(event)
+        self.size += 1
+
+    def popleft(self):
+        if self.front:
+            self.size -= 1
+            return self.front.popleft()
+        if not self.active:
+            raise IndexError('pop from an empty queue')
+        priority = self.active[0]
+        level = self.levels[priority]
+        event = level.popleft(self.weights)
+        if not level.size:
+            heapq.heappop(self.active)
+            del self.levels[priority]
+        self.size -= 1
+        return event
+
+    def drop(self):
+        "Discard an event of the least urgent level"
+        if not self.active:
+            return self.popleft()
+        priority = max(self.active)
+        level = self.levels[priority]
+        event = level.drop()
+        if not level.size:
+            self.active.remove(priority)
+            heapq.heapify(self.active)
+            del self.levels[priority]
+        self.size -= 1
+        return event
+
+    def clear(self):
+        self.levels.clear()
+        self.front.clear()
+        self.active = list()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for event in self.front:
+            yield event
+        for priority in sorted(self.levels):
+            for event in self.levels[priority]:
+                yield event
+
+
+class FairQueue(RunQueue):
+    """A RunQueue that serves events by X-Priority and shares each
+    priority level fairly among clients (see FairScheduler).
+
+    weights maps X-Client-Id values to their share, 1 by default.
+    When full, append_drop() discards an event of the least urgent
+    level and busiest client instead of the oldest one.
+    """
+    def __init__(self, maxlen=None, weights=None):
+        RunQueue.__init__(self, maxlen)
+        self._queue = FairScheduler(weights)
+        self.weights = self._queue.weights
+
+    def append_drop(self, event):
+        with self._lock:
+            dropped = None
+            if self._full() and self._queue:
+                dropped = self._queue.drop()
+            self._queue.append(event)
+            if len(self._queue) > self.high:
+                self.high = len(self._queue)
+            return dropped
+
+    def drain(self, max_batch=None):
+        """Remove and return up to max_batch events in scheduling order.
+        All queued events are returned when max_batch is None."""
+        with self._lock:
+            queue = self._queue
+            size = len(queue)
+            if max_batch is not None:
+                size = min(size, max_batch)
+            popleft = queue.popleft
+            batch = [popleft() for _ in xrange(size)]
+            if batch and self.maxlen is not None:
+                self._not_full.notify_all()
+        return batch
+
+
+# End
@@ -0,0 +1,272 @@
+"""A small event loop with generator based coroutines.
+
+Reactor runs callbacks and timers in a single thread. Other threads
+hand work to it with call_soon_threadsafe(), which wakes the loop up
+through a Waker. Timers are kept in a HeapTimers.
+
+Coroutines are plain generators. A coroutine yields a Future to wait
+for its result, or None to let other callbacks run, and finishes by
+returning or raising StopIteration(value):
+
+    def dispatch_request(self, event):
+        yield self.world.loop.sleep(0.5)
+        event.answer().body = u'done'
+"""
+import time
+from collections import deque
+from threading import Lock, Event as Flag
+
+from swarmforce.loggers import getLogger
+from swarmforce.misc import Waker
+from swarmforce.timers import HeapTimers
+
+log = getLogger('swarmforce')
+
+PENDING = 'PENDING'
+FINISHED = 'FINISHED'
+
+
+class TimeoutError(Exception):
+    "The result of a Future is not ready in time"
+
+
+class CancelledError(Exception):
+    "The Future has been cancelled"
+
+
+class Future(object):
+    """The result of an operation that is not finished yet.
+
+    It can be resolved from any thread. Threads may block on result()
+    while coroutines yield the future to the Reactor.
+    """
+    def __init__(self):
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = list()
+        self._lock = Lock()
+        self._flag = None
+
+    def done(self):
+        return self._state == FINISHED
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self._state == FINISHED:
+                return False
+            self._result = result
+            self._exception = exception
+            self._state = FINISHED
+            callbacks, self._callbacks = self._callbacks, list()
+            if self._flag is not None:
+                self._flag.set()
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                log.exception('Callback %s failed for %s', func, self)
+        return True
+
+    def set_result(self, result):
+        "Resolve the future. Return False if it was already done"
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        "Resolve the future with an error"
+        return self._finish(None, exception)
+
+    def cancel(self):
+        "Resolve the future with a CancelledError"
+        return self._finish(None, CancelledError())
+
+    def cancelled(self):
+        return isinstance(self._exception, CancelledError)
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, func):
+        "Call func(future) when the future is done, maybe right now"
+        with self._lock:
+            if self._state == PENDING:
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def result(self, timeout=None):
+        "Block until the future is done and return its result"
+        if self._state == PENDING:
+            with self._lock:
+                if self._state == PENDING and self._flag is None:
+                    self._flag = Flag()
+                flag = self._flag
+            if self._state == PENDING:
+                flag.wait(timeout)
+            if self._state == PENDING:
+                raise TimeoutError('%s not ready after %ss' % (self, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+def gather(futures):
+    """Return a Future resolved with the list of results of futures,
+    or with the first error. Threads may wait for it with result()
+    and coroutines may yield it."""
+    futures = list(futures)
+    outer = Future()
+    results = [None] * len(futures)
+    remain = [len(futures)]
+    lock = Lock()
+
+    def collect(i, future):
+        if future.exception() is not None:
+            outer.set_exception(future.exception())
+            return
+        results[i] = future.result()
+        with lock:
+            remain[0] -= 1
+            finished = not remain[0]
+        if finished:
+            outer.set_result(results)
+
+    if not futures:
+        outer.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda f, i=i: collect(i, f))
+    return outer
+
+
+class Task(Future):
+    """Run a generator coroutine in a Reactor.
+    The task result is the value the coroutine finishes with."""
+    def __init__(self, coro, loop):
+        Future.__init__(self)
+        self.coro = coro
+        self.loop = loop
+        loop.call_soon_threadsafe(self._step)
+
+    def _step(self, value=None, exception=None):
+        try:
+            if exception is None:
+                yielded = self.coro.send(value)
+            else:
+                yielded = self.coro.throw(exception)
+        except StopIteration, stop:
+            self.set_result(stop.args[0] if stop.args else None)
+        except Exception, why:
+            self.set_exception(why)
+        else:
+            if isinstance(yielded, Future):
+                yielded.add_done_callback(self._wakeup)
+            elif yielded is None:
+                self.loop.call_soon(self._step)
+            else:
+                self.loop.call_soon(self._step, None, TypeError(
+                    'Coroutines must yield a Future or None, not %r'
+                    % (yielded, )))
+
+    def _wakeup(self, future):
+        # the future may be resolved in any thread
+        self.loop.call_soon_threadsafe(self._resume, future)
+
+    def _resume(self, future):
+        if future.exception() is not None:
+            self._step(None, future.exception())
+        else:
+            self._step(future.result())
+
+
+class Reactor(object):
+    """Run callbacks, timers and coroutines in the current thread.
+
+    call_soon() must only be used from the loop thread. call_at(),
+    cancel() and call_soon_threadsafe() may be used from any thread.
+    """
+    def __init__(self):
+        self.ready = deque()
+        self.timers = HeapTimers()
+        self.lock = Lock()
+        self.waker = Waker()
+        self.running = False
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, func, *args):
+        "Run func(*args) in the next iteration of the loop"
+        self.ready.append((func, args))
+
+    def call_soon_threadsafe(self, func, *args):
+        "Run func(*args) in the loop, waking it up if it is sleeping"
+        self.ready.append((func, args))
+        self.waker.wake()
+
+    def call_at(self, when, func, *args):
+        "Run func(*args) at time 'when'. Return a handle for cancel()"
+        with self.lock:
+            handle = self.timers.push(when, (func, args))
+        self.waker.wake()
+        return handle
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.time() + delay, func, *args)
+
+    def cancel(self, handle):
+        "Cancel a timer. Return True if it was still pending"
+        with self.lock:
+            return self.timers.cancel(handle)
+
+    def sleep(self, delay, result=None):
+        "Return a Future resolved with result after delay seconds"
+        future = Future()
+        self.call_later(delay, future.set_result, result)
+        return future
+
+    def spawn(self, coro):
+        "Run a generator coroutine, return its Task"
+        return Task(coro, self)
+
+    def run_once(self):
+        "Wait for ready callbacks or due timers and run them"
+        self.waker.clear()
+        if not self.ready:
+            with self.lock:
+                deadline = self.timers.next_deadline()
+            if deadline is None:
+                self.waker.wait()
+            else:
+                self.waker.wait(deadline - time.time())
+
+        with self.lock:
+            self.ready.extend(self.timers.expire(time.time()))
+
+        ready = self.ready
+        for _ in xrange(len(ready)):
+            func, args = ready.popleft()
+            try:
+                func(*args)
+            except Exception:
+                log.exception('Callback %s failed', func)
+
+    def run_forever(self):
+        "Run the loop until stop() is called"
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        """Stop the loop once the callbacks that are already
+        scheduled have been run"""
+        self.call_soon_threadsafe(self._stop)
+
+    def _stop(self):
+        self.running = False
+
+    def close(self):
+        "Release the waker"
+        self.waker.close()
+
+
+# End
@@ -0,0 +1,192 @@
+"""An indexed registry of the workers running in a node.
+
+The registry is a single file of fixed size records, one per worker,
+holding its id, pid, last heartbeat time and state:
+
+    <workerid> <pid> <heartbeat> <A|D>
+
+A worker finds its own record by slot number, so registering costs a
+locked append (or the reuse of the slot of a dead worker) and every
+heartbeat is a locked read and write in place. Reading the status of
+all the workers is a single read of the file instead of walking the
+node home tree and opening every pid file.
+
+Liveness is checked incrementally: a worker whose heartbeat is recent
+is alive, and psutil is only asked about the pids of stale workers, at
+most once every check_interval seconds for each of them.
+"""
+import os
+import time
+import fcntl
+from threading import Lock
+
+import psutil
+
+from swarmforce.loggers import getLogger
+
+log = getLogger('swarmforce')
+
+RECORD_FMT = '%-40s %10d %17.6f %s\n'
+RECORD_SIZE = 72
+ALIVE = 'A'
+DEAD = 'D'
+
+
+def parse_record(data):
+    "Return (workerid, pid, heartbeat, state) of a record"
+    workerid, pid, heartbeat, state = data.split()
+    return workerid, int(pid), float(heartbeat), state
+
+
+class WorkerRegistry(object):
+    """A fixed record status file of the workers of a node."""
+    def __init__(self, path, stale=60, check_interval=30):
+        self.path = path
+        self.stale = stale  # seconds without heartbeat to ask psutil
+        self.check_interval = check_interval
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self.lock = Lock()
+        self.slots = dict()  # workerid -> slot
+        self.free = list()  # slots of dead workers
+        self.checked = dict()  # pid -> (time, running)
+        self.checks = 0  # psutil calls
+        self._read_all()
+
+    def _read_all(self):
+        "Read every record, rebuilding the slot index"
+        with self.lock:
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            data = ''
+            chunk = os.read(self.fd, 1 << 20)
+            while chunk:
+                data += chunk
+                chunk = os.read(self.fd, 1 << 20)
+        records = list()
+        slots = dict()
+        free = list()
+        for slot in xrange(len(data) // RECORD_SIZE):
+            start = slot * RECORD_SIZE
+            try:
+                record = parse_record(data[start:start + RECORD_SIZE])
+            except ValueError:
+                log.warn('Bad record %s in %s', slot, self.path)
+                continue  # being written by another process
+            if record[3] == DEAD:
+                free.append(slot)
+            else:
+                slots[record[0]] = slot
+                records.append(record)
+        self.slots, self.free = slots, free
+        return records
+
+    def _write(self, slot, workerid, pid, heartbeat, state=ALIVE):
+        record = RECORD_FMT % (workerid, pid, heartbeat, state)
+        if len(record) != RECORD_SIZE:
+            raise ValueError('Bad worker record: %r' % record)
+        with self.lock:
+            os.lseek(self.fd, slot * RECORD_SIZE, os.SEEK_SET)
+            os.write(self.fd, record)
+
+    def register(self, workerid, pid=None, heartbeat=None):
+        "Add a worker or update its record. Return its slot"
+        fcntl.flock(self.fd, fcntl.LOCK_EX)  # against other processes
+        try:
+            return self._register(workerid, pid, heartbeat)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _register(self, workerid, pid=None, heartbeat=None):
+        "register() with the file lock already held"
+        pid = os.getpid() if pid is None else pid
+        heartbeat = time.time() if heartbeat is None else heartbeat
+        self._read_all()
+        slot = self.slots.get(workerid)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop(0)
+            else:
+                slot = os.fstat(self.fd).st_size // RECORD_SIZE
+            self.slots[workerid] = slot
+        self._write(slot, workerid, pid, heartbeat)
+        return slot
+
+    def heartbeat(self, workerid, pid=None):
+        """Stamp the time in the record of a registered worker.
+        The worker is registered again if another process has removed
+        it and maybe given its slot to someone else"""
+        slot = self.slots.get(workerid)
+        if slot is None:
+            return self.register(workerid, pid)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            with self.lock:
+                os.lseek(self.fd, slot * RECORD_SIZE, os.SEEK_SET)
+                data = os.read(self.fd, RECORD_SIZE)
+            try:
+                record = parse_record(data)
+            except ValueError:
+                record = None
+            if record is None or record[0] != workerid or \
+               record[3] == DEAD:
+                return self._register(workerid, pid)
+            self._write(slot, workerid, os.getpid() if pid is None else pid,
+                        time.time())
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return slot
+
+    def get(self, workerid):
+        "Return (pid, heartbeat, state) of a worker or None"
+        slot = self.slots.get(workerid)
+        if slot is None:
+            self._read_all()  # registered by another process
+            slot = self.slots.get(workerid)
+            if slot is None:
+                return None
+        with self.lock:
+            os.lseek(self.fd, slot * RECORD_SIZE, os.SEEK_SET)
+            record = parse_record(os.read(self.fd, RECORD_SIZE))
+        if record[0] != workerid or record[3] == DEAD:
+            self.slots.pop(workerid, None)  # slot reused meanwhile
+            return None
+        return record[1:]
+
+    def remove(self, workerid):
+        "Mark the record of a worker as dead so its slot is reused"
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            self._read_all()
+            slot = self.slots.pop(workerid, None)
+            if slot is not None:
+                self._write(slot, workerid, 0, 0, DEAD)
+                self.free.append(slot)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def running(self, pid, heartbeat, now):
+        "Liveness of a worker, asking psutil only for stale ones"
+        if now - heartbeat < self.stale:
+            return True
+        checked = self.checked.get(pid)
+        if checked is None or now - checked[0] > self.check_interval:
+            checked = self.checked[pid] = (now, psutil.pid_exists(pid))
+            self.checks += 1
+        return checked[1]
+
+    def status(self):
+        "Return workerid -> (pid, heartbeat, running) for every worker"
+        now = time.time()
+        result = dict()
+        for workerid, pid, heartbeat, state in self._read_all():
+            result[workerid] = (pid, heartbeat,
+                                self.running(pid, heartbeat, now))
+        return result
+
+    def __len__(self):
+        return len(self.slots)
+
+    def close(self):
+        os.close(self.fd)
+
+
+# End
@@ -0,0 +1,96 @@
+"""Consistent hashing ring for placing keys on nodes.
+
+hash_range() splits the hash space in equal static slices, so when a
+node joins or leaves almost every key changes its owner. HashRing
+places 'vnodes' points per node (scaled by the node weight) on the
+SHA1 circle and a key belongs to the node of the first point that
+follows it, so a membership change only moves about 1/N of the keys.
+
+Points and keys are 40 chars hex digests, which sort as the numbers
+they represent, so lookups are a bisect on a sorted list of strings.
+"""
+from bisect import bisect_left
+from functools import partial
+from itertools import imap
+from collections import Counter
+
+from swarmforce.misc import hasher
+
+
+class HashRing(object):
+    """A consistent hashing ring with virtual nodes and weights."""
+    def __init__(self, nodes=(), vnodes=128):
+        self.vnodes = vnodes
+        self.weights = dict()
+        self.points = list()
+        self.owners = list()
+        for node in nodes:
+            self.add(node, build=False)
+        self._build()
+
+    def _points(self, node):
+        "Return the points of a node on the ring"
+        replicas = max(1, int(round(self.vnodes * self.weights[node])))
+        return [hasher('%s-%s' % (node, i)) for i in xrange(replicas)]
+
+    def _build(self):
+        ring = sorted((point, node) for node in self.weights
+                      for point in self._points(node))
+        self.points = [point for point, node in ring]
+        # the last entry wraps around to the first point of the ring
+        self.owners = [node for point, node in ring] + \
+                      [node for point, node in ring[:1]]
+
+    def add(self, node, weight=1.0, build=True):
+        "Add or re-weight a node"
+        self.weights[node] = float(weight)
+        if build:
+            self._build()
+
+    def remove(self, node):
+        "Remove a node from the ring"
+        if self.weights.pop(node, None) is not None:
+            self._build()
+
+    def copy(self):
+        "Return an independent copy of the ring"
+        ring = HashRing(vnodes=self.vnodes)
+        ring.weights = dict(self.weights)
+        ring.points = list(self.points)
+        ring.owners = list(self.owners)
+        return ring
+
+    def lookup(self, hash_):
+        "Return the node that owns a hex hash"
+        if not self.points:
+            raise LookupError('Empty ring')
+        return self.owners[bisect_left(self.points, hash_)]
+
+    def lookup_many(self, hashes):
+        "Return the nodes that own a batch of hex hashes, in order"
+        if not self.points:
+            raise LookupError('Empty ring')
+        return map(self.owners.__getitem__,
+                   imap(partial(bisect_left, self.points), hashes))
+
+    def __contains__(self, node):
+        return node in self.weights
+
+    def __len__(self):
+        return len(self.weights)
+
+
+def movement(before, after, hashes):
+    """Report how many of the hashes change their owner from the ring
+    'before' to the ring 'after' and where do they go."""
+    old = before.lookup_many(hashes)
+    new = after.lookup_many(hashes)
+    flows = Counter((a, b) for (a, b) in zip(old, new) if a != b)
+    moved = sum(flows.values())
+    total = len(old)
+    return dict(total=total, moved=moved,
+                ratio=float(moved) / total if total else 0.0,
+                flows=dict(flows))
+
+
+# End
@@ -0,0 +1,248 @@
+"""Routing of requests to the workers that listen to them.
+
+Worker rules are regular expressions matched against the request
+statusline ('METHOD /path'). Most rules start with a literal method
+token and a literal path prefix, e.g. 'DO /inbox/eval', so the Router
+index them by method and path prefix and only the leftover rules that
+can not be analyzed are tried against every request. Candidates are
+always confirmed with the worker regexp, so routing gives exactly the
+same result as matching every worker.
+
+Routing decisions are kept in a bounded LRU cache keyed by statusline
+and invalidated as a whole each time a worker or a rule changes.
+"""
+import re
+from threading import Lock
+from collections import OrderedDict
+
+RE_LITERAL_BRANCH = re.compile(r"(?P<method>[A-Za-z0-9_\-]+) (?P<path>.*)$",
+                               re.DOTALL)
+
+SPECIAL = '.^$*+?{}[]()|\\'
+QUANTIFIERS = '*?{'
+
+
+def split_branches(rule):
+    "Split a regexp by its top level '|' alternations"
+    branches = list()
+    depth = 0
+    klass = False
+    start = 0
+    i = 0
+    while i < len(rule):
+        c = rule[i]
+        if c == '\\':
+            i += 2
+            continue
+        if klass:
+            if c == ']':
+                klass = False
+        elif c == '[':
+            klass = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            branches.append(rule[start:i])
+            start = i + 1
+        i += 1
+    branches.append(rule[start:])
+    return branches
+
+
+def literal_prefix(pattern):
+    "Return the literal text that any match of pattern must start with"
+    prefix = list()
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if not escaped or escaped.isalnum():
+                break  # \d, \w, \1 ... are not literals
+            prefix.append(escaped)
+            i += 2
+            continue
+        if c in SPECIAL:
+            if c in QUANTIFIERS and prefix:
+                prefix.pop()  # previous char is optional
+            break
+        prefix.append(c)
+        i += 1
+    return ''.join(prefix)
+
+
+def analyze(rule):
+    """Return the list of (method, path_prefix) that cover all the
+    branches of a rule or None if some branch can not be indexed."""
+    keys = list()
+    for branch in split_branches(rule):
+        match = RE_LITERAL_BRANCH.match(branch)
+        if not match:
+            return None
+        prefix = literal_prefix(match.group('path'))
+        try:
+            prefix.encode('ascii')
+        except UnicodeError:
+            prefix = ''  # case folding is not trivial, use method only
+        keys.append((match.group('method').lower(), prefix.lower()))
+    return keys
+
+
+class RouteCache(object):
+    """A bounded LRU cache of routing decisions.
+
+    Entries belong to a generation of the Router. When the generation
+    changes the whole cache is discarded.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, statusline, generation):
+        "Return the cached decision for statusline or None"
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        entries = self.entries
+        decision = entries.pop(statusline, None)
+        if decision is None:
+            self.misses += 1
+        else:
+            entries[statusline] = decision  # most recently used
+            self.hits += 1
+        return decision
+
+    def put(self, statusline, generation, decision):
+        "Store a decision computed for a generation of the Router"
+        if generation != self.generation or not self.size:
+            return
+        entries = self.entries
+        entries[statusline] = decision
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+
+    def stats(self):
+        "Return cache counters, useful to size the cache"
+        total = self.hits + self.misses
+        return dict(size=len(self.entries), capacity=self.size,
+                    hits=self.hits, misses=self.misses,
+                    ratio=float(self.hits) / total if total else 0.0)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Router(object):
+    """Index of worker rules for a World.
+
+    Workers are indexed by the literal method token and path prefix of
+    their rules. Workers with rules that can not be analyzed are kept
+    in a wildcard set and are checked for every request.
+    """
+    def __init__(self, cache_size=1024):
+        self.workers = dict()
+        self.order = dict()
+        self.keys = dict()
+        self.index = dict()  # method -> {prefix: set(hashes)}
+        self.lengths = dict()  # method -> sorted prefix lengths
+        self.wildcard = set()
+        self.generation = 0
+        self.cache = RouteCache(cache_size)
+        self.lock = Lock()
+        self._seq = 0
+
+    def add(self, worker):
+        "Index a worker and all its rules"
+        with self.lock:
+            self._seq += 1
+            self.workers[worker.hash_] = worker
+            self.order[worker.hash_] = self._seq
+            self._index(worker)
+            self.generation += 1
+
+    def update(self, worker):
+        "Re-index a worker after its rules have changed"
+        with self.lock:
+            if worker.hash_ not in self.workers:
+                return
+            self._unindex(worker.hash_)
+            self._index(worker)
+            self.generation += 1
+
+    def remove(self, worker):
+        "Remove a worker from the index"
+        with self.lock:
+            if self.workers.pop(worker.hash_, None) is not None:
+                self.order.pop(worker.hash_)
+                self._unindex(worker.hash_)
+                self.generation += 1
+
+    def _index(self, worker):
+        hash_ = worker.hash_
+        keys = set()
+        for rule in worker.rules:
+            rule_keys = analyze(rule)
+            if rule_keys is None:
+                self.wildcard.add(hash_)
+            else:
+                keys.update(rule_keys)
+
+        self.keys[hash_] = keys
+        for method, prefix in keys:
+            table = self.index.setdefault(method, dict())
+            table.setdefault(prefix, set()).add(hash_)
+            self.lengths[method] = sorted(set(len(p) for p in table))
+
+    def _unindex(self, hash_):
+        self.wildcard.discard(hash_)
+        for method, prefix in self.keys.pop(hash_, ()):
+            table = self.index[method]
+            hashes = table[prefix]
+            hashes.discard(hash_)
+            if not hashes:
+                del table[prefix]
+                if table:
+                    self.lengths[method] = sorted(set(len(p) for p in table))
+                else:
+                    del self.index[method]
+                    del self.lengths[method]
+
+    def candidates(self, statusline):
+        "Return the hashes of the workers that may listen a statusline"
+        method, _, path = statusline.partition(' ')
+        method = method.lower()
+        found = set(self.wildcard)
+        table = self.index.get(method)
+        if table:
+            path = path.lower()
+            for length in self.lengths[method]:
+                hashes = table.get(path[:length])
+                if hashes:
+                    found.update(hashes)
+        return found
+
+    def route(self, statusline):
+        "Return the workers whose rules match a statusline"
+        with self.lock:
+            generation = self.generation
+            decision = self.cache.get(statusline, generation)
+            if decision is not None:
+                return list(decision)
+
+            found = self.candidates(statusline)
+            workers = [self.workers[hash_] for hash_ in
+                       sorted(found, key=self.order.get)]
+
+        decision = tuple(worker for worker in workers
+                         if worker.regexp.match(statusline))
+        with self.lock:
+            self.cache.put(statusline, generation, decision)
+        return list(decision)
+
+
+# End
@@ -0,0 +1,156 @@
+"""Sharded runtime: one World process per slice of the hash space.
+
+The SHA1 space is split with hash_range() and every shard is a child
+process running its own World. Requests are sent to the shard that owns
+their X-Hash and responses to the shard that owns their X-Request-Id,
+which is where the request is pending, so a request and its response
+are always handled by the same process.
+
+Events travel to the shards in wire form (see Serializer.wire) and are
+buffered per shard, so many events are sent in a single pipe write.
+Each shard creates its own workers with the setup(world, index)
+callable. Events that workers push inside a shard stay in that shard.
+"""
+import time
+import Queue
+import multiprocessing
+from bisect import bisect_right
+
+from swarmforce.loggers import getLogger
+from swarmforce.http import Request, SERIALIZER, X_REQ_ID, StreamParser
+from swarmforce.swarm import World, hash_range
+
+log = getLogger('swarmforce')
+
+
+def shard_starts(shards):
+    "Return the first hash of every shard, in order"
+    return [hash_range(i, shards)[0] for i in xrange(shards)]
+
+
+def shard_of(hash_, starts):
+    "Return the index of the shard that owns a hex hash"
+    return bisect_right(starts, int(hash_, 16)) - 1
+
+
+def serve_shard(index, shards, inbox, results, setup=None, pool_size=0):
+    """Main function of a shard process.
+
+    Feed the World with the events read from inbox until None is
+    received, then wait for the queue to be processed and report the
+    shard counters into results."""
+    world = World(name='shard-%s' % index)
+    world.lifetime = None
+    world.pool_size = pool_size
+    if setup is not None:
+        setup(world, index)
+    world.start()
+
+    parser = StreamParser()
+    received = 0
+    data = inbox.get()
+    while data is not None:
+        for event in parser.feed(data):
+            world.push(event)
+            received += 1
+        data = inbox.get()
+
+    while world.queue or not world.idle_workers():
+        time.sleep(0.001)
+    world.stop()
+    results.put((index, dict(received=received,
+                             pending=len(world.pending))))
+
+
+class ShardedWorld(object):
+    """Run a World per shard in child processes.
+
+    push() buffers each event for its owning shard and sends the buffer
+    once it is larger than flush_size bytes. Call flush() to send
+    the buffered events at once, and stop() to drain and finish all
+    the shards.
+    """
+    def __init__(self, shards=None, setup=None, pool_size=0,
+                 flush_size=65536):
+        if shards is None:
+            shards = multiprocessing.cpu_count()
+        self.shards = shards
+        self.setup = setup
+        self.pool_size = pool_size
+        self.flush_size = flush_size
+        self.starts = shard_starts(shards)
+        self.buffers = [bytearray() for _ in xrange(shards)]
+        self.inboxes = list()
+        self.processes = list()
+        self.results = multiprocessing.Queue()
+        self.stats = dict()
+
+    def start(self):
+        "Launch the shard processes"
+        for index in xrange(self.shards):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=serve_shard, name='shard-%s' % index,
+                args=(index, self.shards, inbox, self.results,
+                      self.setup, self.pool_size))
+            process.daemon = True
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        log.info('Started %s shards', self.shards)
+
+    def owner(self, event):
+        "Return the index of the shard that must handle an event"
+        if isinstance(event, Request):
+            key = event.hash()
+        else:
+            key = event[X_REQ_ID]
+        return shard_of(key, self.starts)
+
+    def push(self, event):
+        "Send an event to its shard"
+        index = self.owner(event)
+        buf = self.buffers[index]
+        SERIALIZER.write(event, buf)
+        if len(buf) >= self.flush_size:
+            self.flush(index)
+
+    def flush(self, index=None):
+        "Send the buffered events of a shard or of all the shards"
+        if index is None:
+            indexes = xrange(self.shards)
+        else:
+            indexes = [index]
+        for index in indexes:
+            buf = self.buffers[index]
+            if buf:
+                self.inboxes[index].put(bytes(buf))
+                self.buffers[index] = bytearray()
+
+    def stop(self, timeout=60):
+        """Send the buffered events, let the shards process their queues
+        and wait for them. Return the counters of every shard."""
+        self.flush()
+        for inbox in self.inboxes:
+            inbox.put(None)
+
+        end = time.time() + timeout
+        while len(self.stats) < len(self.processes):
+            try:
+                index, stats = self.results.get(
+                    timeout=max(end - time.time(), 0))
+            except Queue.Empty:
+                log.warn('%s shards did not stop in %s seconds',
+                         len(self.processes) - len(self.stats), timeout)
+                break
+            self.stats[index] = stats
+        for process in self.processes:
+            process.join(max(end - time.time(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        log.info('Stopped %s shards', self.shards)
+        return self.stats
+
+
+# End
@@ -0,0 +1,237 @@
+"""Shared memory ring buffer carrying events between local processes.
+
+A ShmRing is a file mapped in memory by exactly one producer and one
+consumer process (use a path under /dev/shm to keep it in RAM). The
+header holds the total number of bytes written (head) and read (tail),
+each in its own cache line, and the data area is a power of two sized
+circular buffer. Only the producer moves head and only the consumer
+moves tail, so no lock is needed.
+
+Events are written in wire form (see Serializer.wire) and the consumer
+reads them back with a StreamParser. A consumer with nothing to read
+raises a 'waiting' flag and sleeps on a FIFO next to the ring file. The
+producer only writes to the FIFO when that flag is set, so a busy
+consumer costs no syscall at all. Sleeps are bounded by a timeout as
+the flag is not a memory barrier.
+"""
+import os
+import time
+import mmap
+import errno
+import select
+import struct
+from threading import Thread
+
+from swarmforce.loggers import getLogger
+from swarmforce.http import SERIALIZER, StreamParser
+
+log = getLogger('swarmforce')
+
+COUNTER = struct.Struct('<Q')
+HEAD = 0
+TAIL = 64
+WAITING = 128
+HEADER = 192
+FIFO_EXT = '.fifo'
+
+
+class ShmRing(object):
+    """A single producer / single consumer byte ring in shared memory.
+
+    The consumer creates the ring with create=True and the producer
+    opens it later with the same path.
+    """
+    def __init__(self, path, size=1 << 20, create=False):
+        self.path = path
+        self.fifo_path = path + FIFO_EXT
+        if create:
+            if size & (size - 1):
+                raise ValueError('Ring size must be a power of 2: %s' % size)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+            os.ftruncate(fd, HEADER + size)
+            if os.path.exists(self.fifo_path):
+                os.unlink(self.fifo_path)
+            os.mkfifo(self.fifo_path, 0600)
+        else:
+            fd = os.open(path, os.O_RDWR)
+            size = os.fstat(fd).st_size - HEADER
+        self.buf = mmap.mmap(fd, HEADER + size)
+        os.close(fd)
+        self.size = size
+        self.mask = size - 1
+        # O_RDWR never blocks nor fails when the other side is missing
+        self.fifo = os.open(self.fifo_path, os.O_RDWR | os.O_NONBLOCK)
+
+    def _get(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    def __len__(self):
+        "Bytes written and not read yet"
+        return self._get(HEAD) - self._get(TAIL)
+
+    # producer side
+    def write(self, data):
+        "Write all data or nothing. Return False if there is no room"
+        n = len(data)
+        if n > self.size:
+            raise ValueError('%s bytes do not fit in the ring' % n)
+        head = self._get(HEAD)
+        if self.size - (head - self._get(TAIL)) < n:
+            return False
+        pos = head & self.mask
+        first = min(n, self.size - pos)
+        start = HEADER + pos
+        self.buf[start:start + first] = data[:first]
+        if first < n:
+            self.buf[HEADER:HEADER + n - first] = data[first:]
+        self._set(HEAD, head + n)
+        if self.buf[WAITING] != '\0':
+            self._signal()
+        return True
+
+    def put(self, data, timeout=None):
+        "Write data, waiting for room. Return False after timeout"
+        if self.write(data):
+            return True
+        end = None if timeout is None else time.time() + timeout
+        delay = 0.0001
+        while not self.write(data):
+            if end is not None and time.time() > end:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        return True
+
+    def _signal(self):
+        try:
+            os.write(self.fifo, 'x')
+        except OSError, why:
+            if why.errno != errno.EAGAIN:
+                raise  # a full FIFO will wake up the consumer anyway
+
+    # consumer side
+    def read(self):
+        "Return all the bytes available, maybe an empty string"
+        tail = self._get(TAIL)
+        n = self._get(HEAD) - tail
+        if not n:
+            return ''
+        pos = tail & self.mask
+        first = min(n, self.size - pos)
+        start = HEADER + pos
+        data = self.buf[start:start + first]
+        if first < n:
+            data += self.buf[HEADER:HEADER + n - first]
+        self._set(TAIL, tail + n)
+        return data
+
+    def wait(self, timeout=0.05):
+        "Sleep until the producer writes or timeout"
+        self.buf[WAITING] = '\1'
+        try:
+            if len(self):
+                return True
+            ready, _, _ = select.select([self.fifo], [], [], timeout)
+            if ready:
+                try:
+                    os.read(self.fifo, 4096)
+                except OSError:
+                    pass
+            return bool(ready)
+        finally:
+            self.buf[WAITING] = '\0'
+
+    def close(self):
+        self.buf.close()
+        os.close(self.fifo)
+
+    def unlink(self):
+        "Remove the ring files, the consumer does it when done"
+        for path in (self.path, self.fifo_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class RingSender(object):
+    """The producer end of a ShmRing.
+
+    It has the push() method of World, so producers may use it where a
+    World is expected to forward events to another local process.
+    """
+    def __init__(self, ring, timeout=None):
+        self.ring = ring
+        self.timeout = timeout
+        self.sent = 0
+
+    def push(self, event, block=True):
+        "Send an event. Return False if it does not fit in time"
+        buf = bytearray()
+        SERIALIZER.write(event, buf)
+        return self.push_wire(bytes(buf), 1, block)
+
+    def push_many(self, events, block=True):
+        "Send many events with as few ring writes as they fit in"
+        buf = bytearray()
+        count = 0
+        for event in events:
+            mark = len(buf)
+            SERIALIZER.write(event, buf)
+            if len(buf) > self.ring.size and count:
+                if not self.push_wire(bytes(buf[:mark]), count, block):
+                    return False
+                del buf[:mark]
+                count = 0
+            count += 1
+        return self.push_wire(bytes(buf), count, block)
+
+    def push_wire(self, data, count=1, block=True):
+        if block:
+            done = self.ring.put(data, self.timeout)
+        else:
+            done = self.ring.write(data)
+        if done:
+            self.sent += count
+        return done
+
+
+class RingReceiver(Thread):
+    """The consumer end of a ShmRing: a thread that parses the events
+    written in the ring and pushes them into a World."""
+    def __init__(self, ring, world, name=None):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.ring = ring
+        self.world = world
+        self.parser = StreamParser()
+        self.running = False
+        self.received = 0
+
+    def start(self):
+        self.running = True
+        Thread.start(self)
+
+    def run(self):
+        ring = self.ring
+        push = self.world.push
+        while self.running:
+            data = ring.read()
+            if data:
+                for event in self.parser.feed(data):
+                    push(event)
+                    self.received += 1
+            else:
+                ring.wait()
+
+    def stop(self, timeout=5):
+        "Stop once the bytes already in the ring have been pushed"
+        while len(self.ring) and self.is_alive() and timeout > 0:
+            time.sleep(0.01)
+            timeout -= 0.01
+        self.running = False
+        self.join(timeout)
+
+
+# End
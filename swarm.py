@@ -6,15 +6,26 @@ import time
 import os
 import shutil
 
-from threading import Thread
+from threading import Thread, Lock, current_thread
 from collections import namedtuple
+from functools import partial
+from inspect import isgeneratorfunction
 
 import psutil
 
 from swarmforce.loggers import getLogger
-from swarmforce.http import Request, Response, \
-     X_CLIENT, X_REQ_ID, X_TIME, X_TIMEOUT, X_REMAIN_EXECUTIONS
-from swarmforce.misc import hasher, until, expath
+from swarmforce.http import Request, Response, PackedEvent, pack, \
+     CODE_TIMEOUT, CODE_UNAVAILABLE, X_CLIENT, X_REQ_ID, X_TIME, X_TIMEOUT, X_REMAIN_EXECUTIONS, \
+     X_HASH, SERIALIZER
+from swarmforce.misc import hasher, until, expath, Waker
+from swarmforce.queues import RunQueue, BLOCK, DROP_OLDEST
+from swarmforce.timers import HeapTimers
+from swarmforce.routing import Router
+from swarmforce.executor import KeyedExecutor
+from swarmforce.reactor import Reactor, Future, TimeoutError
+from swarmforce.inboxlog import InboxLog, is_log
+from swarmforce.inboxwatch import CLAIMED_EXT
+from swarmforce.registry import WorkerRegistry
 
 # log = getLogger(__name__)
 log = getLogger('swarmforce')
@@ -58,33 +69,157 @@ class World(Thread):
                         kwargs, verbose)
 
         self.workers = dict()
+        self.router = Router()
         self.running = STOPPED
         self.relax = 0.1
-        self.timeout = 0.25
+        self.lifetime = 60  # seconds, None means run until stop()
+        # seconds between the re-executions of a request without X-Timeout
+        self.repeat_interval = 0.25
+        self.max_batch = 64
+        self.compact = True  # keep queued and pending events packed
+        # threads used to run workers, 0 means running them inline in
+        # the World thread. Set it before start()
+        self.pool_size = 0
+        self.executor = None
+        self.batches = dict()  # worker hash -> [worker, requests]
         self.now = time.time()
-        self.check = 0
-
-        self.queue = list()
-        self.deferred = list()
+        self.end = None
+        self.waker = Waker()
+
+        # queue: RunQueue (FIFO) or FairQueue to serve events by
+        # X-Priority and fairly among X-Client-Id. Replace it before
+        # start(). Set queue.maxlen to bound the queue, overflow selects
+        # what push() does when it is full: BLOCK, REJECT or DROP_OLDEST.
+        # Refused requests are answered with a 503 response
+        self.queue = RunQueue()
+        self.overflow = BLOCK
+        self.block_timeout = None  # then BLOCK rejects, None waits forever
+        self.rejected = 0
+        self.dropped = 0
+        # timer backend: HeapTimers or TimingWheel for very large
+        # amounts of deferred requests. Replace it before start()
+        self.deferred = HeapTimers()
+        self.deferred_lock = Lock()
+        self.scheduled = HeapTimers()  # callbacks from call_at()
         self.pending = dict()
+        # request key -> [Future, timer, keys], the same entry for all
+        # the hashes the request had while deferred
+        self.futures = dict()
+        # seconds a request waits for its response, None means forever
+        self.pending_ttl = 600
+        self.answer_expired = False  # send a 504 response when expired
+        self.pending_timers = dict()
+        self.evicted = 0
 
         log.info('New World at: %s', self)
 
-    def push(self, event):
-        "broadcast an event to all workers trought their observers"
+    def push(self, event, block=True):
+        """broadcast an event to all workers trought their observers.
+        Return False if the event is refused because the queue is full"""
         if isinstance(event, Request):
             event.hash()
-            self.pending[event.key] = event
+        stored = pack(event) if self.compact else event
+        if isinstance(event, Request):
+            self.pending[event.key] = stored
+            if self.pending_ttl is not None:
+                self._arm_pending(event)
 
         if event.sane():
             timeout = event.get(X_TIME)
             if timeout is not None and \
                float(timeout) > time.time():  # don't use self.now !
                 self._push_deferred(event)
-            else:
-                self.queue.append(event)
+                self.waker.wake()
+            elif not self._enqueue(stored, block,
+                                   bounded=isinstance(event, Request)):
+                self.rejected += 1
+                if isinstance(event, Request):
+                    self._refuse(event, answer=block)
+                return False
         else:
             log.error('MALFORMED event: %s', event.dump())
+        return True
+
+    def try_push(self, event):
+        """Push an event without ever waiting for room in the queue.
+        Return False if it does not fit, no response is sent then"""
+        return self.push(event, block=False)
+
+    def _enqueue(self, event, block=True, bounded=True):
+        """Queue an event to be dispatched by the world thread applying
+        the overflow policy. Return False if it is refused.
+        Responses are not bounded, they release pending requests"""
+        queue = self.queue
+        if queue.maxlen is None or not bounded or current_thread() is self:
+            queue.append(event)  # the world thread must never wait
+        elif self.overflow == DROP_OLDEST:
+            dropped = queue.append_drop(event)
+            if dropped is not None:
+                self.dropped += 1
+                if isinstance(dropped, PackedEvent):
+                    dropped = dropped.unpack()
+                if isinstance(dropped, Request):
+                    self._refuse(dropped)
+        elif self.overflow == BLOCK and block:
+            if not queue.put(event, self.block_timeout):
+                return False
+        elif not queue.offer(event):
+            return False
+        self.waker.wake()
+        return True
+
+    def _refuse(self, request, answer=True):
+        """Forget a request that does not fit in the queue, sending
+        a 503 response to its client when answer is True"""
+        key = request.key
+        timer = self.pending_timers.pop(key, None)
+        if timer is not None:
+            self.cancel_call(timer)
+        if answer and key in self.pending:
+            # dispatch_response will remove it from pending
+            response = request.answer(CODE_UNAVAILABLE, 'Service Unavailable')
+            self._enqueue(pack(response) if self.compact else response,
+                          bounded=False)
+        else:
+            self.pending.pop(key, None)
+
+    def queue_stats(self):
+        "Return the queue size, limit, high-water mark and counters"
+        stats = self.queue.stats()
+        stats.update(rejected=self.rejected, dropped=self.dropped)
+        return stats
+
+    def _arm_pending(self, request):
+        "(Re)start the expiration timer of a pending request"
+        key = request.key
+        start = max(time.time(), float(request.get(X_TIME, 0)))
+        timer = self.pending_timers.pop(key, None)
+        if timer is not None:
+            self.cancel_call(timer)
+        self.pending_timers[key] = self.call_at(start + self.pending_ttl,
+                                                self._evict, key)
+
+    def _evict(self, key):
+        "Expire a request that has not been answered in time"
+        if self.pending_timers.pop(key, None) is None:
+            return
+        request = self.pending.get(key)
+        if request is None:
+            return
+        self.evicted += 1
+        log.warn('Pending request %s expired', key)
+        if self.answer_expired:
+            # dispatch_response will remove it from pending
+            if isinstance(request, PackedEvent):
+                request = request.unpack()
+            self.push(request.answer(CODE_TIMEOUT, 'Gateway Timeout'))
+        else:
+            del self.pending[key]
+
+    def pending_stats(self):
+        "Return the size of the pending table and its counters"
+        return dict(size=len(self.pending), timers=len(self.pending_timers),
+                    evicted=self.evicted)
 
     def new(self, klass, *args, **kw):
         """Create a pair of worker / observer, attach them
@@ -93,73 +228,190 @@ class World(Thread):
         worker = klass(*args, **kw)
         self.workers[worker.hash_] = worker
         worker.world = self
+        self.router.add(worker)
         return worker
 
+    def remove(self, worker):
+        "Detach a worker from the world"
+        self.router.remove(worker)
+        self.workers.pop(worker.hash_, None)
+        worker.world = None
+
+    def start(self):
+        "Set the world RUNNING before its thread starts"
+        self.running = RUNNING
+        Thread.start(self)
+
     def run(self):
         log.info("RUN: %s", self)
-        end = time.time() + 60
-        self.running = RUNNING
-        self.check = self.now + self.timeout
+        if self.lifetime is not None:
+            self.end = time.time() + self.lifetime
+        if self.running == STOPPED:
+            self.running = RUNNING
+        if self.pool_size and self.executor is None:
+            self.executor = KeyedExecutor(self.pool_size,
+                                          name='%s-pool' % self.name)
         while self.running > STOPPED:
             self.now = time.time()
-            self.step()
-
-            if self.now > end:
+            if self.end is not None and self.now > self.end:
                 break
 
-            if self.now >= self.check:
-                log.debug('Checking housekeeping...')
-                self.check = self.now + self.timeout
+            deadline = self.next_deadline()
+            if deadline is not None and deadline <= self.now:
                 self._check_deferred()
 
+            self.step()
+
+        self._finish_batches()
+        self.waker.close()
         log.info("FINISH: %s", self)
 
     def step(self):
-        """Process the next event if worker is in RUNNING mode
+        """Process the next batch of events if worker is in RUNNING mode
         or performs a idle action when queue is empty"""
         if self.running > PAUSED:
-            if self.queue:
-                event = self.queue.pop(0)
-                if isinstance(event, Request):
-                    self.dispatch_request(event)
-                    if X_TIMEOUT in event or \
-                       X_REMAIN_EXECUTIONS in event:
-                        self._push_deferred(event)
-                    if event.response:
-                        # log.warn('sending response: %s',
-                        # event.response.dump())
-                        self.push(event.response)
-                else:  # Response
-                    self.dispatch_response(event)
+            batch = self.queue.drain(self.max_batch)
+            if batch:
+                for event in batch:
+                    self._dispatch(event)
+                if self.batches:
+                    self._flush_batches()
             else:
                 self.idle()
         else:
             log.info('%s is PAUSED', self)
-            time.sleep(self.relax)
+            self.waker.clear()
+            if self.running == PAUSED:
+                self._sleep()
+
+    def _dispatch(self, event):
+        "Deliver a single event to the workers"
+        if isinstance(event, PackedEvent):
+            event = event.unpack()
+        if isinstance(event, Request):
+            self.dispatch_request(event)
+            if X_TIMEOUT in event or \
+               X_REMAIN_EXECUTIONS in event:
+                self._push_deferred(event, self.repeat_interval)
+            if self.executor is None and event.response:
+                # log.warn('sending response: %s',
+                # event.response.dump())
+                self.push(event.response)
+        else:  # Response
+            self.dispatch_response(event)
 
     def idle(self):
-        """Performs an idle task. Should be overrrided."""
-        time.sleep(self.relax)
+        """Performs an idle task. Should be overrrided.
+        By default sleeps until an event is pushed, the next deferred
+        request is due or the world lifetime is over."""
+        self.waker.clear()
+        if self.queue or self.running < RUNNING:
+            return
+        self._sleep()
+
+    def _sleep(self):
+        "Sleep until woken up, the next deadline or the end of lifetime"
+        wakeup = self.next_deadline()
+        if self.end is not None:
+            wakeup = self.end if wakeup is None else min(wakeup, self.end)
+        if wakeup is not None:
+            self.waker.wait(wakeup - time.time())
+        else:
+            self.waker.wait()
+
+    def next_deadline(self):
+        """Return the time when next deferred request or scheduled
+        callback is due, or None"""
+        with self.deferred_lock:
+            deadlines = [self.deferred.next_deadline(),
+                         self.scheduled.next_deadline()]
+        deadlines = [d for d in deadlines if d is not None]
+        if deadlines:
+            return min(deadlines)
 
     def _check_deferred(self):
         """Check for any deferred request that mush be fired"""
         timeout = self.now
         log.debug('%s elements in deferred queue', len(self.deferred))
-        while self.deferred:
-            if self.deferred[0][X_TIME] <= timeout:
-                # TODO: re-hash he request?
-                event = self.deferred.pop(0)
-                if X_REMAIN_EXECUTIONS in event:
-                    counter = int(event[X_REMAIN_EXECUTIONS]) - 1
-                    if counter < 0:
-                        continue
-                    event[X_REMAIN_EXECUTIONS] = str(counter)
-
-                log.debug('moving %s to running queue', event.key)
-                self.push(event)
-                # self.queue.append(event)
-            else:
-                break
+        with self.deferred_lock:
+            batch = self.deferred.expire(timeout)
+            calls = self.scheduled.expire(timeout)
+        for event in batch:
+            self._fire(event)
+        for func, args in calls:
+            func(*args)
+
+    def _fire(self, event):
+        "Push a deferred request that is due"
+        # TODO: re-hash he request?
+        event.__dict__.pop('timer', None)
+        if X_REMAIN_EXECUTIONS in event:
+            counter = int(event[X_REMAIN_EXECUTIONS]) - 1
+            if counter < 0:
+                return
+            key = event.get(X_HASH)
+            event[X_REMAIN_EXECUTIONS] = str(counter)
+            self._follow(key, event)
+
+        log.debug('moving %s to running queue', event.key)
+        self.push(event)
+
+    def call_at(self, when, func, *args):
+        """Call func(*args) from the world thread at time 'when'.
+        Return a handle for cancel_call()"""
+        with self.deferred_lock:
+            handle = self.scheduled.push(when, (func, args))
+        self.waker.wake()
+        return handle
+
+    def cancel_call(self, handle):
+        "Cancel a call_at(). Return True if it was still pending"
+        with self.deferred_lock:
+            return self.scheduled.cancel(handle)
+
+    def expect(self, request, timeout=None):
+        """Return a Future resolved with the response of a request.
+        Register it before pushing the request."""
+        future = Future()
+        key = request.hash()
+        entry = self.futures[key] = [future, None, [key]]
+        if timeout is not None:
+            entry[1] = self.call_at(time.time() + timeout,
+                                    self._expire_future, entry, timeout)
+        return future
+
+    def _pop_future(self, key):
+        "Forget the future expecting a request key. Return its entry"
+        entry = self.futures.pop(key, None)
+        if entry is not None:
+            for alias in entry[2]:
+                self.futures.pop(alias, None)
+        return entry
+
+    def _expire_future(self, entry, timeout):
+        future, _, keys = entry
+        if self._pop_future(keys[0]) is not None:
+            future.set_exception(TimeoutError(
+                'No response for %s after %ss' % (keys[0], timeout)))
+
+    def _follow(self, key, event):
+        """A header of a request hashed as key has changed: let its
+        future, if any, also expect the response to the new hash"""
+        entry = self.futures.get(key)
+        if entry is not None:
+            new = event.hash()
+            if new not in entry[2]:
+                entry[2].append(new)
+                self.futures[new] = entry
+
+    def cancel(self, event):
+        """Cancel a deferred event so it will not be fired.
+        Return True if the event was waiting in the deferred queue."""
+        handle = event.__dict__.pop('timer', None)
+        if handle is not None:
+            with self.deferred_lock:
+                return self.deferred.cancel(handle)
+        return False
 
     def set(self, running):
         """Set the running state of worker:
@@ -169,32 +421,132 @@ class World(Thread):
         STOPPED: worker is done
         """
         self.running = running
+        self.waker.wake()
 
     def stop(self, timeout=5):
         "Stops the worker while trying to flush the queue"
         if self.running != STOPPED:
             # log.info('Stopping %s', self)
-            self.running = SWITCHING
+            self.set(SWITCHING)
             end = time.time() + timeout
-            while self.queue and time.time() < end:
+            while (self.queue or not self.idle_workers()) and \
+                  time.time() < end:
                 time.sleep(0.1)
 
-            self.running = STOPPED
+            self.set(STOPPED)
             self.join(timeout)
+            if self.executor is not None:
+                # drain the events already handed to workers
+                self.executor.shutdown(max(end - time.time(), 0.1))
+            self.waker.close()
             log.info('Stopped %s', self)
         else:
             log.info('Already Stopped %s', self)
 
     def dispatch_request(self, event):
-        "Process the event. Must be overriden."
-        for worker in self.workers.values():
-            worker.dispatch_request(event)
+        """Deliver the event to the workers that listen to it.
+        Each pool task gets its own copy, as the world thread may
+        change the event (deferred requests) while workers run"""
+        executor = self.executor
+        for worker in self.router.route(event.statusline):
+            if executor is None:
+                if worker.batch_size:
+                    self._collect(worker, event)
+                else:
+                    worker.dispatch_request(event)
+            elif worker.batch_size:
+                self._collect(worker, event.copy())
+            else:
+                executor.submit(worker.hash_, self._run_request,
+                                worker, event.copy())
+
+    def _run_request(self, worker, event):
+        "Run a request copy in the pool and send the worker answer, if any"
+        worker.dispatch_request(event)
+        response = event.__dict__.pop('response', None)
+        if response is not None:
+            self.push(response)
+
+    def _collect(self, worker, event):
+        """Add a request to the batch of a worker. The batch is delivered
+        when it is full, after worker.linger seconds or, when linger is
+        0, once the events drained in this step have been dispatched"""
+        batch = self.batches.get(worker.hash_)
+        if batch is None:
+            batch = self.batches[worker.hash_] = [worker, list()]
+            if worker.linger:
+                self.call_at(time.time() + worker.linger, self._flush_batch,
+                             worker.hash_, batch[1])
+        batch[1].append(event)
+        if len(batch[1]) >= worker.batch_size:
+            self._flush_batch(worker.hash_)
+
+    def _flush_batches(self):
+        "Deliver the batches of the workers that do not linger"
+        for hash_, (worker, events) in self.batches.items():
+            if not worker.linger:
+                self._flush_batch(hash_)
+
+    def _flush_batch(self, hash_, events=None):
+        "Deliver the batch of a worker, unless it is not the expected one"
+        batch = self.batches.get(hash_)
+        if batch is None or (events is not None and batch[1] is not events):
+            return
+        del self.batches[hash_]
+        worker, events = batch
+        if self.executor is None:
+            self._run_batch(worker, events)
+        else:
+            self.executor.submit(hash_, self._run_batch, worker, events)
+
+    def _finish_batches(self):
+        """Deliver the batches left when the world stops and dispatch
+        the answers they send, as no step() will drain them later"""
+        if not self.batches:
+            return
+        for hash_ in list(self.batches):
+            self._flush_batch(hash_)
+        if self.executor is not None:
+            self.executor.join(self.relax * 10)
+        requests = list()
+        for event in self.queue.drain():
+            stored = event
+            if isinstance(event, PackedEvent):
+                event = event.unpack()
+            if isinstance(event, Request):
+                requests.append(stored)  # left for the next run()
+            else:
+                self.dispatch_response(event)
+        for event in requests:
+            self.queue.append(event)
+
+    def _run_batch(self, worker, events):
+        "Run dispatch_batch and send the new answers"
+        previous = [event.response for event in events]
+        worker.dispatch_batch(events)
+        for event, before in zip(events, previous):
+            response = event.response
+            if response is not None and response is not before:
+                del event.__dict__['response']
+                self.push(response)
 
     def dispatch_response(self, event):
         "Process a response. Must be overriden."
 
         request = self.pending.pop(event[X_REQ_ID], None)
-        if request is None:
+        timer = self.pending_timers.pop(event[X_REQ_ID], None)
+        if timer is not None:
+            self.cancel_call(timer)
+        future, timer, _ = self._pop_future(event[X_REQ_ID]) or \
+            (None, None, None)
+        if future is not None:
+            if timer is not None:
+                self.cancel_call(timer)
+            if isinstance(request, PackedEvent):
+                request = request.unpack()
+            event.__dict__['request'] = request  # not a header
+            future.set_result(event)
+        elif request is None:
             log.error('%s Can not find associated resquest %s',
                       self, event.dump())
             log.warn('Pending request are: %s', self.pending.keys())
@@ -202,24 +554,156 @@ class World(Thread):
             log.debug('%s Found associated request: %s',
                       self, event[X_REQ_ID])
 
-            event.request = request
-            worker = self.workers.get(event[X_CLIENT])
-            worker.dispatch_response(event)
-
-    def _push_deferred(self, event):
+            if isinstance(request, PackedEvent):
+                request = request.unpack()
+            event.__dict__['request'] = request  # not a header
+            worker = self.workers.get(event.get(X_CLIENT))
+            if worker is None:
+                log.warn('%s No worker waits for response %s to %s',
+                         self, event.code, event[X_REQ_ID])
+            elif self.executor is None:
+                worker.dispatch_response(event)
+            else:
+                self.executor.submit(worker.hash_, worker.dispatch_response,
+                                     event)
+
+    def idle_workers(self):
+        "True when no event is waiting for or running in a worker"
+        return self.executor is None or self.executor.idle()
+
+    def depths(self):
+        "Return the number of events waiting for each busy worker hash"
+        if self.executor is None:
+            return dict()
+        return self.executor.depths()
+
+    def _push_deferred(self, event, interval=0):
+        """Defer a request by its X-Timeout, or by interval when it has
+        none, from its X-Time"""
         if int(event.get(X_REMAIN_EXECUTIONS, '1')) <= 0:
             log.warn('No more remain executions!')
             return
-        timeout = event[X_TIME] + event.get(X_TIMEOUT, 0)
+        timeout = float(event[X_TIME]) + float(event.get(X_TIMEOUT, interval))
+        key = event.get(X_HASH)
         event[X_TIME] = timeout
-        for i, msg in enumerate(self.deferred):
-            if timeout < msg[X_TIME]:
-                log.debug('insert into %s of deferred queue', i)
-                self.deferred.insert(i, event)
-                break
+        self._follow(key, event)
+        log.debug('push into deferred queue')
+        self._schedule(timeout, event)
+
+    def _schedule(self, deadline, event):
+        "Fire a deferred request at deadline"
+        with self.deferred_lock:
+            event.__dict__['timer'] = self.deferred.push(deadline, event)
+
+
+class AsyncWorld(World):
+    """A World driven by a Reactor instead of a sleeping loop.
+
+    Events pushed from any thread are handed to the reactor with
+    call_soon_threadsafe() and deferred requests are reactor timers.
+    Workers may implement dispatch_request as a generator coroutine
+    (see reactor.py), so thousands of workers can wait for I/O at the
+    same time in a single thread. The response they answer is sent
+    when the coroutine finishes.
+    """
+    def __init__(self, *args, **kw):
+        World.__init__(self, *args, **kw)
+        self.loop = Reactor()
+        self.waker.close()
+        self.waker = self.loop.waker
+
+    def _enqueue(self, event, block=True, bounded=True):
+        """Queue the event applying the World overflow policy, then
+        ask the reactor to dispatch it"""
+        if not World._enqueue(self, event, block, bounded):
+            return False
+        self.loop.call_soon_threadsafe(self._drain)
+        return True
+
+    def _schedule(self, deadline, event):
+        event.__dict__['timer'] = self.loop.call_at(deadline, self._fire,
+                                                    event)
+
+    def cancel(self, event):
+        handle = event.__dict__.pop('timer', None)
+        if handle is not None:
+            return self.loop.cancel(handle)
+        return False
+
+    def next_deadline(self):
+        with self.loop.lock:
+            return self.loop.timers.next_deadline()
+
+    def call_at(self, when, func, *args):
+        return self.loop.call_at(when, func, *args)
+
+    def cancel_call(self, handle):
+        return self.loop.cancel(handle)
+
+    def run(self):
+        log.info("RUN: %s", self)
+        if self.lifetime is not None:
+            self.end = time.time() + self.lifetime
+            self.loop.call_at(self.end, self._stop)
+        if self.running == STOPPED:
+            self.running = RUNNING
+        self.loop.run_forever()
+        log.info("FINISH: %s", self)
+
+    def _drain(self):
+        "Dispatch the queued events, unless PAUSED"
+        if self.running < RUNNING:
+            return
+        for event in self.queue.drain():
+            self._dispatch(event)
+        if self.batches:
+            self._flush_batches()
+
+    def _stop(self):
+        "Deliver the pending batches while the reactor runs, then stop it"
+        self._finish_batches()
+        self.loop.stop()
+
+    def set(self, running):
+        self.running = running
+        if running == RUNNING:
+            self.loop.call_soon_threadsafe(self._drain)
+        elif running == STOPPED:
+            self.loop.call_soon_threadsafe(self._stop)
+
+    def stop(self, timeout=5):
+        "Stops the reactor once the events already pushed are dispatched"
+        if self.running != STOPPED:
+            self.loop.call_soon_threadsafe(self._stop)
+            self.join(timeout)
+            self.running = STOPPED
+            self.loop.close()
+            log.info('Stopped %s', self)
         else:
-            log.debug('append to deferred queue')
-            self.deferred.append(event)
+            log.info('Already Stopped %s', self)
+
+    def dispatch_request(self, event):
+        """Deliver the event to the workers, running coroutine workers.
+        Each coroutine gets its own copy of the event, as it may still
+        be running when other workers answer or the event is deferred"""
+        for worker in self.router.route(event.statusline):
+            if worker.batch_size:
+                self._collect(worker, event)
+            elif isgeneratorfunction(worker.dispatch_request):
+                request = event.copy()
+                task = self.loop.spawn(worker.dispatch_request(request))
+                task.add_done_callback(partial(self._answered, request))
+            else:
+                worker.dispatch_request(event)
+
+    def _answered(self, request, task):
+        "Send the response of a coroutine worker when it finishes"
+        if task.exception() is not None:
+            log.error('Worker failed on %s: %r', request.statusline,
+                      task.exception())
+        response = request.response
+        if response is not None:
+            self.push(response)
 
 
 class Worker(object):
@@ -236,12 +720,23 @@ class Worker(object):
 
         self.response_callbacks = list()
 
+        # set batch_size > 0 to receive requests in dispatch_batch(),
+        # waiting up to linger seconds for a batch to be full
+        self.batch_size = 0
+        self.linger = 0.0
+
         log.info('New Worker at: %s', self)
 
     def dispatch_request(self, event):
         "Process the event. Must be overriden."
         log.info('Must be overriden: %s', event.dump())
 
+    def dispatch_batch(self, events):
+        """Process a batch of requests, when batch_size is set.
+        May be overriden to amortize the cost of each request."""
+        for event in events:
+            self.dispatch_request(event)
+
     def dispatch_response(self, event):
         "Process a response. Must be overriden."
         log.warn('ATTENDIND RESPONSE: %s from %s', event, event.request)
@@ -251,9 +746,15 @@ class Worker(object):
                 log.warn('--> %s', func)
                 func(event)
 
-    def send(self, event):
-        "Send an event to the world"
+    def send(self, event, future=False, timeout=None):
+        """Send an event to the world. When future is True return a
+        Future resolved with the response, instead of running the
+        response handlers. It fails with TimeoutError after timeout."""
+        result = None
+        if future:
+            result = self.world.expect(event, timeout)
         self.world.push(event)
+        return result
 
     def new_request(self, **kw):
         "Create a this-worker specific Request"
@@ -271,14 +772,21 @@ class Worker(object):
         allrules = u'|'.join(['(%s)' % s for s in self.rules])
         self.regexp = re.compile(allrules,
                                  re.DOTALL | re.I | re.UNICODE)
+        if self.world is not None:
+            self.world.router.update(self)
 
     def unlisten(self, rule):
         "remove a rule and rebuild the full regexp"
         self.rules.remove(rule)
         # build a single regexp that match all rules
-        allrules = u'|'.join(['(%s)' % s for s in self.rules])
+        if self.rules:
+            allrules = u'|'.join(['(%s)' % s for s in self.rules])
+        else:
+            allrules = 'invalid^.{1000,}$'
         self.regexp = re.compile(allrules,
                                  re.DOTALL | re.I | re.UNICODE)
+        if self.world is not None:
+            self.world.router.update(self)
 
     # response handlers
     def add_response_handler(self, regexp, func):
@@ -325,6 +833,7 @@ class Layout(dict):
         self.nodeid = nodeid
         self.workerid = workerid
         self.pid_file = None
+        self.registry = None
 
     def setup(self):
         "create the initial worker setup"
@@ -335,6 +844,7 @@ class Layout(dict):
         inbox = self['inbox'] = expath(home, 'inbox')
 
         self['pid_file'] = expath(home, 'worker.pid')
+        self['registry'] = expath(node_home, 'workers.idx')
 
         for key, path in self.items():
             if '.' in os.path.basename(path):  # ignore regular files
@@ -345,14 +855,33 @@ class Layout(dict):
                 os.makedirs(path)
 
     def update_pid_file(self):
-        """Stamp pid and time info in pid_file."""
+        """Stamp pid and time info in pid_file and the registry."""
         info = '%s %s' % (os.getpid(), time.time())
         file(self['pid_file'], 'wt').write(info)
-
-    def get_worker_status(self):
-        "return all know worker status"
+        self.get_registry().heartbeat(self.workerid)
+
+    def inbox_log(self, key='inbox', **kw):
+        "Open the InboxLog rooted at the inbox folder of worker or node"
+        return InboxLog(self[key], **kw)
+
+    def get_registry(self):
+        """Open the registry of the node workers, filling it from the pid
+        files of the workers started before it existed"""
+        if self.registry is None:
+            path = self['registry']
+            fresh = not os.path.exists(path)
+            self.registry = WorkerRegistry(path)
+            if fresh:
+                for workerid, info in self.scan_pid_files().items():
+                    self.registry.register(workerid, info.pid, info.timeout)
+        return self.registry
+
+    def scan_pid_files(self):
+        "return the status found walking the pid files of node_home"
         status = {}
         for root, folders, files in os.walk(self['node_home']):
+            # skip the homes claimed by clean_dead()
+            folders[:] = [f for f in folders if not f.endswith(CLAIMED_EXT)]
             for name in files:
                 if name in ('worker.pid', ):
                     path = os.path.join(root, name)
@@ -368,22 +897,63 @@ class Layout(dict):
                         print why
         return status
 
+    def get_worker_status(self):
+        "return all know worker status"
+        return dict((workerid, WorkerStatus(*info)) for workerid, info
+                    in self.get_registry().status().items())
+
     def clean_dead(self):
-        "clean dead workers directories"
-        died = dead(self.get_worker_status())
+        """Remove the homes of the dead workers, moving the events they
+        did not consume to the node inbox. A home is claimed with an
+        atomic rename first, so concurrent cleaners never move it twice"""
+        registry = self.get_registry()
+        for workerid in dead(self.get_worker_status()):
+            home = expath(self['node_home'], workerid)
+            claimed = home + CLAIMED_EXT
+            try:
+                os.rename(home, claimed)
+            except OSError:
+                if not os.path.exists(claimed):
+                    registry.remove(workerid)  # no home left to clean
+                continue  # else being cleaned by another process
+            try:
+                self._move_inbox(expath(claimed, 'inbox'), workerid)
+            except Exception, why:
+                log.error('Can not move the inbox of %s: %s', workerid, why)
+                continue
+            registry.remove(workerid)
+            shutil.rmtree(claimed)
+
+    def _move_inbox(self, inbox, workerid):
+        "Move the messages of a dead worker to the node inbox"
+        if is_log(inbox):
+            self._move_log(inbox, workerid)
+            return
+        for root, folders, files in os.walk(inbox):
+            for name in files:
+                os.rename(expath(root, name),
+                          expath(self['node_inbox'], name))
+
+    def _move_log(self, inbox, workerid):
+        """Write the events of a dead worker log not consumed yet as a
+        message file of the node inbox, read by its InboxFeeders"""
+        orphan = InboxLog(inbox, readonly=True)
         try:
-            for workerid in died:
-                home = expath(self['node_home'], workerid, )
-                inbox = expath(home, 'inbox')
-                for root, folders, files in os.walk(inbox):
-                    for name in files:
-                        os.rename(expath(root, name),
-                                  expath(self['node_inbox'], name))
-
-                shutil.rmtree(home)
-
-        except Exception, why:
-            print why
+            offset = min(orphan.checkpoints().values() or [0])
+            events, _ = orphan.scan(offset)
+        finally:
+            orphan.close()
+        if not events:
+            return
+        buf = bytearray()
+        for _, event in events:
+            SERIALIZER.write(event, buf)
+        path = expath(self['node_inbox'], workerid)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
 
 
 # End
@@ -31,4 +31,21 @@ class EvalWorker(Worker):
         answer.body = unicode(result)
         log.info(answer.dump())
 
+
+class BatchEvalWorker(Worker):
+    "A server agent that evaluates a batch of requests at once"
+
+    def __init__(self, batch_size=16, linger=0.0):
+        Worker.__init__(self)
+        self.batch_size = batch_size
+        self.linger = linger
+        self.sizes = []
+
+    def dispatch_batch(self, events):
+        self.sizes.append(len(events))
+        code = compile('[%s]' % ', '.join(e.body for e in events),
+                       '<batch>', 'eval')
+        for event, result in zip(events, eval(code)):
+            event.answer().body = unicode(result)
+
 # End
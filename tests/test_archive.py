@@ -0,0 +1,81 @@
+"""Test archives of recorded events"""
+import os
+from itertools import izip
+
+from swarmforce.http import Request, Response, populate, X_HASH
+from swarmforce.archive import Archive, parse_many, write_many
+
+
+def recorded(n):
+    "Create n random hashed messages"
+    events = []
+    for i in range(n):
+        msg = Request() if i % 2 else Response(code='200', result='OK')
+        populate(msg)
+        if i % 5 == 0:
+            msg.body = u''
+            del msg['Content-Length']
+        msg.hash()
+        events.append(msg)
+    return events
+
+
+def test_parse_many(tmpdir):
+    "Messages are read back lazily in the same order"
+    path = str(tmpdir.join('events.log'))
+    events = recorded(50)
+    write_many(path, events[:20])
+    write_many(path, events[20:])
+
+    keys = []
+    for record, event in izip(parse_many(path), events):
+        keys.append(record.key)
+        assert record.headers.body == u''  # body is not loaded yet
+        assert record.body == event.body
+        assert record.event.sane()
+        assert record.event.hash() == event[X_HASH]
+    assert keys == [e[X_HASH] for e in events]
+
+
+def test_index_lookup(tmpdir):
+    "The sidecar index gives random access by X-Hash"
+    path = str(tmpdir.join('events.log'))
+    events = recorded(30)
+    write_many(path, events)
+
+    assert len(list(parse_many(path, index=True))) == 30
+    assert os.path.exists(path + '.idx')
+
+    archive = Archive(path)
+    for event in reversed(events):
+        record = archive.lookup(event[X_HASH])
+        assert record.event.hash() == event[X_HASH]
+        assert record.body == event.body
+    assert archive.lookup('0' * 40) is None
+    assert archive.lookup('f' * 40) is None
+    archive.close()
+
+
+def test_stale_index(tmpdir):
+    "The index is built again when the archive has grown"
+    path = str(tmpdir.join('events.log'))
+    events = recorded(10)
+    write_many(path, events[:5])
+    Archive(path).build_index()
+    write_many(path, events[5:])
+
+    archive = Archive(path)
+    assert archive.lookup(events[-1][X_HASH]).body == events[-1].body
+    assert archive.lookup(events[0][X_HASH]).body == events[0].body
+    archive.close()
+
+
+def test_empty_archive(tmpdir):
+    "An empty file is a valid archive"
+    path = str(tmpdir.join('empty.log'))
+    open(path, 'w').close()
+    assert list(parse_many(path)) == []
+    assert Archive(path).lookup('0' * 40) is None
+
+
+# End
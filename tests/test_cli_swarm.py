@@ -4,15 +4,17 @@ import os
 import hashlib
 import pytest
 import subprocess
+from ConfigParser import RawConfigParser
 
 from swarmforce.misc import expath
 from swarmforce.swarm import World, Worker, \
      MAX_HASH, hash_range, RUNNING, PAUSED
 from swarmforce.http import Event, Request, Response, \
-     X_TIME, X_REMAIN_EXECUTIONS
+     X_TIME, X_REMAIN_EXECUTIONS, SERIALIZER
 from swarmforce.misc import until
 from demo_workers import Boss, EvalWorker
 from swarmforce.loggers import getLogger, setup_logging
+from swarmforce.cli.sf import my_setup_hook, watch_inboxes, unwatch_inboxes
 
 from loganalizer.main import get_files_fmt, MultiParser
 
@@ -65,4 +67,40 @@ def test_connect_swarm(clean_logs,  world, log_now):
     foo = 1
 
 
+class Meta(object):
+    config_files = []
+
+
+class DaemonApp(object):
+    "The parts of a SwarmForce app used by the setup hook and inboxes"
+    _meta = Meta()
+
+    def __init__(self, root, worker_classes):
+        self.config = RawConfigParser()
+        self.config.add_section('swarmforce')
+        self.config.set('swarmforce', 'root', root)
+        self.config.set('swarmforce', 'worker_classes', worker_classes)
+        self.log = log
+
+
+def test_inbox_reaches_worker(tmpdir):
+    """a message file dropped in the inbox of a daemon is served by
+    the workers of its process"""
+    app = DaemonApp(str(tmpdir),
+                    'swarmforce.tests.demo_workers.EvalWorker DO /inbox/eval')
+    my_setup_hook(app)
+    assert len(app.world.workers) == 1
+    watch_inboxes(app)
+    try:
+        req = Request(method='DO', path='/inbox/eval', body=u'6 * 7')
+        future = app.world.expect(req)
+        tmp = os.path.join(app.layout['inbox'], 'msg.tmp')
+        file(tmp, 'wb').write(SERIALIZER.write(req, bytearray()))
+        os.rename(tmp, tmp[:-4])
+        assert future.result(5).body == u'42'
+        until("not os.listdir(app.layout['inbox'])", timeout=1)
+    finally:
+        unwatch_inboxes(app)
+
+
 # End
@@ -0,0 +1,97 @@
+"""Test outbound connection pool module"""
+import time
+import pytest
+
+from swarmforce.swarm import World, PAUSED, RUNNING
+from swarmforce.http import Request
+from swarmforce.misc import until
+from swarmforce.reactor import gather
+from swarmforce.transport import Transport
+from swarmforce.connpool import ConnectionPool
+from swarmforce.tests.demo_workers import EvalWorker
+
+NODE = 'a' * 40
+
+
+@pytest.fixture(scope="function")
+def server(request):
+    "Provide a world answering eval requests through a Transport"
+    world = World()
+    world.start()
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    transport = Transport(world)
+    transport.listen()
+    transport.start()
+
+    def fin():
+        transport.stop()
+        world.stop()
+
+    request.addfinalizer(fin)
+    return transport
+
+
+@pytest.fixture(scope="function")
+def client(request):
+    transport = Transport()
+    transport.start()
+    request.addfinalizer(transport.stop)
+    return transport
+
+
+def test_multiplexing(server, client):
+    "requests spread over up to max_size pipelined connections"
+    pool = ConnectionPool(client, min_size=1, max_size=3, max_inflight=10,
+                          idle_timeout=0, interval=3600)
+    pool.register(NODE, server.address)
+    server.world.set(PAUSED)
+    time.sleep(0.1)
+
+    futures = []
+    for i in range(100):
+        req = Request(method='DO', path='/inbox/eval', body=u'%s' % i)
+        futures.append(pool.send(NODE, req))
+
+    stats = pool.stats()[NODE]
+    assert stats['size'] == stats['opened'] == 3
+    assert stats['inflight'] == 100
+    assert stats['busy'] == 3
+    assert stats['utilization'] > 1
+
+    server.world.set(RUNNING)
+    responses = gather(futures).result(5)
+    assert [r.body for r in responses] == [u'%s' % i for i in range(100)]
+
+    pool.maintain()  # reap idle connections down to min_size
+    stats = pool.stats()[NODE]
+    assert (stats['size'], stats['reaped'], stats['inflight']) == (1, 2, 0)
+    pool.stop()
+
+
+def test_health_checks(server, client):
+    "dead connections are detected and replaced"
+    pool = ConnectionPool(client, min_size=2, max_size=2, interval=0,
+                          idle_timeout=3600, health_timeout=1)
+    pool.register(NODE, server.address)
+    pool.maintain()
+    assert pool.stats()[NODE]['size'] == 2
+
+    pool.maintain()  # pings the idle connections
+    conns = list(pool.nodes[NODE].connections)
+    until("all(f.done() for f, t in pool.nodes[NODE].pings.values())",
+          timeout=1)
+    pool.maintain()
+    assert pool.nodes[NODE].connections == conns
+    assert pool.stats()[NODE]['failed'] == 0
+
+    server.stop()
+    until("all(c.closed for c in conns)", timeout=2)
+    pool.maintain()
+    stats = pool.stats()[NODE]
+    assert stats['size'] == 0
+    assert stats['closed'] == 2
+    assert stats['failed'] >= 1  # can not reconnect
+    pool.stop()
+
+
+# End
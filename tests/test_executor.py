@@ -0,0 +1,72 @@
+"""Test keyed thread pool executor module"""
+import time
+from threading import Event as Flag, current_thread
+
+from swarmforce.executor import KeyedExecutor
+
+
+def test_order_per_key():
+    "Tasks of the same key run in submission order, one at a time"
+    executor = KeyedExecutor(4, batch=3)
+    done = dict()
+    threads = dict()
+
+    def task(key, i):
+        done.setdefault(key, []).append(i)
+        threads.setdefault((key, i), current_thread().name)
+
+    for i in range(200):
+        for key in 'abcdef':
+            executor.submit(key, task, key, i)
+
+    assert executor.join(5)
+    assert sorted(done) == list('abcdef')
+    for key in done:
+        assert done[key] == range(200)
+    assert len(set(threads.values())) > 1
+    executor.shutdown()
+
+
+def test_depths():
+    "A slow key does not block other keys and its backlog is visible"
+    executor = KeyedExecutor(2)
+    gate = Flag()
+    done = []
+
+    executor.submit('slow', gate.wait)
+    for i in range(5):
+        executor.submit('slow', done.append, ('slow', i))
+    executor.submit('fast', done.append, ('fast', 0))
+
+    time.sleep(0.1)
+    assert done == [('fast', 0)]
+    assert executor.depth('slow') == 5
+    assert executor.depths() == {'slow': 5}
+    assert not executor.idle()
+
+    gate.set()
+    assert executor.join(2)
+    assert executor.depths() == {}
+    executor.shutdown()
+
+
+def test_shutdown_drains():
+    "shutdown() runs every submitted task before stopping the threads"
+    executor = KeyedExecutor(2)
+    done = []
+    for i in range(50):
+        executor.submit(i % 3, time.sleep, 0.001)
+        executor.submit(i % 3, done.append, i)
+
+    assert executor.shutdown(5)
+    assert sorted(done) == range(50)
+    assert not any(t.is_alive() for t in executor.threads)
+    try:
+        executor.submit(0, done.append, 0)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'submit must fail after shutdown'
+
+
+# End
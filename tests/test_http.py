@@ -1,7 +1,8 @@
 """Test HTTP message parsing module"""
 import types
 from io import StringIO
-from swarmforce.http import Event, populate, parse, Request, Response, X_HASH
+from swarmforce.http import Event, populate, parse, Request, Response, \
+     X_HASH, SERIALIZER, StreamParser, PackedEvent, pack
 
 
 def test_init():
@@ -105,6 +106,148 @@ def test_dump():
     assert msg1 == msg1, "Malformed message"
 
 
+def legacy_dump(msg, exclude_headers=None):
+    "Event.dump as it was written before the Serializer engine"
+    lines = [msg.statusline_fmt % msg]
+    excluded = set(['method', 'path', 'http-version',
+                    'body', 'code', 'result'])
+    if exclude_headers:
+        excluded.update(exclude_headers)
+
+    body = msg.body
+    if body:
+        msg['Content-Length'] = len(body)
+
+    keys = list(excluded.symmetric_difference(msg.keys()))
+    keys.sort()
+    for key in keys:
+        if key in msg:
+            lines.append('%s: %s' % (key, msg[key]))
+
+    if body:
+        lines.append('')
+        lines.append(body)
+    return '\n'.join(lines)
+
+
+def test_serializer_forms():
+    "dump() is unchanged, canonical() hashes the same, wire() round-trips"
+    for klass in (Request, Response, Request):
+        msg = klass(code='200', result='OK')
+        populate(msg)
+        if klass is Response:
+            msg['body'] = ''
+            del msg['Content-Length']
+        msg.hash()
+
+        copy = klass(**msg)
+        assert msg.dump() == legacy_dump(copy)
+        assert msg.dump([X_HASH]) == legacy_dump(copy, [X_HASH])
+        assert SERIALIZER.canonical(msg) == legacy_dump(copy, [X_HASH])
+
+        raw = SERIALIZER.wire(msg)
+        assert raw == str(SERIALIZER.write(msg, bytearray()))
+        assert '\r\n\r\n' in raw
+        other = parse(raw)
+        assert isinstance(other, klass)
+        assert other.sane()
+        assert other.hash() == msg[X_HASH]
+
+    msg = Request(method='GET', path='/x', body=u'abc')
+    assert SERIALIZER.canonical(msg) == legacy_dump(Request(**msg), [X_HASH])
+    assert 'Content-Length' not in msg
+
+
+def test_stream_parser():
+    "Messages are parsed from any split of a pipelined stream"
+    messages = []
+    for i in range(20):
+        msg = Request() if i % 3 else Response(code='404', result='Not Found')
+        populate(msg)
+        if i % 4 == 0:
+            msg.body = u''
+            del msg['Content-Length']
+        msg.hash()
+        messages.append(msg)
+
+    raw = ''.join(SERIALIZER.wire(msg) for msg in messages)
+    for size in (1, 7, 100, 1000, len(raw)):
+        parser = StreamParser()
+        parsed = []
+        for i in range(0, len(raw), size):
+            parsed.extend(parser.feed(memoryview(raw)[i:i + size]))
+
+        assert parser.pending() == 0
+        assert [m[X_HASH] for m in parsed] == [m[X_HASH] for m in messages]
+        assert all(m.sane() for m in parsed)
+        assert [type(m) for m in parsed] == [type(m) for m in messages]
+
+
+def test_stream_parser_legacy():
+    "dump() output, that may lack the final blank line, is parsed on close"
+    msg = Request()
+    populate(msg)
+    msg.body = u''
+    del msg['Content-Length']
+    parser = StreamParser()
+    assert parser.feed(msg.dump()) == []
+    parsed = parser.close()
+    assert len(parsed) == 1
+    assert parsed[0].path == msg.path
+
+
+def test_non_ascii_body():
+    "Content-Length counts utf-8 bytes whatever the path taken"
+    body = u'caf\xe9 \u20ac'
+    length = len(body.encode('utf-8'))
+    msg = Request(method='POST', path='/x', body=body)
+    msg.hash()
+
+    raw = SERIALIZER.wire(msg)
+    assert 'Content-Length: %s\r\n' % length in raw
+    assert 'Content-Length: %s\n' % length in SERIALIZER.canonical(msg)
+
+    parsed = StreamParser().feed(raw)
+    assert len(parsed) == 1
+    assert parsed[0].body == body
+    assert parsed[0].hash() == msg[X_HASH]
+
+    text = msg.dump()
+    assert msg['Content-Length'] == length
+    other = parse(text)
+    assert other.body == body
+    assert int(other['Content-Length']) == length
+    assert other.hash() == msg[X_HASH]
+
+
+def test_packed_event():
+    "A packed event reads like a dict and unpacks to an equal Event"
+    for msg in (Request(), Response(code='200', result='OK')):
+        populate(msg)
+        msg.hash()
+        packed = pack(msg)
+        assert isinstance(packed, PackedEvent)
+        assert pack(packed) is packed
+
+        assert packed == msg
+        assert sorted(packed.keys()) == sorted(msg.keys())
+        assert packed['http-version'] == msg['http-version']
+        assert packed.get('Missing', 1) == 1
+        assert 'code' not in packed or isinstance(msg, Response)
+        assert packed.Host == msg.Host
+        assert packed.statusline == msg.statusline
+        assert packed.key == msg.key
+        assert packed.dump() == msg.dump()
+
+        other = packed.unpack()
+        assert type(other) is type(msg)
+        assert other == msg
+        assert other.hash() == msg[X_HASH]
+
+    twin = Response(**msg)
+    assert pack(twin).headers is packed.headers  # shared header names
+
+
 def test_hash():
     "Test message hashing"
 
@@ -116,6 +259,31 @@ def test_hash():
     assert len(msg1[X_HASH]) == 40
 
 
+def test_hash_cache():
+    "Hash is only computed again when a hashed header changes"
+    msg = Request()
+    populate(msg)
+    hash_1 = msg.hash()
+    footprint = msg.footprint()
+
+    assert msg.key == hash_1
+    assert msg.sane()
+    assert msg.footprint() is footprint
+
+    msg[X_HASH] = hash_1  # does not count for the hash
+    assert msg.footprint() is footprint
+
+    msg.body = 'another body'
+    assert msg.footprint() is not footprint
+    assert not msg.sane()
+
+    hash_2 = msg.hash()
+    assert hash_2 != hash_1
+    del msg['Accept-Language']
+    assert msg.hash() != hash_2
+    assert msg.sane()
+
+
 def test_key():
     "Test message key"
 
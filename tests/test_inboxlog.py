@@ -0,0 +1,133 @@
+"""Test segmented inbox log module"""
+import os
+from threading import Thread
+
+from swarmforce.swarm import Layout
+from swarmforce.http import Request
+from swarmforce.inboxlog import InboxLog, segment_bases
+from swarmforce.inboxwatch import read_messages, CLAIMED_EXT
+
+
+def request(i):
+    return Request(method='DO', path='/inbox/%s' % i, body=u'event %s' % i)
+
+
+def test_segments(tmpdir):
+    "events are read back in order across segments and reopening"
+    root = str(tmpdir.join('inbox'))
+    inbox = InboxLog(root, segment_size=500)
+    offsets = [inbox.append(request(i)) for i in range(20)]
+    assert len(segment_bases(root)) > 3
+    assert offsets == sorted(offsets)
+
+    events, end = inbox.scan()
+    assert [e.path for _, e in events] == ['/inbox/%s' % i for i in range(20)]
+    assert [o for o, _ in events] == offsets
+    assert end == inbox.head
+    inbox.close()
+
+    inbox = InboxLog(root, segment_size=500)
+    inbox.append(request(20))
+    assert len(inbox.scan(offsets[-1])[0]) == 2
+    inbox.close()
+
+
+def test_consumer_checkpoint(tmpdir):
+    "a consumer resumes after the last offset it committed"
+    root = str(tmpdir.join('inbox'))
+    inbox = InboxLog(root, segment_size=500)
+    inbox.extend([request(i) for i in range(10)])
+
+    consumer = inbox.consumer('worker')
+    assert [e.path for e in consumer.poll(3)] == \
+        ['/inbox/0', '/inbox/1', '/inbox/2']
+    consumer.commit()
+    consumer.poll(2)
+    consumer.rewind()  # crash before commit
+
+    reader = InboxLog(root, readonly=True).consumer('worker')
+    assert [e.path for e in reader.poll()] == \
+        ['/inbox/%s' % i for i in range(3, 10)]
+    assert reader.poll() == []
+    inbox.append(request(10))
+    assert [e.path for e in reader.poll()] == ['/inbox/10']
+    reader.commit()
+
+    # segments read by every consumer are removed
+    before = len(segment_bases(root))
+    assert inbox.compact() == before - 1
+    assert segment_bases(root) == [inbox.base]
+    assert [e.path for e in inbox.consumer('worker').poll()] == []
+    assert [e.path for e in inbox.consumer('late').poll()][-1] == \
+        '/inbox/10'
+    inbox.close()
+
+
+def test_recover_torn_write(tmpdir):
+    "a message half written by a crash is truncated on open"
+    root = str(tmpdir.join('inbox'))
+    inbox = InboxLog(root)
+    inbox.append(request(0))
+    end = inbox.head
+    os.write(inbox.fd, 'DO /inbox/1 HTTP/1.1\r\nContent-Le')
+    inbox.close()
+
+    inbox = InboxLog(root)
+    assert inbox.head == end
+    inbox.append(request(1))
+    assert [e.path for _, e in inbox.scan()[0]] == ['/inbox/0', '/inbox/1']
+    inbox.close()
+
+
+def test_group_commit(tmpdir):
+    "concurrent writers share fsync calls"
+    inbox = InboxLog(str(tmpdir.join('inbox')), commit_delay=0.002)
+    N, M = 8, 20
+
+    def writer(n):
+        for i in range(M):
+            inbox.append(request(n * M + i))
+
+    threads = [Thread(target=writer, args=(n, )) for n in range(N)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert inbox.synced == inbox.head
+    assert inbox.syncs < N * M
+    assert len(inbox.scan()[0]) == N * M
+    inbox.close()
+
+
+def test_clean_dead(tmpdir):
+    """the events a dead worker did not consume go to the node inbox
+    as a message file, moved only once by concurrent cleaners"""
+    layout = Layout(str(tmpdir), 'node', 'worker')
+    layout.setup()
+    file(layout['pid_file'], 'wt').write('999999999 0')  # long dead
+    layout.get_registry()
+
+    inbox = layout.inbox_log()
+    inbox.extend([request(i) for i in range(5)])
+    consumer = inbox.consumer('worker')
+    consumer.poll(2)
+    consumer.commit()
+    inbox.close()
+
+    other = Layout(str(tmpdir), 'node', 'other')
+    other.setup()
+    os.rename(layout['home'], layout['home'] + CLAIMED_EXT)
+    other.clean_dead()  # being cleaned by someone else
+    assert os.listdir(layout['node_inbox']) == []
+    os.rename(layout['home'] + CLAIMED_EXT, layout['home'])
+
+    layout.clean_dead()
+    other.clean_dead()
+    assert not os.path.exists(layout['home'])
+    assert os.listdir(layout['node_inbox']) == ['worker']
+    moved = read_messages(os.path.join(layout['node_inbox'], 'worker'))
+    assert [e.path for e in moved] == ['/inbox/%s' % i for i in range(2, 5)]
+    assert 'worker' not in layout.get_registry().status()
+
+
+# End
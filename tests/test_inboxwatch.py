@@ -0,0 +1,121 @@
+"""Test inbox feeder module"""
+import os
+
+import pytest
+
+from swarmforce.swarm import World, PAUSED, RUNNING
+from swarmforce.queues import REJECT
+from swarmforce.http import Request, SERIALIZER
+from swarmforce.inboxwatch import InboxFeeder, read_messages, CLAIMED_EXT
+from swarmforce.misc import until
+from swarmforce.tests.demo_workers import EvalWorker
+
+
+@pytest.fixture(scope="function")
+def world(request):
+    world = World()
+    world.start()
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    request.addfinalizer(world.stop)
+    return world
+
+
+def drop(inbox, name, *events):
+    "Write events in a file and move it into inbox, as writers should"
+    buf = bytearray()
+    for event in events:
+        event.hash()
+        SERIALIZER.write(event, buf)
+    tmp = os.path.join(inbox, name + '.tmp')
+    file(tmp, 'wb').write(buf)
+    path = os.path.join(inbox, name)
+    os.rename(tmp, path)
+    return path
+
+
+def ask(i):
+    return Request(method='DO', path='/inbox/eval', body=u'%s * 2' % i)
+
+
+def test_scan_and_notify(world, tmpdir):
+    "files found on start and files notified later are consumed"
+    inbox = str(tmpdir.mkdir('inbox'))
+    old = [ask(i) for i in range(3)]
+    drop(inbox, 'old', *old)
+    futures = [world.expect(req) for req in old]
+
+    feeder = InboxFeeder(world, [inbox], linger=0.01)
+    feeder.start()
+    assert [f.result(5).body for f in futures] == [u'0', u'2', u'4']
+
+    new = [ask(i) for i in range(3, 10)]
+    futures = [world.expect(req) for req in new]
+    for i, req in enumerate(new):
+        feeder.notify(drop(inbox, 'new%s' % i, req))
+    feeder.notify(drop(inbox, 'ignored.tmp', ask(0)))
+    assert [f.result(5).body for f in futures] == \
+        [u'%s' % (i * 2) for i in range(3, 10)]
+
+    feeder.stop()
+    assert os.listdir(inbox) == ['ignored.tmp']
+    assert feeder.files == 8 and feeder.events == 10
+    assert feeder.batches < feeder.files  # notifications were coalesced
+
+
+def test_quarantine(world, tmpdir):
+    "a file that can not be parsed is put aside and the feeder goes on"
+    inbox = str(tmpdir.mkdir('inbox'))
+    feeder = InboxFeeder(world, [inbox], linger=0.01)
+    feeder.start()
+    bad = os.path.join(inbox, 'junk')
+    file(bad, 'wb').write('junk\r\n\r\n')
+    feeder.notify(bad)
+    until("feeder.bad == 1", timeout=1)
+    assert feeder.is_alive()
+    assert os.listdir(os.path.join(inbox, 'quarantine')) == ['junk']
+
+    req = ask(4)
+    future = world.expect(req)
+    feeder.notify(drop(inbox, 'good', req))
+    assert future.result(5).body == u'8'
+    feeder.notify(drop(inbox, 'other' + CLAIMED_EXT, ask(5)))  # not ours
+    feeder.stop()
+    assert sorted(os.listdir(inbox)) == ['other' + CLAIMED_EXT, 'quarantine']
+
+
+def test_refused(world, tmpdir):
+    "a file is only removed when the world accepts all its messages"
+    inbox = str(tmpdir.mkdir('inbox'))
+    world.set(PAUSED)
+    world.queue.maxlen = 2
+    world.overflow = REJECT
+    requests = [ask(i) for i in range(3)]
+    futures = [world.expect(req) for req in requests]
+    path = drop(inbox, 'msg', *requests)
+
+    feeder = InboxFeeder(world, [inbox], linger=0.01)
+    feeder.start()
+    until("feeder.refused", timeout=1)
+    assert os.listdir(inbox) == ['msg']
+    assert [e.body for e in read_messages(path)] == [u'2 * 2']
+
+    world.queue.maxlen = None
+    world.set(RUNNING)
+    assert [f.result(5).body for f in futures] == [u'0', u'2', u'4']
+    until("not os.listdir(inbox)", timeout=1)
+    feeder.stop()
+    assert feeder.files == 1 and feeder.events == 3
+
+
+def test_partial_file(tmpdir):
+    "a file still being written is not consumed"
+    path = str(tmpdir.join('msg'))
+    data = str(SERIALIZER.write(ask(1), bytearray()))
+    file(path, 'wb').write(data[:-3])
+    assert read_messages(path) is None
+    file(path, 'wb').write(data + '\r\n')
+    assert [e.body for e in read_messages(path)] == [u'1 * 2']
+    assert read_messages(str(tmpdir.join('missing'))) is None
+
+
+# End
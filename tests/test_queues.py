@@ -0,0 +1,129 @@
+"""Test event queues module"""
+import time
+from threading import Thread
+
+from swarmforce.queues import RunQueue, FairQueue
+from swarmforce.http import Request, X_CLIENT, X_PRIORITY
+
+
+def test_fifo_order():
+    "Events come out in the same order they were pushed"
+    queue = RunQueue()
+    for i in range(10):
+        queue.append(i)
+
+    assert len(queue) == 10
+    assert queue.pop() == 0
+    assert queue.drain() == range(1, 10)
+    assert not queue
+
+
+def test_drain_batch():
+    "drain() never returns more than max_batch events"
+    queue = RunQueue()
+    for i in range(100):
+        queue.append(i)
+
+    batches = []
+    while queue:
+        batches.append(queue.drain(30))
+
+    assert [len(b) for b in batches] == [30, 30, 30, 10]
+    assert sum(batches, []) == range(100)
+
+
+def test_concurrent_producers():
+    "Many threads can push at the same time without losing events"
+    queue = RunQueue()
+    N, M = 8, 5000
+
+    def producer(n):
+        for i in xrange(M):
+            queue.append((n, i))
+
+    threads = [Thread(target=producer, args=(n, )) for n in range(N)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    events = queue.drain()
+    assert len(events) == N * M
+    for n in range(N):
+        assert [i for (m, i) in events if m == n] == range(M)
+
+
+def test_bounded():
+    "put() waits for room, offer() fails and append_drop() discards"
+    queue = RunQueue(maxlen=3)
+    for i in range(3):
+        assert queue.offer(i)
+    assert not queue.offer(3)
+    assert not queue.put(3, timeout=0.05)
+    assert queue.append_drop(3) == 0
+    assert list(queue) == [1, 2, 3]
+
+    consumer = Thread(target=lambda: (time.sleep(0.05), queue.pop()))
+    consumer.start()
+    assert queue.put(4, timeout=1)
+    consumer.join()
+    assert list(queue) == [2, 3, 4]
+
+    queue.append(5)  # append() ignores maxlen
+    assert queue.stats() == dict(size=4, maxlen=3, high=4)
+
+
+def event(client, i, priority=None):
+    req = Request(method='DO', path='/%s' % i)
+    req[X_CLIENT] = client
+    if priority is not None:
+        req[X_PRIORITY] = str(priority)
+    return req
+
+
+def test_fair_queue():
+    "strict priorities, then weighted turns among clients"
+    queue = FairQueue()
+    queue.weights['b'] = 2
+    for i in range(6):
+        queue.append(event('a', i))  # chatty client comes first
+    for i in range(6):
+        queue.append(event('b', i))
+    queue.append(event('c', 0))
+    queue.append(event('ctl', 0, priority=0))
+
+    order = [(e[X_CLIENT], e.path) for e in queue.drain()]
+    assert order[0] == ('ctl', '/0')
+    clients = [c for (c, p) in order[1:]]
+    assert sorted(clients[:3]) == ['a', 'b', 'c']  # c is not starved
+    assert clients[3:9].count('b') == 4  # b weights twice as a
+    for client in 'ab':
+        assert [p for (c, p) in order if c == client] == \
+            ['/%s' % i for i in range(6)]
+    assert not queue
+
+
+def test_fair_queue_drop():
+    "a full fair queue drops from the least urgent busiest client"
+    queue = FairQueue(maxlen=4)
+    for i in range(3):
+        queue.append(event('a', i, priority=9))
+    queue.append(event('b', 0, priority=1))
+    dropped = queue.append_drop(event('b', 1, priority=1))
+    assert (dropped[X_CLIENT], dropped.path) == ('a', '/0')
+    assert [e.path for e in queue.drain(2)] == ['/0', '/1']
+    assert len(queue) == 2
+
+
+def test_fair_queue_appendleft():
+    "events put back are served first, in the order they are put back"
+    queue = FairQueue()
+    for i in range(3):
+        queue.append(event('a', i))
+    first, second = queue.pop(), queue.pop()
+    queue.appendleft(second)
+    queue.appendleft(first)
+    assert [e.path for e in queue.drain()] == ['/0', '/1', '/2']
+
+
+# End
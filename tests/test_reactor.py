@@ -0,0 +1,93 @@
+"""Test reactor and coroutines module"""
+import time
+from threading import Thread
+
+import pytest
+
+from swarmforce.reactor import Reactor, Future, TimeoutError, gather
+
+
+@pytest.fixture(scope="function")
+def loop(request):
+    "Provide a reactor running in its own thread"
+    loop = Reactor()
+    thread = Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        loop.stop()
+        thread.join(2)
+        loop.close()
+
+    request.addfinalizer(fin)
+    return loop
+
+
+def test_callbacks_order(loop):
+    "callbacks run in order and timers fire in deadline order"
+    done = Future()
+    seen = []
+    now = time.time()
+    loop.call_at(now + 0.06, seen.append, 'c')
+    loop.call_at(now + 0.02, seen.append, 'b')
+    handle = loop.call_at(now + 0.04, seen.append, 'x')
+    loop.call_soon_threadsafe(seen.append, 'a')
+    loop.call_at(now + 0.08, done.set_result, True)
+    assert loop.cancel(handle)
+
+    assert done.result(1)
+    assert seen == ['a', 'b', 'c']
+    assert time.time() - now >= 0.08
+
+
+def test_coroutines(loop):
+    "many sleeping coroutines run concurrently in the loop thread"
+    def sleeper(i):
+        value = yield loop.sleep(0.1, i)
+        yield  # let others run
+        raise StopIteration(value * 2)
+
+    start = time.time()
+    tasks = [loop.spawn(sleeper(i)) for i in range(1000)]
+    assert [task.result(2) for task in tasks] == range(0, 2000, 2)
+    assert time.time() - start < 1
+
+
+def test_errors(loop):
+    "errors are raised into the coroutine and kept in its task"
+    failed = Future()
+
+    def waiter():
+        try:
+            yield failed
+        except KeyError:
+            raise ValueError('handled')
+
+    task = loop.spawn(waiter())
+    with pytest.raises(TimeoutError):
+        task.result(0.05)
+    failed.set_exception(KeyError('boom'))
+    with pytest.raises(ValueError):
+        task.result(1)
+
+
+def test_gather(loop):
+    "gather waits for all the futures or fails with the first error"
+    futures = [loop.sleep(0.01 * (5 - i), i) for i in range(5)]
+    assert gather(futures).result(1) == range(5)
+    assert gather([]).result(0) == []
+
+    def fan_out():
+        results = yield gather(loop.sleep(0.01, i) for i in range(3))
+        raise StopIteration(sum(results))
+
+    assert loop.spawn(fan_out()).result(1) == 3
+
+    failed = Future()
+    failed.set_exception(KeyError('boom'))
+    with pytest.raises(KeyError):
+        gather([loop.sleep(0.01), failed]).result(1)
+
+
+# End
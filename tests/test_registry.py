@@ -0,0 +1,81 @@
+"""Test worker registry module"""
+import os
+import time
+
+from swarmforce.swarm import Layout
+from swarmforce.registry import WorkerRegistry, RECORD_SIZE
+
+DEAD_PID = 999999999
+
+
+def wid(i):
+    return '%040x' % i
+
+
+def test_slots(tmpdir):
+    "records are found by slot and dead slots are reused"
+    path = str(tmpdir.join('workers.idx'))
+    registry = WorkerRegistry(path)
+    for i in range(5):
+        assert registry.register(wid(i), pid=100 + i) == i
+    assert os.path.getsize(path) == 5 * RECORD_SIZE
+
+    other = WorkerRegistry(path)  # another process
+    assert other.get(wid(3))[0] == 103
+    other.remove(wid(3))
+    assert registry.get(wid(3)) is None
+    assert registry.register(wid(9)) == 3
+    assert len(registry) == 5
+    assert os.path.getsize(path) == 5 * RECORD_SIZE
+
+    before = registry.get(wid(9))[1]
+    time.sleep(0.01)
+    registry.heartbeat(wid(9))
+    assert other.get(wid(9))[1] > before
+
+
+def test_heartbeat_reused_slot(tmpdir):
+    "a heartbeat never overwrites the worker that took its slot"
+    path = str(tmpdir.join('workers.idx'))
+    a = WorkerRegistry(path)
+    b = WorkerRegistry(path)  # another process
+    a.register(wid(1))
+    b.remove(wid(1))
+    assert b.register(wid(2)) == 0
+    assert a.heartbeat(wid(1)) == 1
+    assert sorted(b.status()) == [wid(1), wid(2)]
+
+
+def test_incremental_liveness(tmpdir):
+    "psutil is only asked about stale workers, once per interval"
+    registry = WorkerRegistry(str(tmpdir.join('workers.idx')))
+    registry.register(wid(0))  # fresh heartbeat
+    registry.register(wid(1), pid=DEAD_PID, heartbeat=0)
+    registry.register(wid(2), pid=os.getpid(), heartbeat=0)
+
+    status = registry.status()
+    assert [status[wid(i)][2] for i in range(3)] == [True, False, True]
+    assert registry.checks == 2
+    registry.status()
+    assert registry.checks == 2
+
+
+def test_layout(tmpdir):
+    "Layout uses the registry and imports the existing pid files"
+    old = Layout(str(tmpdir), 'node', wid(1))
+    old.setup()
+    file(old['pid_file'], 'wt').write('%s 0' % DEAD_PID)
+
+    layout = Layout(str(tmpdir), 'node', wid(2))
+    layout.setup()
+    layout.update_pid_file()
+    status = layout.get_worker_status()
+    assert sorted(status) == [wid(1), wid(2)]
+    assert status[wid(2)].active and not status[wid(1)].active
+
+    layout.clean_dead()
+    assert not os.path.exists(old['home'])
+    assert layout.get_worker_status().keys() == [wid(2)]
+
+
+# End
@@ -0,0 +1,53 @@
+"""Test consistent hashing ring module"""
+from collections import Counter
+
+from swarmforce.misc import hasher
+from swarmforce.ring import HashRing, movement
+from swarmforce.shards import shard_starts, shard_of
+
+KEYS = [hasher(u'key-%s' % i) for i in range(20000)]
+
+
+def test_lookup():
+    "lookup and lookup_many agree and cover all the nodes"
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    owners = ring.lookup_many(KEYS)
+    assert owners == [ring.lookup(key) for key in KEYS]
+    assert ring.lookup('f' * 40) == ring.owners[0]  # wraps around
+
+    counts = Counter(owners)
+    assert sorted(counts) == ['a', 'b', 'c', 'd']
+    for node in counts:
+        assert 0.15 < counts[node] / float(len(KEYS)) < 0.35
+
+
+def test_weights():
+    "a node with double weight owns about twice the keys"
+    ring = HashRing(['a', 'b'])
+    ring.add('c', weight=2)
+    counts = Counter(ring.lookup_many(KEYS))
+    assert 1.5 < counts['c'] / float(counts['a']) < 2.5
+
+
+def test_movement():
+    "only the keys of the changed node move"
+    before = HashRing(['n%s' % i for i in range(4)])
+    after = before.copy()
+    after.add('n4')
+    report = movement(before, after, KEYS)
+    assert 0.1 < report['ratio'] < 0.3
+    assert set(new for (old, new) in report['flows']) == set(['n4'])
+
+    after.remove('n1')
+    report = movement(before, after, KEYS)
+    assert all(old == 'n1' or new == 'n4'
+               for (old, new) in report['flows'])
+
+    # static ranges move most of the keys when adding a fifth node
+    old, new = shard_starts(4), shard_starts(5)
+    moved = sum(1 for key in KEYS
+                if shard_of(key, old) != shard_of(key, new))
+    assert moved > 0.4 * len(KEYS)
+
+
+# End
@@ -0,0 +1,117 @@
+"""Test routing of requests to workers"""
+import random
+
+from swarmforce.swarm import Worker
+from swarmforce.routing import Router, RouteCache, analyze, \
+     literal_prefix, split_branches
+
+
+def test_analyze_rules():
+    "Rules are split into literal method tokens and path prefixes"
+    assert split_branches('NEW|UPDATE /inbox') == ['NEW', 'UPDATE /inbox']
+    assert split_branches('DO /(a|b)') == ['DO /(a|b)']
+    assert split_branches('DO /[|]x') == ['DO /[|]x']
+
+    assert literal_prefix('/inbox/eval') == '/inbox/eval'
+    assert literal_prefix('/inbox/.*') == '/inbox/'
+    assert literal_prefix('/inbox?') == '/inbo'
+    assert literal_prefix(r'/a\.b\d') == '/a.b'
+
+    assert analyze('DO /inbox/eval') == [('do', '/inbox/eval')]
+    assert analyze('GET|POST /done') is None
+    assert analyze('GET /done|POST /Done') == [('get', '/done'),
+                                               ('post', '/done')]
+    assert analyze('.* /workers') is None
+
+
+def test_route_same_as_regexp():
+    "The router finds exactly the workers whose regexp match"
+    rules = ['DO /inbox/eval', 'NEW|UPDATE /inbox', 'UPDATE /done',
+             '.* /workers', 'GET /a/b/c', 'GET /a', 'POST /a.*/x',
+             'get /A/B', 'DELETE']
+    methods = ['DO', 'NEW', 'UPDATE', 'GET', 'POST', 'DELETE', 'DELETEX']
+    paths = ['/inbox/eval', '/inbox/evaluate', '/inbox', '/done/1',
+             '/workers', '/a', '/a/b', '/a/b/c/d', '/aa/x', '/other']
+
+    router = Router()
+    workers = []
+    for i in range(50):
+        worker = Worker()
+        for rule in random.sample(rules, 2):
+            worker.listen(rule)
+        router.add(worker)
+        workers.append(worker)
+
+    for method in methods:
+        for path in paths:
+            statusline = '%s %s' % (method, path)
+            expected = [w for w in workers if w.regexp.match(statusline)]
+            assert router.route(statusline) == expected
+
+
+def test_incremental_update():
+    "Listen, unlisten and remove update the index"
+    router = Router()
+    worker = Worker()
+    router.add(worker)
+    assert router.route('DO /x') == []
+
+    worker.listen('DO /x')
+    router.update(worker)
+    assert router.route('DO /x/1') == [worker]
+
+    worker.unlisten('DO /x')
+    router.update(worker)
+    assert router.route('DO /x/1') == []
+    assert not router.index
+
+    worker.listen('.* /y')
+    router.update(worker)
+    assert router.route('ANY /y') == [worker]
+
+    generation = router.generation
+    router.remove(worker)
+    assert router.generation > generation
+    assert router.route('ANY /y') == []
+    assert not router.wildcard
+
+
+def test_route_cache():
+    "Decisions are cached until a rule changes"
+    router = Router(cache_size=2)
+    worker = Worker()
+    worker.listen('DO /x')
+    router.add(worker)
+
+    assert router.route('DO /x') == [worker]
+    assert router.route('DO /x') == [worker]
+    assert router.cache.hits == 1
+    assert router.cache.misses == 1
+
+    worker.listen('GET /y')
+    router.update(worker)
+    assert router.route('GET /y') == [worker]
+    assert router.route('DO /x') == [worker]
+    assert router.cache.misses == 3
+
+    router.route('GET /z')  # evicts 'GET /y'
+    assert len(router.cache) == 2
+    router.route('GET /y')
+    assert router.cache.stats()['misses'] == 5
+
+
+def test_lru_order():
+    "The least recently used entry is evicted first"
+    cache = RouteCache(size=2)
+    cache.put('a', 0, ('A', ))
+    cache.put('b', 0, ('B', ))
+    assert cache.get('a', 0) == ('A', )
+    cache.put('c', 0, ('C', ))
+    assert cache.get('b', 0) is None
+    assert cache.get('a', 0) == ('A', )
+
+    assert cache.get('a', 1) is None  # new generation
+    assert not cache
+
+
+# End
@@ -0,0 +1,65 @@
+"""Test sharded runtime module"""
+import time
+
+from swarmforce.swarm import Worker, hash_range
+from swarmforce.http import Request
+from swarmforce.shards import ShardedWorld, shard_starts, shard_of
+
+
+class Counter(Worker):
+    "Count the requests seen by a shard"
+    def __init__(self):
+        Worker.__init__(self)
+        self.hits = 0
+
+    def dispatch_request(self, event):
+        self.hits += 1
+
+
+def add_counter(world, index):
+    world.new(Counter).listen('DO /count')
+
+
+def test_shard_of():
+    "shard_of agrees with hash_range bounds"
+    for shards in (1, 2, 3, 8):
+        starts = shard_starts(shards)
+        assert shard_of('0' * 40, starts) == 0
+        assert shard_of('f' * 40, starts) == shards - 1
+        for i in range(shards):
+            low, high = hash_range(i, shards)
+            assert shard_of('%040x' % low, starts) == i
+            assert shard_of('%040x' % (high - 1), starts) == i
+
+
+def test_sharded_world():
+    "every request is handled by the shard that owns its hash"
+    world = ShardedWorld(3, setup=add_counter, flush_size=1024)
+    world.start()
+    expected = [0] * 3
+    for i in range(300):
+        req = Request(method='DO', path='/count', body=u'%s' % i)
+        expected[world.owner(req)] += 1
+        world.push(req)
+
+    stats = world.stop()
+    assert [stats[i]['received'] for i in range(3)] == expected
+    assert all(expected)
+    assert not any(p.is_alive() for p in world.processes)
+
+
+def sleepy(world, index):
+    time.sleep(30)
+
+
+def test_stop_timeout():
+    "stop() gives up on shards that do not finish in time"
+    world = ShardedWorld(2, setup=sleepy)
+    world.start()
+    start = time.time()
+    assert world.stop(timeout=0.5) == {}
+    assert time.time() - start < 5
+    assert not any(p.is_alive() for p in world.processes)
+
+
+# End
@@ -0,0 +1,95 @@
+"""Test shared memory ring buffer module"""
+import os
+import time
+import tempfile
+
+import pytest
+
+from swarmforce.swarm import World
+from swarmforce.http import Request
+from swarmforce.shmring import ShmRing, RingSender, RingReceiver
+from swarmforce.tests.demo_workers import EvalWorker
+
+
+@pytest.fixture(scope="function")
+def path(request):
+    "Provide a path for a ring file, removed after the test"
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'ring')
+
+    def fin():
+        for name in os.listdir(root):
+            os.unlink(os.path.join(root, name))
+        os.rmdir(root)
+
+    request.addfinalizer(fin)
+    return path
+
+
+def test_wrap_around(path):
+    "bytes come out in order across the end of the buffer"
+    consumer = ShmRing(path, size=64, create=True)
+    producer = ShmRing(path)
+    assert producer.size == 64
+
+    assert producer.write('a' * 40)
+    assert not producer.write('b' * 40)  # no room
+    assert consumer.read() == 'a' * 40
+    assert producer.write('b' * 40)
+    assert producer.write('c' * 24)
+    assert len(consumer) == 64
+    assert consumer.read() == 'b' * 40 + 'c' * 24
+    assert consumer.read() == ''
+    assert not consumer.wait(0.01)
+
+    with pytest.raises(ValueError):
+        producer.write('x' * 65)
+    producer.close()
+    consumer.close()
+
+
+def test_child_process(path):
+    "a forked producer wakes up a sleeping consumer"
+    consumer = ShmRing(path, size=256, create=True)
+    pid = os.fork()
+    if not pid:
+        producer = ShmRing(path)
+        time.sleep(0.1)
+        for i in range(100):
+            producer.put('%03d' % i)  # the ring is filled many times
+        os._exit(0)
+
+    assert consumer.wait(5)
+    data = ''
+    while len(data) < 300:
+        data += consumer.read() or ''
+        consumer.wait(0.5)
+    os.waitpid(pid, 0)
+    assert data == ''.join('%03d' % i for i in range(100))
+    consumer.close()
+
+
+def test_push_into_world(path):
+    "events sent through the ring are pushed into the World"
+    world = World()
+    world.start()
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    receiver = RingReceiver(ShmRing(path, size=4096, create=True), world)
+    receiver.start()
+
+    sender = RingSender(ShmRing(path))
+    requests = [Request(method='DO', path='/inbox/eval', body=u'%s * 2' % i)
+                for i in range(50)]
+    futures = [world.expect(req) for req in requests]
+    assert sender.push(requests[0])
+    assert sender.push_many(requests[1:])
+
+    assert [f.result(5).body for f in futures] == \
+        [u'%s' % (i * 2) for i in range(50)]
+    assert sender.sent == receiver.received == 50
+    receiver.stop()
+    world.stop()
+    receiver.ring.unlink()
+
+
+# End
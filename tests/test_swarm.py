@@ -6,12 +6,14 @@ import subprocess
 import pytest
 
 from swarmforce.misc import expath
-from swarmforce.swarm import World, Worker, \
+from swarmforce.swarm import World, AsyncWorld, Worker, \
      MAX_HASH, hash_range, RUNNING, PAUSED
+from swarmforce.queues import FairQueue, REJECT, DROP_OLDEST
 from swarmforce.http import Event, Request, Response, \
-     X_TIME, X_REMAIN_EXECUTIONS
+     X_TIME, X_TIMEOUT, X_REMAIN_EXECUTIONS, X_PRIORITY
 from swarmforce.misc import until
-from swarmforce.tests.demo_workers import Boss, EvalWorker
+from swarmforce.reactor import gather, TimeoutError
+from swarmforce.tests.demo_workers import Boss, EvalWorker, BatchEvalWorker
 from swarmforce.loggers import getLogger, setup_logging
 
 from loganalizer.main import get_files_fmt, MultiParser
@@ -111,6 +113,463 @@ def test_deferred_requests(world):
     until("client.response == '3'")
 
 
+def test_wakeup_latency(world):
+    """an idle world dispatch pushed and deferred events without delay"""
+    client = world.new(Boss)
+    worker = world.new(EvalWorker)
+    worker.listen('DO /inbox/eval')
+    stamps = []
+    client.add_response_handler('2\d\d$', lambda r: stamps.append(time.time()))
+
+    time.sleep(0.2)  # let the world fall asleep
+    req = client.new_request()
+    req.method = 'DO'
+    req.path = '/inbox/eval'
+    req.body = '1 + 2'
+    start = time.time()
+    client.send(req)
+    until("len(stamps) == 1", timeout=1)
+    assert stamps[0] - start < 0.01
+
+    req = client.new_request()
+    req.method = 'DO'
+    req.path = '/inbox/eval'
+    req.body = '2 + 2'
+    req[X_TIME] = start = time.time() + 0.3
+    client.send(req)
+    until("len(stamps) == 2", timeout=1)
+    assert 0 <= stamps[1] - start < 0.01
+
+
+def test_waker_release():
+    """a paused world sleeps on its waker, released when run() exits"""
+    world = World()
+    world.lifetime = 0.3
+    world.start()
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    world.set(PAUSED)
+    req = Request(method='DO', path='/inbox/eval', body=u'1 + 1')
+    future = world.expect(req)
+    world.push(req)
+    time.sleep(0.1)
+    assert not future.done()
+    world.set(RUNNING)
+    assert future.result(1).body == u'2'
+
+    world.join(1)  # lifetime is over, stop() was never called
+    assert world.waker.closed
+    world.waker.wake()  # harmless after close
+
+
+def test_expect_deferred(world):
+    """a future follows its request when deferral changes its hash"""
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    req = Request(method='DO', path='/inbox/eval', body=u'3 * 3')
+    req[X_TIME] = time.time() + 0.1
+    req[X_TIMEOUT] = 0.1
+    future = world.expect(req, timeout=2)
+    key = req.key
+    world.push(req)
+    assert future.result(1).body == u'9'
+    assert req.key != key
+    assert not world.futures
+
+
+def test_pool_dispatch():
+    """workers run on a thread pool keeping the order of their events"""
+    world = World()
+    world.pool_size = 4
+    world.start()
+    client = world.new(Boss)
+    workers = [world.new(EvalWorker) for _ in range(3)]
+    for i, worker in enumerate(workers):
+        worker.listen('DO /inbox/eval/%s' % i)
+
+    seen = []
+    client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+    N = 30
+    for n in range(N):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval/%s' % (n % 3)
+        req.body = '%s' % n
+        client.send(req)
+
+    until("len(seen) == N", timeout=3)
+    assert sorted(int(body) for body in seen) == range(N)
+    for i in range(3):
+        bodies = [int(body) for body in seen if int(body) % 3 == i]
+        assert bodies == range(i, N, 3)
+    assert world.depths() == {}
+
+    world.stop()
+    assert world.idle_workers()
+    assert not any(t.is_alive() for t in world.executor.threads)
+
+
+class Recorder(EvalWorker):
+    "Remember the events it receives"
+    def __init__(self):
+        EvalWorker.__init__(self)
+        self.events = []
+
+    def dispatch_request(self, event):
+        self.events.append(event)
+        EvalWorker.dispatch_request(self, event)
+
+
+def test_pool_copies():
+    """pool tasks get their own copy of an event sent to many workers"""
+    world = World()
+    world.pool_size = 2
+    world.start()
+    workers = [world.new(Recorder) for _ in range(2)]
+    for worker in workers:
+        worker.listen('DO /inbox/eval')
+
+    req = Request(method='DO', path='/inbox/eval', body=u'1 + 1')
+    future = world.expect(req)
+    world.push(req)
+    assert future.result(1).body == u'2'
+    until("all(w.events for w in workers)", timeout=1)
+    a, b = workers[0].events[0], workers[1].events[0]
+    assert a is not b and a is not req
+    assert a == b and a.key == req.key
+    assert 'response' not in req.__dict__
+    world.stop()
+
+
+def test_send_future(world):
+    """send() may return a Future of the response"""
+    client = world.new(Boss)
+    worker = world.new(EvalWorker)
+    worker.listen('DO /inbox/eval')
+
+    futures = []
+    for i in range(100):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval'
+        req.body = '%s + 1' % i
+        futures.append(client.send(req, future=True, timeout=2))
+
+    responses = gather(futures).result(2)
+    assert [r.body for r in responses] == [u'%s' % (i + 1) for i in range(100)]
+    assert responses[0].request.body == '0 + 1'
+    assert client.hits == 0  # response handlers are not used
+    assert not world.futures
+
+    req = client.new_request()
+    req.method = 'DO'
+    req.path = '/nobody/listen'
+    future = client.send(req, future=True, timeout=0.1)
+    with pytest.raises(TimeoutError):
+        future.result(1)
+    assert not world.futures
+
+
+def test_pending_ttl(world):
+    """unanswered requests leave the pending table after their ttl"""
+    client = world.new(Boss)
+    codes = []
+    client.add_response_handler('504', lambda r: codes.append(r.code))
+    world.pending_ttl = 0.1
+    for i in range(10):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/nobody/listen/%s' % i
+        client.send(req)
+
+    assert world.pending_stats()['size'] == 10
+    until("world.pending_stats()['size'] == 0", timeout=1)
+    assert world.pending_stats() == dict(size=0, timers=0, evicted=10)
+    assert not codes
+
+    world.answer_expired = True
+    req = client.new_request()
+    req.method = 'DO'
+    req.path = '/nobody/listen'
+    future = client.send(req, future=True)
+    assert future.result(1).code == '504'
+
+    req = client.new_request()
+    req.method = 'DO'
+    req.path = '/nobody/listen/again'
+    client.send(req)
+    until("codes == ['504']", timeout=1)
+    assert world.pending_stats() == dict(size=0, timers=0, evicted=12)
+
+
+def test_response_without_client(world):
+    """a response nobody waits for does not stop the world"""
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    world.push(Request(method='DO', path='/inbox/eval', body=u'1'))
+    req = Request(method='DO', path='/inbox/eval', body=u'2')
+    future = world.expect(req)
+    world.push(req)
+    assert future.result(1).body == u'2'
+    assert world.is_alive()
+
+
+def test_backpressure(world):
+    """a bounded queue refuses requests with 503 or drops the oldest"""
+    client = world.new(Boss)
+    worker = world.new(EvalWorker)
+    worker.listen('DO /inbox/eval')
+    codes = []
+    client.add_response_handler('\d+$', lambda r: codes.append(r.code))
+
+    def request(i):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval'
+        req.body = '%s' % i
+        return req
+
+    world.set(PAUSED)
+    time.sleep(0.1)
+    world.queue.maxlen = 5
+    world.overflow = REJECT
+    accepted = [world.push(request(i)) for i in range(8)]
+    assert accepted == [True] * 5 + [False] * 3
+    assert not world.try_push(request(8))
+    assert len(world.pending) == 8  # 3 requests wait for their 503
+
+    world.set(RUNNING)
+    until("len(codes) == 8", timeout=1)
+    assert sorted(codes) == ['200'] * 5 + ['503'] * 3
+    assert world.queue_stats() == dict(size=0, maxlen=5, high=8,
+                                       rejected=4, dropped=0)
+
+    del codes[:]
+    world.set(PAUSED)
+    time.sleep(0.1)
+    world.overflow = DROP_OLDEST
+    assert all(world.push(request(i)) for i in range(7))
+    world.set(RUNNING)
+    until("len(codes) == 7", timeout=1)
+    assert sorted(codes) == ['200'] * 5 + ['503'] * 2
+    assert world.queue_stats()['dropped'] == 2
+    assert not world.pending
+
+
+def test_priorities():
+    """urgent requests and quiet clients are not starved by bulk work"""
+    world = World()
+    world.queue = FairQueue()
+    world.max_batch = 1
+    world.start()
+    worker = world.new(EvalWorker)
+    worker.listen('DO /inbox/eval')
+    bulk, quiet = world.new(Boss), world.new(Boss)
+    seen = []
+    for client in bulk, quiet:
+        client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+
+    world.set(PAUSED)
+    time.sleep(0.1)
+    for i in range(20):
+        req = bulk.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval'
+        req.body = '%s' % i
+        bulk.send(req)
+    req = quiet.new_request()
+    req.method = 'DO'
+    req.path = '/inbox/eval'
+    req.body = '100'
+    quiet.send(req)
+    req = quiet.new_request()
+    req.method = 'DO'
+    req.path = '/inbox/eval'
+    req.body = '-1'
+    req[X_PRIORITY] = '0'
+    quiet.send(req)
+
+    world.set(RUNNING)
+    until("len(seen) == 22", timeout=2)
+    world.stop()
+    assert seen[0] == '-1'
+    assert seen.index('100') <= 2
+    assert [int(b) for b in seen if 0 <= int(b) < 20] == range(20)
+
+
+def test_dispatch_batch(world):
+    """batch workers get the queued requests together"""
+    client = world.new(Boss)
+    worker = world.new(BatchEvalWorker, batch_size=10, linger=0.1)
+    worker.listen('DO /inbox/eval')
+    seen = []
+    client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+
+    world.set(PAUSED)
+    time.sleep(0.1)
+    for i in range(25):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval'
+        req.body = '%s * 3' % i
+        client.send(req)
+
+    start = time.time()
+    world.set(RUNNING)
+    until("len(seen) == 25", timeout=1)
+    assert time.time() - start >= 0.1  # last batch lingers
+    assert worker.sizes == [10, 10, 5]
+    assert seen == [u'%s' % (i * 3) for i in range(25)]
+
+
+class SlowEval(EvalWorker):
+    "A coroutine worker waiting for some I/O"
+    def dispatch_request(self, event):
+        yield self.world.loop.sleep(0.2)
+        EvalWorker.dispatch_request(self, event)
+
+
+def test_async_world():
+    """coroutine workers wait concurrently in the reactor thread"""
+    world = AsyncWorld()
+    world.start()
+    client = world.new(Boss)
+    N = 500
+    for i in range(N):
+        world.new(SlowEval).listen('DO /inbox/eval/%s$' % i)
+
+    seen = []
+    client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+    world.set(PAUSED)
+    start = time.time()
+    for i in range(N):
+        req = client.new_request()
+        req.method = 'DO'
+        req.path = '/inbox/eval/%s' % i
+        req.body = '%s * 2' % i
+        if i == 0:
+            req[X_TIME] = time.time() + 0.3
+        client.send(req)
+
+    time.sleep(0.1)
+    assert not seen
+    world.set(RUNNING)
+    until("len(seen) == N", timeout=3)
+    assert time.time() - start < 1
+    assert sorted(int(body) for body in seen) == range(0, 2 * N, 2)
+    world.stop()
+    assert not world.is_alive()
+
+
+class SlowWatcher(Worker):
+    "A coroutine worker that looks at requests without answering them"
+    def dispatch_request(self, event):
+        yield self.world.loop.sleep(0.3)
+
+
+def test_async_shared_event():
+    """coroutine workers answering the same event send one response each"""
+    world = AsyncWorld()
+    world.start()
+    client = world.new(Boss)
+    world.new(SlowEval).listen('DO /inbox/eval')
+    world.new(SlowWatcher).listen('DO /inbox/eval')
+    pushed = []
+    push = world.push
+
+    def spy(event, block=True):
+        if isinstance(event, Response):
+            pushed.append(event.body)
+        return push(event, block)
+
+    world.push = spy
+    client.send(client.new_request(method='DO', path='/inbox/eval',
+                                   body=u'2 + 2'))
+    time.sleep(0.5)
+    assert pushed == [u'4']
+    world.stop()
+
+
+def test_async_backpressure():
+    """an AsyncWorld applies the overflow policy of its queue"""
+    world = AsyncWorld()
+    world.start()
+    client = world.new(Boss)
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    codes = []
+    client.add_response_handler('\d+$', lambda r: codes.append(r.code))
+
+    world.set(PAUSED)
+    world.queue.maxlen = 3
+    world.overflow = REJECT
+    requests = [client.new_request(method='DO', path='/inbox/eval',
+                                   body=u'%s' % i) for i in range(5)]
+    assert [world.push(req) for req in requests] == [True] * 3 + [False] * 2
+    world.set(RUNNING)
+    until("len(codes) == 5", timeout=1)
+    assert sorted(codes) == ['200'] * 3 + ['503'] * 2
+    assert world.queue_stats()['rejected'] == 2
+    world.stop()
+
+
+def test_async_batch():
+    """an AsyncWorld delivers batches and flushes them when stopped"""
+    world = AsyncWorld()
+    world.start()
+    client = world.new(Boss)
+    worker = world.new(BatchEvalWorker, batch_size=10)
+    worker.listen('DO /inbox/eval')
+    seen = []
+    client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+
+    world.set(PAUSED)
+    for i in range(25):
+        client.send(client.new_request(method='DO', path='/inbox/eval',
+                                       body=u'%s * 3' % i))
+    world.set(RUNNING)
+    until("len(seen) == 25", timeout=1)
+    assert worker.sizes == [10, 10, 5]
+    assert seen == [u'%s' % (i * 3) for i in range(25)]
+
+    worker.linger = 60
+    for i in range(3):
+        client.send(client.new_request(method='DO', path='/inbox/eval',
+                                       body=u'%s' % i))
+    time.sleep(0.1)
+    assert len(seen) == 25  # still lingering
+    world.stop()
+    assert worker.sizes[-1] == 3
+    assert seen[25:] == [u'0', u'1', u'2']
+
+
+@pytest.mark.parametrize('pool_size', [0, 2])
+def test_batch_flush_on_stop(pool_size):
+    """the batches left when a World stops are answered"""
+    world = World()
+    world.pool_size = pool_size
+    world.start()
+    client = world.new(Boss)
+    worker = world.new(BatchEvalWorker, batch_size=10, linger=60)
+    worker.listen('DO /inbox/eval')
+    seen = []
+    client.add_response_handler('2\d\d$', lambda r: seen.append(r.body))
+
+    for i in range(3):
+        client.send(client.new_request(method='DO', path='/inbox/eval',
+                                       body=u'%s' % i))
+    time.sleep(0.2)
+    assert not seen
+    world.stop()
+    assert worker.sizes == [3]
+    assert seen == [u'0', u'1', u'2']
+
+
+def test_lifetime():
+    """world finish by itself when its lifetime is over"""
+    world = World()
+    world.lifetime = 0.2
+    world.start()
+    world.join(2)
+    assert not world.is_alive()
+
+
 def test_remain_executions(world, clean_logs):
     """test remain executions for a requests"""
 
@@ -0,0 +1,118 @@
+"""Test timer backends for deferred requests"""
+import random
+import pytest
+
+from swarmforce.timers import HeapTimers, TimingWheel
+
+NOW = 1000000.0
+
+
+def heap():
+    return HeapTimers()
+
+
+def wheel():
+    return TimingWheel(resolution=0.01, now=NOW)
+
+
+@pytest.fixture(params=[heap, wheel])
+def timers(request):
+    "Provide every timer backend"
+    return request.param()
+
+
+def test_expire_in_order(timers):
+    "Items come out once their deadline is reached and never before"
+    deadlines = [NOW + random.random() * 100 for _ in range(2000)]
+    for deadline in deadlines:
+        timers.push(deadline, deadline)
+
+    assert len(timers) == 2000
+    now = timers.next_deadline()
+    fired = timers.expire(now)
+    assert min(deadlines) in fired
+
+    while timers:
+        now += 0.5
+        batch = timers.expire(now)
+        assert all(d <= now for d in batch)
+        fired.extend(batch)
+
+    assert sorted(fired) == sorted(deadlines)
+    assert timers.next_deadline() is None
+
+
+def test_cancel(timers):
+    "Cancelled items are never returned"
+    handles = [timers.push(NOW + i, i) for i in range(10)]
+    assert timers.cancel(handles[3])
+    assert not timers.cancel(handles[3])
+    assert len(timers) == 9
+
+    assert timers.expire(NOW + 20) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert not timers
+
+
+def test_cancel_equal_items(timers):
+    "A handle cancels its own entry, not another one holding an equal item"
+    call = (len, ('x', ))
+    first = timers.push(NOW + 1, call)
+    second = timers.push(NOW + 1, call)
+    assert timers.cancel(second)
+    assert timers.expire(NOW + 2) == [call]
+    assert not timers.cancel(first)  # already expired
+    assert not timers
+
+
+def test_batches(timers):
+    "expire() honours max_batch and keeps the rest for the next call"
+    for i in range(25):
+        timers.push(NOW + 1, i)
+
+    assert len(timers.expire(NOW + 2, max_batch=10)) == 10
+    assert len(timers.expire(NOW + 2, max_batch=10)) == 10
+    assert len(timers.expire(NOW + 2, max_batch=10)) == 5
+    assert timers.expire(NOW + 2) == []
+
+
+def test_wheel_far_deadlines():
+    "Far deadlines are cascaded down the levels and the overflow list"
+    timers = TimingWheel(resolution=0.01, bits=2, levels=2, now=NOW)
+    for delay in (0.02, 0.5, 3, 50):
+        timers.push(NOW + delay, delay)
+
+    assert timers.expire(NOW + 0.1) == [0.02]
+    assert timers.expire(NOW + 1) == [0.5]
+    assert timers.expire(NOW + 10) == [3]
+    assert timers.expire(NOW + 49.9) == []
+    assert timers.expire(NOW + 50.01) == [50]
+
+
+def test_wheel_next_deadline():
+    "Sleeping until next_deadline() never oversleeps a cascaded item"
+    timers = TimingWheel(resolution=0.01, now=NOW)
+    for delay in (0.3, 0.63, 1.0, 1.33, 45.5):
+        timers.push(NOW + delay, NOW + delay)
+    now = NOW
+    while len(timers):
+        now = max(now, timers.next_deadline())  # sleep
+        for deadline in timers.expire(now):
+            assert deadline <= now <= deadline + timers.resolution
+
+
+def test_heap_purge():
+    "Cancelled entries do not pile up in the heap"
+    timers = HeapTimers()
+    keep = ['keep%s' % i for i in range(10)]
+    for item in keep:
+        timers.push(NOW + 600, item)
+    for i in range(10000):
+        timers.cancel(timers.push(NOW + 600, i))
+    assert len(timers) == 10
+    assert len(timers.heap) <= timers.min_purge + 11
+    assert timers.cancelled == len(timers.heap) - 10
+    assert sorted(timers.expire(NOW + 601)) == keep
+    assert timers.cancelled == 0
+
+
+# End
@@ -0,0 +1,97 @@
+"""Test TCP transport module"""
+import socket
+
+import pytest
+
+from swarmforce.swarm import World
+from swarmforce.http import Request
+from swarmforce.reactor import gather
+from swarmforce.transport import Transport
+from swarmforce.misc import until
+from swarmforce.tests.demo_workers import EvalWorker
+
+
+@pytest.fixture(scope="function")
+def server(request):
+    "Provide a world answering eval requests through a Transport"
+    world = World()
+    world.start()
+    world.new(EvalWorker).listen('DO /inbox/eval')
+    transport = Transport(world)
+    transport.listen()
+    transport.start()
+
+    def fin():
+        transport.stop()
+        world.stop()
+
+    request.addfinalizer(fin)
+    return transport
+
+
+@pytest.fixture(scope="function")
+def client(request):
+    transport = Transport()
+    transport.start()
+    request.addfinalizer(transport.stop)
+    return transport
+
+
+def test_pipelining(server, client):
+    "many requests are in flight on a single keep-alive connection"
+    conn = client.connect(server.address)
+    futures = []
+    for i in range(200):
+        req = Request(method='DO', path='/inbox/eval', body=u'%s * 2' % i)
+        futures.append(client.send(conn, req, future=True))
+
+    responses = gather(futures).result(5)
+    assert [r.body for r in responses] == [u'%s' % (i * 2)
+                                           for i in range(200)]
+    assert len(server.connections) == 1
+    assert conn.sent == conn.received == 200
+
+    # the connection is kept alive for the next requests
+    req = Request(method='DO', path='/inbox/eval', body=u'7 * 6')
+    assert client.send(conn, req, future=True).result(1).body == u'42'
+    assert len(server.connections) == 1
+
+
+def test_large_body(server, client):
+    "messages larger than a socket read are reassembled"
+    conn = client.connect(server.address)
+    body = u'len(%r)' % ('x' * 500000)
+    req = Request(method='DO', path='/inbox/eval', body=body)
+    assert client.send(conn, req, future=True).result(5).body == u'500000'
+
+
+def test_malformed_peer(server, client):
+    "a peer sending garbage is dropped, the other connections go on"
+    conn = client.connect(server.address)
+    req = Request(method='DO', path='/inbox/eval', body=u'1 + 1')
+    assert client.send(conn, req, future=True).result(2).body == u'2'
+
+    bad = socket.create_connection(server.address, 2)
+    bad.sendall('DO /inbox/eval HTTP/1.1\r\nContent-Length: abc\r\n\r\n')
+    assert bad.recv(100) == ''  # closed by the server
+    bad.close()
+
+    assert server.is_alive()
+    until("len(server.connections) == 1", timeout=1)
+    req = Request(method='DO', path='/inbox/eval', body=u'2 + 2')
+    assert client.send(conn, req, future=True).result(2).body == u'4'
+
+
+def test_closed(server, client):
+    "requests waiting on a closed connection fail"
+    conn = client.connect(server.address)
+    req = Request(method='DO', path='/nobody/listen')
+    future = client.send(conn, req, future=True)
+    server.stop()
+    with pytest.raises(IOError):
+        future.result(2)
+    with pytest.raises(IOError):
+        client.send(conn, Request(method='DO', path='/x'))
+
+
+# End
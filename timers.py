@@ -0,0 +1,243 @@
+"""Timer backends used by World for deferred requests.
+
+Both backends share the same interface:
+
+- push(deadline, item) -> handle
+- cancel(handle)
+- expire(now, max_batch=None) -> list of items whose deadline is due
+- next_deadline() -> earliest time when something may be due, or None
+
+HeapTimers is a binary heap with O(log n) insert and amortized O(1)
+lazy cancel.
+TimingWheel is a hierarchical timing wheel with O(1) insert and cancel,
+better suited for hundreds of thousands of timers where a resolution
+of a few milliseconds is acceptable.
+"""
+
+import heapq
+import math
+import time
+from collections import deque
+from itertools import count
+
+# entry fields
+DEADLINE = 0
+SEQ = 1
+ITEM = 2
+TICK = 3
+
+
+class HeapTimers(object):
+    """Deferred items sorted in a binary heap.
+
+    The handle returned by push() is the heap entry itself, so cancel()
+    marks exactly that entry even if other ones hold an equal item.
+    Cancelled entries are discarded when they reach the top of the heap,
+    or all at once when there are more of them than min_purge and than
+    pending entries, so timers cancelled long before their deadline
+    (like the expiration of answered requests) do not pile up.
+    """
+    min_purge = 1024  # cancelled entries kept before a purge
+
+    def __init__(self):
+        self.heap = list()
+        self.active = 0
+        self.cancelled = 0  # cancelled entries still in the heap
+        self._seq = count()
+
+    def push(self, deadline, item):
+        "Schedule an item and return a handle that can be cancelled"
+        entry = [deadline, next(self._seq), item]
+        heapq.heappush(self.heap, entry)
+        self.active += 1
+        return entry
+
+    def cancel(self, handle):
+        "Cancel a scheduled item. Return True if it was still pending"
+        if handle[ITEM] is None:
+            return False
+        handle[ITEM] = None
+        self.active -= 1
+        self.cancelled += 1
+        if self.cancelled > self.min_purge and self.cancelled > self.active:
+            self.purge()
+        return True
+
+    def purge(self):
+        "Remove the cancelled entries from the heap"
+        heap = self.heap
+        heap[:] = [entry for entry in heap if entry[ITEM] is not None]
+        heapq.heapify(heap)
+        self.cancelled = 0
+
+    def expire(self, now, max_batch=None):
+        "Return the items whose deadline is <= now in deadline order"
+        heap = self.heap
+        batch = list()
+        while heap and heap[0][DEADLINE] <= now:
+            if max_batch is not None and len(batch) >= max_batch:
+                break
+            entry = heapq.heappop(heap)
+            item = entry[ITEM]
+            if item is not None:
+                entry[ITEM] = None
+                self.active -= 1
+                batch.append(item)
+            else:
+                self.cancelled -= 1
+        return batch
+
+    def next_deadline(self):
+        "Return the deadline of the earliest pending item"
+        heap = self.heap
+        while heap and heap[0][ITEM] is None:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+        if heap:
+            return heap[0][DEADLINE]
+
+    def __len__(self):
+        return self.active
+
+
+class TimingWheel(object):
+    """A hierarchical timing wheel.
+
+    Level 0 has one slot per tick of 'resolution' seconds. Each upper
+    level slot spans a whole turn of the level below and its entries
+    are cascaded down when the lower level wraps around, as the
+    classic kernel timer wheel does. Items never fire before their
+    deadline and at most 'resolution' seconds later.
+    """
+    def __init__(self, resolution=0.01, bits=6, levels=4, now=None):
+        if now is None:
+            now = time.time()
+
+        self.resolution = float(resolution)
+        self.bits = bits
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.wheels = [[list() for _ in xrange(self.size)]
+                       for _ in xrange(levels)]
+        self.overflow = list()
+        self.ready = deque()
+        self.current = int(now / self.resolution)
+        self.active = 0
+        self._seq = count()
+
+    def _tick(self, deadline):
+        return int(math.ceil(deadline / self.resolution))
+
+    def _add(self, entry):
+        tick = entry[TICK]
+        delta = tick - self.current
+        bits = self.bits
+        if delta < 0:
+            self.wheels[0][self.current & self.mask].append(entry)
+            return
+        for level, wheel in enumerate(self.wheels):
+            if delta < 1 << (bits * (level + 1)):
+                wheel[(tick >> (bits * level)) & self.mask].append(entry)
+                return
+        self.overflow.append(entry)
+
+    def _cascade(self, level):
+        "Move down the entries of the current slot of a level"
+        index = (self.current >> (self.bits * level)) & self.mask
+        slot = self.wheels[level][index]
+        if slot:
+            self.wheels[level][index] = list()
+            for entry in slot:
+                if entry[ITEM] is not None:
+                    self._add(entry)
+        return index
+
+    def _turn(self):
+        """Cascade the upper levels into the level 0 turn that starts
+        at the current tick. Calling it again in the same tick is a no-op
+        as new entries of this turn are added to level 0 directly"""
+        levels = len(self.wheels)
+        level = 1
+        while level < levels and not self._cascade(level):
+            level += 1
+        if level == levels and self.overflow:
+            overflow, self.overflow = self.overflow, list()
+            for entry in overflow:
+                if entry[ITEM] is not None:
+                    self._add(entry)
+
+    def push(self, deadline, item):
+        "Schedule an item and return a handle that can be cancelled"
+        entry = [deadline, next(self._seq), item, self._tick(deadline)]
+        self._add(entry)
+        self.active += 1
+        return entry
+
+    def cancel(self, handle):
+        "Cancel a scheduled item. Return True if it was still pending"
+        if handle[ITEM] is None:
+            return False
+        handle[ITEM] = None
+        self.active -= 1
+        return True
+
+    def _advance(self, now):
+        "Move the wheel up to now, collecting due entries into ready"
+        # tolerate float rounding when now comes from next_deadline()
+        target = int(now / self.resolution + 1e-6)
+        wheel = self.wheels[0]
+        ready = self.ready
+        while self.current <= target:
+            if not self.active:
+                # nothing to collect, just jump
+                self.current = target + 1
+                break
+            index = self.current & self.mask
+            if not index:
+                self._turn()
+            self.current += 1
+            slot = wheel[index]
+            if slot:
+                wheel[index] = list()
+                slot.sort()
+                ready.extend(slot)
+
+    def expire(self, now, max_batch=None):
+        "Return the items whose deadline is <= now"
+        self._advance(now)
+        ready = self.ready
+        batch = list()
+        while ready:
+            if max_batch is not None and len(batch) >= max_batch:
+                break
+            entry = ready.popleft()
+            item = entry[ITEM]
+            if item is not None:
+                entry[ITEM] = None
+                self.active -= 1
+                batch.append(item)
+        return batch
+
+    def next_deadline(self):
+        """Return the earliest time when an item may be due, rounded
+        up to the wheel resolution. This is exact when the item is in
+        the current turn of level 0 and a lower bound otherwise."""
+        if not self.active:
+            return None
+        if self.ready:
+            return (self.current - 1) * self.resolution
+        if not self.current & self.mask:
+            self._turn()  # bring down the items due in this turn
+        wheel = self.wheels[0]
+        for i in xrange(self.size - (self.current & self.mask)):
+            for entry in wheel[(self.current + i) & self.mask]:
+                if entry[ITEM] is not None:
+                    return (self.current + i) * self.resolution
+        # wait until next cascade
+        return ((self.current | self.mask) + 1) * self.resolution
+
+    def __len__(self):
+        return self.active
+
+
+# End
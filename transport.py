@@ -0,0 +1,374 @@
+"""TCP transport exchanging events between Worlds.
+
+Events travel in wire form (see Serializer.wire) over persistent
+connections and are read back with a StreamParser, so any number of
+requests may be pipelined on a connection without waiting for their
+responses. Responses carry the X-Request-Id of their request and may
+come back in any order.
+
+A Transport runs a non-blocking I/O loop in its own thread, using
+epoll when available and select() otherwise. Requests received on a
+listening Transport are pushed into its World and the response of the
+World is written back on the same connection. Requests sent with
+send(future=True) return a Future resolved with the remote response.
+"""
+import time
+import errno
+import socket
+import select
+from collections import deque
+from functools import partial
+from threading import Thread, Lock
+
+from swarmforce.loggers import getLogger
+from swarmforce.http import Request, SERIALIZER, X_REQ_ID, StreamParser
+from swarmforce.misc import Waker
+from swarmforce.reactor import Future
+
+log = getLogger('swarmforce')
+
+READ = 1
+WRITE = 4
+RECV_SIZE = 65536
+PING = 'PING'  # requests answered by the Transport itself
+AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+# errors that only break the connection raising them: hang ups and
+# socket errors, and malformed or undecodable messages (StreamParser)
+BROKEN = (EOFError, socket.error, RuntimeError, ValueError)
+
+
+class Poller(object):
+    """Wait for file descriptors to be ready, with epoll when available
+    and select() otherwise. Events are READ and WRITE masks."""
+    def __init__(self):
+        self.masks = dict()
+        self.epoll = select.epoll() if hasattr(select, 'epoll') else None
+
+    def register(self, fd, mask):
+        self.masks[fd] = mask
+        if self.epoll is not None:
+            self.epoll.register(fd, mask)
+
+    def modify(self, fd, mask):
+        if self.masks.get(fd) != mask:
+            self.masks[fd] = mask
+            if self.epoll is not None:
+                self.epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        if self.masks.pop(fd, None) is not None and self.epoll is not None:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        "Return the list of (fd, mask) ready for I/O"
+        if self.epoll is not None:
+            try:
+                ready = self.epoll.poll(-1 if timeout is None else timeout)
+            except IOError, why:
+                if why.errno != errno.EINTR:
+                    raise
+                return []
+            result = list()
+            for fd, mask in ready:
+                if mask & ~WRITE:
+                    # errors and hang ups are reported by recv()
+                    result.append((fd, mask & WRITE | READ))
+                else:
+                    result.append((fd, WRITE))
+            return result
+
+        masks = self.masks
+        rlist = [fd for fd, mask in masks.items() if mask & READ]
+        wlist = [fd for fd, mask in masks.items() if mask & WRITE]
+        try:
+            rlist, wlist, _ = select.select(rlist, wlist, [], timeout)
+        except select.error:
+            return []
+        ready = dict((fd, READ) for fd in rlist)
+        for fd in wlist:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+
+class Connection(object):
+    """A persistent connection carrying events in both directions.
+
+    write() may be called from any thread, the Transport loop does the
+    actual I/O. waiting holds the Futures of requests sent through
+    this connection, by request key.
+    """
+    def __init__(self, transport, sock, address):
+        self.transport = transport
+        self.sock = sock
+        self.address = address
+        self.parser = StreamParser()
+        self.output = bytearray()
+        self.lock = Lock()
+        self.waiting = dict()
+        self.last = time.time()
+        self.closed = False
+        self.sent = self.received = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def write(self, event):
+        "Queue an event to be sent"
+        with self.lock:
+            if self.closed:
+                raise IOError('Connection to %s is closed' % (self.address, ))
+            SERIALIZER.write(event, self.output)
+            self.sent += 1
+        self.transport.want_write(self)
+
+    def flush(self):
+        "Send as much output as possible. Return True if all was sent"
+        with self.lock:
+            output = self.output
+            while output:
+                try:
+                    sent = self.sock.send(output)
+                except socket.error, why:
+                    if why.errno in AGAIN:
+                        return False
+                    raise
+                del output[:sent]
+                self.last = time.time()
+        return True
+
+    def read(self):
+        """Read the available data and return the events completed.
+        Raise EOFError when the peer closes the connection."""
+        events = list()
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except socket.error, why:
+                if why.errno in AGAIN:
+                    break
+                raise
+            if not data:
+                raise EOFError()
+            events.extend(self.parser.feed(data))
+            if len(data) < RECV_SIZE:
+                break
+        self.last = time.time()
+        self.received += len(events)
+        return events
+
+
+class Transport(Thread):
+    """Exchange events with other Transports over TCP.
+
+    Call listen() to accept connections and connect() to open them,
+    both may be used on the same Transport. Incoming requests are
+    pushed into world (when there is one) and answered on the same
+    connection. Connections idle for more than idle_timeout seconds
+    are closed, None keeps them forever.
+    """
+    def __init__(self, world=None, timeout=60, idle_timeout=None,
+                 name=None):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.world = world
+        self.timeout = timeout  # seconds to wait for the World response
+        self.idle_timeout = idle_timeout
+        self.poller = Poller()
+        self.waker = Waker()
+        self.poller.register(self.waker.fileno(), READ)
+        self.connections = dict()
+        self.listener = None
+        self.address = None
+        self.calls = deque()  # functions to run in the loop thread
+        self.running = False
+
+    # public API, any thread
+    def listen(self, host='127.0.0.1', port=0, backlog=128):
+        "Accept connections on host:port. Return the bound address"
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sock.setblocking(0)
+        self.listener = sock
+        self.address = sock.getsockname()
+        self._call(self.poller.register, sock.fileno(), READ)
+        return self.address
+
+    def connect(self, address, timeout=10):
+        "Open a persistent connection to a listening Transport"
+        sock = socket.create_connection(address, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        conn = Connection(self, sock, address)
+        self._call(self._add, conn)
+        return conn
+
+    def send(self, conn, event, future=False):
+        """Send an event through a connection. When future is True
+        return a Future resolved with the remote response."""
+        result = None
+        if future:
+            result = Future()
+            key = event.hash()
+            conn.waiting[key] = result
+        try:
+            conn.write(event)
+        except IOError:
+            if future:
+                conn.waiting.pop(key, None)
+            raise
+        return result
+
+    def want_write(self, conn):
+        "Ask the loop to flush the output of a connection"
+        self._call(self._flush, conn)
+
+    def ping(self, conn):
+        "Return a Future resolved when the peer answers a PING request"
+        return self.send(conn, Request(method=PING, path='/'), future=True)
+
+    def close(self, conn):
+        "Close a connection, failing the requests waiting on it"
+        self._call(self._close, conn)
+
+    def start(self):
+        self.running = True
+        Thread.start(self)
+
+    def stop(self, timeout=5):
+        "Close all the connections and stop the loop thread"
+        self.running = False
+        self.waker.wake()
+        self.join(timeout)
+        for conn in self.connections.values():
+            self._close(conn)
+        if self.listener is not None:
+            self.listener.close()
+        self.poller.close()
+        self.waker.close()
+
+    # loop thread
+    def _call(self, func, *args):
+        self.calls.append((func, args))
+        self.waker.wake()
+
+    def run(self):
+        log.info('RUN: %s at %s', self, self.address)
+        listener = self.listener
+        waker = self.waker.fileno()
+        while self.running:
+            self.waker.clear()
+            calls = self.calls
+            for _ in xrange(len(calls)):
+                func, args = calls.popleft()
+                func(*args)
+            if calls:
+                continue
+
+            for fd, mask in self.poller.poll(self._poll_timeout()):
+                if fd == waker:
+                    continue
+                if listener is not None and fd == listener.fileno():
+                    self._accept()
+                    continue
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                try:
+                    if mask & WRITE:
+                        self._flush(conn)
+                    if mask & READ:
+                        self._read(conn)
+                except BROKEN, why:
+                    self._close(conn, why)
+            if self.idle_timeout is not None:
+                self._reap()
+        log.info('FINISH: %s', self)
+
+    def _poll_timeout(self):
+        if self.idle_timeout is not None:
+            return self.idle_timeout / 2.0
+        return None
+
+    def _add(self, conn):
+        self.connections[conn.fileno()] = conn
+        self.poller.register(conn.fileno(), READ)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error, why:
+                if why.errno in AGAIN:
+                    return
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(0)
+            self._add(Connection(self, sock, address))
+
+    def _flush(self, conn):
+        if conn.closed:
+            return
+        try:
+            done = conn.flush()
+        except socket.error, why:
+            self._close(conn, why)
+            return
+        self.poller.modify(conn.fileno(), READ if done else READ | WRITE)
+
+    def _read(self, conn):
+        for event in conn.read():
+            if isinstance(event, Request):
+                self._incoming(conn, event)
+            else:
+                future = conn.waiting.pop(event.get(X_REQ_ID), None)
+                if future is not None:
+                    future.set_result(event)
+                elif self.world is not None:
+                    self.world.push(event)
+
+    def _incoming(self, conn, request):
+        "Push a remote request into the world, answer on the connection"
+        if request.method == PING:
+            request.hash()
+            conn.write(request.answer())
+            return
+        if self.world is None:
+            log.warn('%s has no world for %s', self, request.statusline)
+            return
+        future = self.world.expect(request, self.timeout)
+        self.world.push(request)
+        future.add_done_callback(partial(self._reply, conn))
+
+    def _reply(self, conn, future):
+        if future.exception() is None and not conn.closed:
+            conn.write(future.result())
+
+    def _reap(self):
+        limit = time.time() - self.idle_timeout
+        for conn in self.connections.values():
+            if conn.last < limit and not conn.waiting and not conn.output:
+                self._close(conn)
+
+    def _close(self, conn, why=None):
+        if conn.closed:
+            return
+        with conn.lock:
+            conn.closed = True
+        if why is not None and not isinstance(why, EOFError):
+            log.warn('Closing connection to %s: %s', conn.address, why)
+        self.connections.pop(conn.fileno(), None)
+        self.poller.unregister(conn.fileno())
+        conn.sock.close()
+        error = IOError('Connection to %s closed' % (conn.address, ))
+        for future in conn.waiting.values():
+            future.set_exception(error)
+        conn.waiting.clear()
+
+
+# End